@@ -12,26 +12,28 @@ from threading import Thread
 import Queue
 from subprocess import Popen, PIPE, STDOUT
 import slippy
-from gpsfiles import gen_tracks_from_files
-from imagefiles import gen_images_from_files
-from options import OptionsDialog
+from gpsfiles import gen_tracks_from_files, match_times, ClockOffsetEstimator
+from imagefiles import gen_images_from_files, save_changes, same_geotag, ExiftoolSession, ExiftoolException
+from pipeline import Pipeline, Batcher
+from importer import copy_file, rotate_file, plan_import, RotateError
+from exporter import find_export_files, read_images, plan_export, resolve_collisions, catalog_entries, ExportMover
+from exporter import ExportArchive, ArchiveVolumeError, archive_files, archive_base
+from exporter import COLLISION_ASK, COLLISION_SKIP, ARCHIVE_NONE
+from exporter import find_places, uses_places
+from geocoder import ReverseGeocoder, GeocoderError, build_index
+from catalog import Catalog
+from geotagjournal import GeotagJournal, previous_geotags, restore_geotags
+from hashindex import HashIndex, CHECK_OFF
+from importjournal import ImportJournal, PLANNED, COPIED, ROTATED, LOADED
+from options import OptionsDialog, int_option
 from imagelist import ImageListCtrlPanel
+from stagestats import StageStats, DISCOVERY, COPY, ROTATE, EXIF_READ, GEOTAG_MATCH, EXIF_WRITE, EXPORT_MOVE
+from stagestats import EXPORT_ARCHIVE
+from statspanel import StageStatsPanel
 
 _DEFAULT_STATUS_TEXT = "PGTips v0.1"
 
-# Define the jpegtran command-line options to losslessly correct
-# the possible orientations for an image
-_jpegtranOptions = [
-    None, # 0 - not present
-    [], # 1 - no translation
-    ["-flip", "horizontal"], # 2 - Shouldn't get this with a photo?
-    ["-rotate", "180"], # 3 - Camera was upside down!
-    ["-flip", "vertical"], # 4 - Shouldn't get this with a photo?
-    ["-transpose"], # 5 - Shouldn't get this with a photo?
-    ["-rotate", "90"], # 6 - Camera was on its side
-    ["-transverse"], # 7 - Shouldn't get this with a photo?
-    ["-rotate", "270"], # 8 - Camera was on its other side
-]
+_DEBUG = True
 
 class GpsFileCache(object):
     """
@@ -107,6 +109,11 @@ class MyFrame(wx.Frame):
         self._closing = False
 
         self._exiftoolChecked = ""
+        self._offsetEstimator = None
+        self._offsetEstimatorFiles = None
+        # The index of places that photos are filed by, opened when first used
+        self._geocoder = None
+        self._geocoderFile = None
 
         self._mgr = aui.AuiManager(
             self,
@@ -132,9 +139,14 @@ class MyFrame(wx.Frame):
                     ]),
                 ("&Geotag", [
                     ("Geotag all images\tCtrl-T", self.OnGeotagAll),
+                    ("Estimate camera clock offset...", self.OnEstimateOffset),
+                    ("Undo last geotag run...", self.OnUndoGeotag),
                     ]),
                 ("&Tools", [
                     ("Toggle full screen mode\tF11", self.OnToggleFullScreen),
+                    ("Index gazetteer...", self.OnIndexGazetteer),
+                    ("Show statistics", self.OnShowStats),
+                    ("Reset statistics", self.OnResetStats),
                     ("Options...", self.OnOptions),
                     ]),
                 ]
@@ -178,11 +190,17 @@ class MyFrame(wx.Frame):
 
         self._images = ImageListCtrlPanel(self)
 
+        # Counts of the work done by each stage of importing, geotagging and
+        # exporting, which are also logged for analysis after a run
+        self._stats = StageStats("pgtips.stats")
+        self._statsPanel = StageStatsPanel(self, self._stats)
+
         # add the panes to the manager
         self._mgr.AddPane(self._slipMap, wx.TOP, 'Mapping pane')
         #self._mgr.AddPane(text1, wx.TOP, 'Preview pane')
         self._mgr.AddPane(self._gpxTree, wx.TOP, 'GPS fle pane')
         self._mgr.AddPane(self._images, wx.CENTER)
+        self._mgr.AddPane(self._statsPanel, wx.BOTTOM, 'Statistics pane')
 
         # tell the manager to 'commit' all the changes just made
         self._mgr.Update()
@@ -196,13 +214,32 @@ class MyFrame(wx.Frame):
         self._workerThread = Thread(target = self._WorkerThread)
         self._workerThread.start()
 
-        self._importing = False
-        self._importQueue = Queue.Queue()
-        self._importThread = Thread(target = self._ImportThread)
-        self._importThread.start()
+        # The import threads form the final (metadata loading) stage of the
+        # import pipeline, so the queue feeding them is bounded too
+        options = self._optionsDialog.options
+        self._importQueue = Queue.Queue(int_option(options, "ImportQueueSize"))
+        self._importThreads = []
+        self._importBusy = []
+        self._importBatchers = []
+        for n in range(max(1, int_option(options, "ImportMetadataWorkers"))):
+            self._importBusy.append(False)
+            self._importBatchers.append(Batcher(self._importQueue,
+                                                int_option(options, "ImportBatchSize"),
+                                                int_option(options, "ImportBatchLatency") / 1000.0))
+            t = Thread(target = self._ImportThread, args = (n,))
+            t.start()
+            self._importThreads.append(t)
 
         self._checkQueue = Queue.Queue()
 
+        # Index of the contents of the files already held, to skip duplicates on import
+        self._hashIndex = HashIndex("pgtips.idx")
+        self._importJournal = ImportJournal("pgtips.jnl")
+        # Catalog of the files that have been exported into the filing tree
+        self._catalog = Catalog("pgtips.db")
+        # The geotags replaced by each geotag run, so that it can be undone
+        self._geotagJournal = GeotagJournal("pgtips.undo")
+
         self._images.add_image_select_notify(self.OnImageSelected)
         self._images.add_image_deselect_notify(self.OnImageDeselected)
 
@@ -240,7 +277,10 @@ class MyFrame(wx.Frame):
             except Queue.Empty:
                 break
 
-        if self._working or self._importing:
+        if self._mgr.GetPane(self._statsPanel).IsShown():
+            self._statsPanel.refresh()
+
+        if self._working or any(self._importBusy):
             self._statusBar.progress.Pulse()
             wx.CallLater(100, self._PulseProgress)
         else:
@@ -333,12 +373,15 @@ class MyFrame(wx.Frame):
         include = self._optionsDialog.options["ImageExtensions"]
         if len(include) == 0:
             include = None
-        for i in gen_images_from_files(
-                path,
-                include = include,
-                exiftool = self._exiftoolChecked):
-            wx.CallAfter(self._statusBar.SetStatusText, "Loading " + i["FileName"])
-            wx.CallAfter(self._add_image, i)
+        with self._stats.timed(EXIF_READ, items = 0) as counts:
+            for i in gen_images_from_files(
+                    path,
+                    include = include,
+                    exiftool = self._exiftoolChecked,
+                    sidecarExtensions = self._optionsDialog.options["SidecarExtensions"]):
+                counts["items"] += 1
+                wx.CallAfter(self._statusBar.SetStatusText, "Loading " + i["FileName"])
+                wx.CallAfter(self._add_image, i)
 
     def OnLoadImages(self, event):
         if not self._exiftool_check():
@@ -356,92 +399,174 @@ class MyFrame(wx.Frame):
 ################################################################################
 
     # This function is run as a seperate thread to automatically batch the files
-    # to exiftool to improve performance
-    def _ImportThread(self):
+    # to exiftool to improve performance. Batches grow with the rate at which
+    # files arrive, up to the batch size, but no file waits longer than the
+    # batch latency, and they are read by a resident exiftool process.
+    def _ImportThread(self, n):
+        batcher = self._importBatchers[n]
+        session = None
         while not self._closing:
-            files = []
-            try:
-                filename = self._importQueue.get_nowait()
-            except Queue.Empty:
-                self._importing = False
-                filename = self._importQueue.get()
-            self._importing = True
-            if filename is not None:
-                files.append(filename)
+            options = self._optionsDialog.options
+            batcher.targetSize = int_option(options, "ImportBatchSize")
+            batcher.maxLatency = int_option(options, "ImportBatchLatency") / 1000.0
+            self._importBusy[n] = False
+            jobs = batcher.get_batch()
+            if jobs is None:
+                break
+            self._importBusy[n] = True
+            images = None
+            # A batch that fails is retried once with a new exiftool, in case
+            # it was the resident one that went wrong
+            for attempt in range(2):
                 try:
-                    timeout = 0.5
-                    while True:
-                        filename = self._importQueue.get(block = timeout > 0, timeout = timeout)
-                        if filename is not None:
-                            files.append(filename)
-                            timeout -= 0.1
-                        else:
-                            break
-                except Queue.Empty:
-                    for i in gen_images_from_files(files, exiftool = self._exiftoolChecked):
-                        wx.CallAfter(self._statusBar.SetStatusText, "Loading " + i["FileName"])
-                        wx.CallAfter(self._add_image, i)
-
-    def _copy_file_work(self, f, dirpath, workingDir, ext, process, useJpegtran, jpegexiforient, jpegtran):
-        wx.CallAfter(self._statusBar.SetStatusText, "Importing " + f)
-        srcFile = os.path.join(dirpath, f)
-        destFile = os.path.join(workingDir, f)
-        if os.path.exists(destFile):
-            # User must have OK'd this so delete the destination file then copy the new one into place
-            os.remove(destFile)
-        shutil.copy(srcFile, workingDir)
-        if process and ext in [".jpg", ".jpeg"] and useJpegtran:
-            # losslessly rotate
-            p = Popen([jpegexiforient, "-n", destFile], stdin = PIPE, stdout = PIPE, stderr = PIPE)
-            stdout, stderr = p.communicate()
+                    if session is None or session.exiftool != self._exiftoolChecked:
+                        if session is not None:
+                            session.close()
+                            session = None
+                        session = ExiftoolSession(self._exiftoolChecked,
+                                                  sidecarExtensions = options["SidecarExtensions"])
+                    with self._stats.timed(EXIF_READ, len(jobs), sum(job.size or 0 for job in jobs)):
+                        images = session.read_images([job.destFile for job in jobs])
+                    break
+                except (ExiftoolException, OSError), e:
+                    if _DEBUG: print "Unable to load metadata:", e
+                    if session is not None:
+                        session.close()
+                        session = None
+                    error = e
+            if images is None:
+                self._report_import_load_errors([(job, error) for job in jobs])
+                continue
+            loaded = set(os.path.normpath(i.get_filename()) for i in images)
+            for i in images:
+                wx.CallAfter(self._statusBar.SetStatusText, "Loading " + i["FileName"])
+                wx.CallAfter(self._add_image, i)
+            failed = []
+            for job in jobs:
+                if os.path.normpath(job.destFile) in loaded:
+                    self._importJournal.record(job, LOADED)
+                else:
+                    failed.append((job, "exiftool was unable to read it"))
+            if len(failed) > 0:
+                self._report_import_load_errors(failed)
+        self._importBusy[n] = False
+        if session is not None:
+            session.close()
+
+    def _report_import_load_errors(self, failed):
+        # The files have been imported, they just aren't in the list
+        wx.CallAfter(wx.MessageBox,
+                     "Unable to load the metadata of %d imported file(s):\n\n" % len(failed) +
+                     "\n".join("%s: %s" % (job.destFile, e) for job, e in failed[:20]),
+                     "Import errors",
+                     wx.OK | wx.ICON_ERROR)
+
+    def _import_copy(self, job):
+        wx.CallAfter(self._statusBar.SetStatusText, "Importing " + job.filename)
+        if not job.copied:
+            with self._stats.timed(COPY) as counts:
+                job = copy_file(job)
+                counts["bytes"] = job.size
+            self._importJournal.record(job, COPIED)
+        self._hashIndex.add_imported(job.destFile, job.size, job.partial, job.hash)
+        return job
+
+    def _import_rotate(self, job, jpegtran):
+        if job.rotate and not job.rotated:
+            wx.CallAfter(self._statusBar.SetStatusText, "Importing %s (losslessly rotating)" % job.filename)
             try:
-                orient = int(stdout)
-            except ValueError:
-                # No orientation flag? Set orient to the value that prevents any further work
-                orient = 1
-            if orient > 1:
-                wx.CallAfter(self._statusBar.SetStatusText, "Importing %s (losslessly rotating)" % f)
-                print destFile, "- using option:", _jpegtranOptions[orient]
-                tmpFile = destFile + ".pgtips~.jpg"
-                p = Popen([jpegtran, "-copy", "all"] + _jpegtranOptions[orient] + ["-outfile", tmpFile, destFile],
-                          stdin = PIPE, stdout = PIPE, stderr = PIPE)
-                stdout, stderr = p.communicate()
-                assert p.returncode == 0, "jpegtran failed: " + stderr
-                
-                p = Popen([jpegexiforient, "-1", tmpFile], stdin = PIPE, stdout = PIPE, stderr = PIPE)
-                stdout, stderr = p.communicate()
-                assert p.returncode == 0, "jpegexiforient failed: " + stderr
-
-                os.remove(destFile)
-                os.rename(tmpFile, destFile)
-
-        if process:
-            # Now that the file is where it needs to be, load the file
-            # TODO: Could optimize by batching files together?
-            if 1:
-                self._importQueue.put(destFile)
-            else:
-                wx.CallAfter(self._statusBar.SetStatusText, "Loading " + f)
-                for i in gen_images_from_files(destFile, exiftool = self._exiftoolChecked):
-                    wx.CallAfter(self._add_image, i)
+                with self._stats.timed(ROTATE, bytes = job.size or 0):
+                    job = rotate_file(job, jpegtran)
+            except RotateError, e:
+                # The copy is still good, it just hasn't been rotated, so carry on
+                # with it and report the problem at the end
+                job.warnings.append(str(e))
+                return job
+        self._importJournal.record(job, ROTATED)
+        return job
+
+    def _import_load(self, job):
+        if job.process:
+            # Now that the file is where it needs to be, pass it on to be
+            # loaded. The queue is bounded and the import threads stop taking
+            # files when PGTips is closing, so give up then; the journal still
+            # has the file to be loaded when the import is resumed.
+            while not self._closing:
+                try:
+                    self._importQueue.put(job, timeout = 0.1)
+                    return
+                except Queue.Full:
+                    pass
+        else:
+            self._importJournal.record(job, LOADED)
+
+    def _resolve_import_conflicts(self, plan, jpegtran):
+        choices = ["%s (%s)" % (job.filename, reason) for job, reason in plan.conflicts]
+        dlg = wx.MultiChoiceDialog(
+                self,
+                "%d file(s) to be imported clash with existing files.\n\n"
+                "Select the files that should overwrite the existing ones; the\n"
+                "others will not be imported. Cancel abandons the import." % len(choices),
+                "Files exist",
+                choices)
+        if dlg.ShowModal() == wx.ID_OK:
+            plan.resolve_conflicts(dlg.GetSelections())
+            self._do_work(self._run_import_plan, plan, jpegtran)
+        else:
+            self._importJournal.finish()
+        dlg.Destroy()
+
+    def _run_import_plan(self, plan, jpegtran):
+        options = self._optionsDialog.options
+
+        # The files are copied, rotated and handed over to the import threads
+        # (to load their metadata) by a pipeline so that card reads, jpegtran
+        # and exiftool all overlap
+        pipeline = Pipeline([
+                ("copy", self._import_copy, int_option(options, "ImportCopyWorkers")),
+                ("rotate", lambda job: self._import_rotate(job, jpegtran),
+                    int_option(options, "ImportRotateWorkers")),
+                ],
+                sink = self._import_load,
+                queueSize = int_option(options, "ImportQueueSize"))
+
+        for job in plan.jobs():
+            if self._closing:
+                pipeline.cancel()
+                break
+            if not job.copied:
+                self._importJournal.record(job, PLANNED)
+            pipeline.put(job)
 
-    def _copy_file_overwrite_check(self, f, dirpath, workingDir, ext, process, useJpegtran, jpegexiforient, jpegtran):
-        if wx.MessageBox(
-                "%s already exists in %s; overwrite?" % (f, workingDir),
-                "File exists",
-                wx.YES_NO,
-                self) == wx.YES:
-            self._do_work(self._copy_file_work,
-                          f,
-                          dirpath,
-                          workingDir,
-                          ext,
-                          process,
-                          useJpegtran,
-                          jpegexiforient,
-                          jpegtran)
-
-    def _import_files_work(self, fromDir, workingDir, useJpegtran, jpegexiforient, jpegtran, emptyWorkingDir):
+        pipeline.close()
+        # Once a file has been copied and rotated it doesn't need importing
+        # again, so there's no need to wait for its metadata to be loaded
+        if not self._closing:
+            self._importJournal.finish()
+        self._hashIndex.save()
+        if _DEBUG:
+            for n, batcher in enumerate(self._importBatchers):
+                print "Metadata worker %d batches:" % n, batcher.stats()
+        if _DEBUG and len(plan.resumed) > 0:
+            print "Resumed", len(plan.resumed), "file(s) from the unfinished import"
+        if len(plan.identical) > 0:
+            wx.CallAfter(self._statusBar.SetStatusText, "Skipped %d file(s) that have already been imported" % len(plan.identical))
+        problems = ["%s (%s): %s" % (job, stage, e) for stage, job, e in pipeline.errors]
+        warnings = ["%s: %s" % (job, w) for job in plan.jobs() for w in job.warnings]
+        self._stats.mark("import finished", files = len(plan.jobs()), skipped = len(plan.identical),
+                         errors = len(problems), warnings = len(warnings))
+        if len(problems) > 0 or len(warnings) > 0:
+            message = []
+            if len(problems) > 0:
+                message.append("Failed to import %d file(s):\n\n" % len(problems) + "\n".join(problems[:20]))
+            if len(warnings) > 0:
+                message.append("Imported %d file(s) with problems:\n\n" % len(warnings) + "\n".join(warnings[:20]))
+            wx.CallAfter(wx.MessageBox,
+                         "\n\n".join(message),
+                         "Import errors",
+                         wx.OK | wx.ICON_ERROR)
+
+    def _import_files_work(self, fromDir, workingDir, useJpegtran, jpegtran, emptyWorkingDir, resume = False):
         if emptyWorkingDir:
             wx.CallAfter(self._statusBar.SetStatusText, "Deleting files in " + workingDir)
             files = os.listdir(workingDir)
@@ -449,74 +574,55 @@ class MyFrame(wx.Frame):
                 print "Deleting", os.path.join(workingDir, f)
                 os.remove(os.path.join(workingDir, f))
 
-        other = self._optionsDialog.options["OtherExtensions"]
-        image = self._optionsDialog.options["ImageExtensions"]
-        
-        wx.CallAfter(self._statusBar.SetStatusText, "Searching for files to import...")
+        options = self._optionsDialog.options
+        duplicateCheck = options["ImportDuplicateCheck"]
+        if duplicateCheck != CHECK_OFF:
+            wx.CallAfter(self._statusBar.SetStatusText, "Indexing files already held...")
+            self._hashIndex.refresh([d for d in [workingDir, options["FilingDir"]] if d != "" and os.path.isdir(d)])
 
-        # Walk and copy files to working dir
-        for dirpath, dirnames, filenames in os.walk(fromDir):
-            for f in filenames:
-                ext = os.path.splitext(f)[1].lower()
-                copy = False
-                process = False
-                if ext in other or len(other) == 0:
-                    copy = True
-                if ext in image or len(image) == 0:
-                    copy = True
-                    process = True
-                if copy:
-                    destFile = os.path.join(workingDir, f)
-                    if os.path.exists(destFile):
-                        self._do_check(self._copy_file_overwrite_check,
-                                       f,
-                                       dirpath,
-                                       workingDir,
-                                       ext,
-                                       process,
-                                       useJpegtran,
-                                       jpegexiforient,
-                                       jpegtran)
-                    else:
-                        self._do_work(self._copy_file_work,
-                                      f,
-                                      dirpath,
-                                      workingDir,
-                                      ext,
-                                      process,
-                                      useJpegtran,
-                                      jpegexiforient,
-                                      jpegtran)
+        # Files that were completed (or partially completed) by an import that
+        # is being resumed carry on from where they got to
+        records = self._importJournal.start(fromDir, workingDir, resume)
+
+        wx.CallAfter(self._statusBar.SetStatusText, "Searching for files to import...")
+        self._stats.mark("import started", fromDir = fromDir, workingDir = workingDir, resume = resume)
+        with self._stats.timed(DISCOVERY) as counts:
+            plan = plan_import(fromDir, workingDir,
+                               options["ImageExtensions"], options["OtherExtensions"], useJpegtran,
+                               hashIndex = self._hashIndex, duplicateCheck = duplicateCheck,
+                               journal = self._importJournal, records = records,
+                               cancelled = lambda: self._closing)
+            counts["items"] = len(plan.jobs()) + len(plan.identical) + len(plan.conflicts)
+        for job, duplicate in plan.identical:
+            if _DEBUG: print job.srcFile, "is already held as", duplicate
+
+        if len(plan.conflicts) > 0:
+            # All of the clashes are resolved in one go before anything is copied
+            self._do_check(self._resolve_import_conflicts, plan, jpegtran)
+        else:
+            self._run_import_plan(plan, jpegtran)
 
     def OnImport(self, event):
         if not self._exiftool_check():
             return
         useJpegtran = self._optionsDialog.options["JpegtranEnabled"]
         jpegtran = "jpegtran"
-        jpegexiforient = "jpegexiforient"
         if useJpegtran:
             error = False
             path = self._optionsDialog.options["JpegtranPath"]
             if path != "":
                 jpegtran = os.path.join(path, jpegtran)
-                jpegexiforient = os.path.join(path, jpegexiforient)
             try:
                 p = Popen([jpegtran, "-v"], stdin = PIPE, stdout = PIPE, stderr = STDOUT)
                 stdout, stderr = p.communicate()
             except OSError:
                 error = True
-            try:
-                p = Popen([jpegexiforient, "--help"], stdin = PIPE, stdout = PIPE, stderr = STDOUT)
-                stdout, stderr = p.communicate()
-            except OSError:
-                error = True
             if error:
                 response = wx.MessageDialog(
                     self,
                     "PGTips is configured to use jpegtran but it was not able to\n"
-                    "execute jpegtran and/or jpegexiforient. This means that it\n"
-                    "will not be possible to automatically rotate any JPEG files\n"
-                    "during import\n\n"
+                    "execute jpegtran. This means that it will not be possible to\n"
+                    "automatically rotate any JPEG files during import\n\n"
                     "Do you want to continue importing?",
                     "Configuration problem",
                     style = wx.YES_NO | wx.YES_DEFAULT | wx.ICON_QUESTION).ShowModal()
@@ -525,6 +631,25 @@ class MyFrame(wx.Frame):
                 else:
                     useJpegtran = False
 
+        unfinished = self._importJournal.unfinished()
+        if unfinished is not None:
+            fromDir, workingDir = unfinished
+            response = wx.MessageDialog(
+                self,
+                "An import from %s into %s did not finish.\n\n"
+                "Do you want to resume it? Files that were completed will not\n"
+                "be copied again." % (fromDir, workingDir),
+                "Unfinished import",
+                style = wx.YES_NO | wx.CANCEL | wx.YES_DEFAULT | wx.ICON_QUESTION).ShowModal()
+            if response == wx.ID_YES:
+                self._do_work(self._import_files_work,
+                              fromDir, workingDir,
+                              useJpegtran, jpegtran,
+                              False, resume = True)
+                return
+            elif response == wx.ID_CANCEL:
+                return
+
         dlg = wx.DirDialog(self, style = wx.DD_DIR_MUST_EXIST, defaultPath = "/home/steve/Master/")
         if dlg.ShowModal() == wx.ID_OK:
             workingDir = self._optionsDialog.options["WorkingDir"]
@@ -549,7 +674,7 @@ class MyFrame(wx.Frame):
 
             self._do_work(self._import_files_work,
                           dlg.GetPath(), workingDir,
-                          useJpegtran, jpegexiforient, jpegtran,
+                          useJpegtran, jpegtran,
                           emptyWorkingDir)
 
 
@@ -561,62 +686,183 @@ class MyFrame(wx.Frame):
 ####
 ################################################################################
 
-    def _export_file_overwrite(self, f, exportDir, srcFile):
-        dest = os.path.join(exportDir, f)
-        wx.CallAfter(self._statusBar.SetStatusText, "Removing " + dest)
-        os.remove(dest)
-
+    def _export_move(self, srcFiles, exportDir, images, names = {}, sidecars = None):
+        """
+        Move the files (and the sidecars given, if any) into the directory
+        (under the names given, if any),
+        removing them from the image list and adding them to the catalog (with
+        the metadata in the dictionary of ExifFile objects), and returning
+        (srcFile, exception) pairs for any that failed
+        """
+        options = self._optionsDialog.options
+        mover = ExportMover(int_option(options, "ExportCopyWorkers"), self._hashIndex,
+                            options["FilingDir"], options["FilingMirrors"])
+        with self._stats.timed(EXPORT_MOVE, len(srcFiles), sum(os.path.getsize(f) for f in srcFiles)):
+            moved, errors = mover.move_files(srcFiles, exportDir, names, sidecars)
+        found = self._images.find_images([srcFile for srcFile, destFile in moved])
+        if len(found) > 0:
+            wx.CallAfter(self._images.rm_images, found.values())
+        self._catalog.add(catalog_entries(moved, images, self._hashIndex))
+        return errors
+
+    def _report_export_errors(self, errors, collisions = [], volumes = []):
+        message = []
+        if len(errors) > 0:
+            message.append("Failed to export %d file(s):\n\n" % len(errors) +
+                           "\n".join("%s: %s" % (srcFile, e) for srcFile, e in errors[:20]))
+        if len(collisions) > 0:
+            message.append("%d file(s) clashed with files already filed:\n\n" % len(collisions) +
+                           "\n".join("%s: %s (%s)" % (os.path.basename(srcFile), outcome, destFile)
+                                     for srcFile, destFile, outcome in collisions[:20]))
+        if len(volumes) > 0:
+            message.append("Archived to:\n\n" + "\n".join(volumes))
+        if len(message) > 0:
+            wx.CallAfter(wx.MessageBox,
+                         "\n\n".join(message),
+                         "Export errors" if len(errors) > 0 else "Export",
+                         wx.OK | (wx.ICON_ERROR if len(errors) > 0 else wx.ICON_INFORMATION))
+
+    def _export_file_overwrite(self, f, exportDir, srcFile, img, sidecars):
+        # The move replaces the existing file
         wx.CallAfter(self._statusBar.SetStatusText, "Exporting " + f)
-        shutil.move(srcFile, exportDir)
+        self._report_export_errors(self._export_move([srcFile], exportDir, {srcFile: img}, sidecars = sidecars))
 
-    def _export_file_overwrite_check(self, f, exportDir, srcFile):
+    def _export_file_overwrite_check(self, f, exportDir, srcFile, img, sidecars):
         if wx.MessageBox(
                 "%s already exists in %s; overwrite?" % (f, exportDir),
                 "File exists",
                 wx.YES_NO,
                 self) == wx.YES:
-            self._do_work(self._export_file_overwrite, f, exportDir, srcFile)
-
-    def _export_file_work(self, dirpath, f):
-        images = self._optionsDialog.options["ImageExtensions"]
-        other = self._optionsDialog.options["OtherExtensions"]
-
-        ext = os.path.splitext(f)[1].lower()
-        srcFile = os.path.abspath(os.path.join(dirpath, f))
-        img = None
-        exportDatetime = None
-        if ext in images or len(images) == 0:
-            for img in self._images.iter_images():
-                if os.path.abspath(img.get_filename()) == srcFile:
-                    wx.CallAfter(self._images.rm_image, img)
+            self._do_work(self._export_file_overwrite, f, exportDir, srcFile, img, sidecars)
+
+    def _export_work(self, fromDir):
+        options = self._optionsDialog.options
+        wx.CallAfter(self._statusBar.SetStatusText, "Finding files to export...")
+        files = find_export_files(fromDir, options["ImageExtensions"], options["OtherExtensions"])
+
+        # The dates of the images already loaded are known; those of all of the
+        # other files are read in one go before anything is moved
+        images = self._images.find_images(files)
+        unresolved = [srcFile for srcFile in files if srcFile not in images]
+        wx.CallAfter(self._statusBar.SetStatusText, "Reading the dates of %d file(s)..." % len(unresolved))
+        with self._stats.timed(EXIF_READ, items = len(unresolved)):
+            images.update(read_images(unresolved, self._exiftoolChecked, options["SidecarExtensions"]))
+        dates = dict((srcFile, img.dateTime) for srcFile, img in images.iteritems())
+        places = {}
+        if uses_places(options["FilingStruct"]):
+            wx.CallAfter(self._statusBar.SetStatusText, "Finding the places of %d file(s)..." % len(images))
+            try:
+                places = find_places(images, self._place_geocoder(), int_option(options, "PlaceMaxDistance"))
+            except (GeocoderError, IOError, OSError), e:
+                wx.CallAfter(wx.MessageBox, "Unable to find where the files were taken, so nothing was exported:\n\n%s" % e,
+                             "Export", wx.OK | wx.ICON_ERROR)
+                return
+
+        # Everything is worked out up front so that each directory in the
+        # filing tree is only listed and created once
+        plan = plan_export(files, dates, options["FilingDir"], options["FilingStruct"], places)
+        for srcFile in plan.undated:
+            print srcFile, "- unable to determine when it was taken so not exporting"
+
+        archive = None
+        archiveOnly = False
+        if options["ExportArchive"] != ARCHIVE_NONE:
+            archive = ExportArchive(archive_base(options["ExportArchiveDir"]), options["ExportArchive"],
+                                    int_option(options, "ExportArchiveVolumeSize") * 1024 * 1024)
+            archiveOnly = options["ExportArchiveOnly"]
+
+        # Unless the user is to be asked about each clash, they are dealt with
+        # automatically and reported at the end. The archive is written in one
+        # go, so clashes can't wait to be asked about while one is.
+        collisions = []
+        policy = options["ExportCollisions"]
+        if archiveOnly:
+            # Nothing is filed, so nothing clashes
+            for srcFile, exportDir in plan.conflicts:
+                plan.moves.setdefault(exportDir, []).append(srcFile)
+            plan.conflicts = []
+        elif policy != COLLISION_ASK or archive is not None:
+            wx.CallAfter(self._statusBar.SetStatusText, "Checking %d clash(es) with files already filed..." % len(plan.conflicts))
+            collisions = resolve_collisions(plan, COLLISION_SKIP if policy == COLLISION_ASK else policy)
+
+        errors = []
+        toFile = dict(plan.moves)
+        volumes = []
+        if archive is not None:
+            # Everything is archived before anything is filed, so that no file
+            # leaves the working directory before the volume holding it has
+            # been closed and synced
+            toFile = {}
+            for exportDir in plan.dirs():
+                if self._closing:
                     break
-            else:
-                img = list(gen_images_from_files(srcFile, exiftool = self._exiftoolChecked))[0]
-            exportDatetime = img.dateTime
-        if exportDatetime is None and (ext in other or len(other) == 0):
-            otherFile = list(gen_images_from_files(srcFile, exiftool = self._exiftoolChecked))[0]
-            exportDatetime = otherFile.dateTime
-            print f, exportDatetime
-            assert exportDatetime is not None
-            # exportDatetime = datetime.datetime.fromtimestamp(os.stat(srcFile).st_ctime)
-        if exportDatetime is not None:
-            exportDir = os.path.join(self._optionsDialog.options["FilingDir"],
-                                     exportDatetime.strftime(self._optionsDialog.options["FilingStruct"]))
-            if not os.path.isdir(exportDir):
-                os.makedirs(exportDir)
-            if os.path.exists(os.path.join(exportDir, f)):
-                self._do_check(self._export_file_overwrite_check, f, exportDir, srcFile)
-            else:
-                wx.CallAfter(self._statusBar.SetStatusText, "Exporting " + f)
-                shutil.move(srcFile, exportDir)
+                srcFiles = plan.moves[exportDir]
+                wx.CallAfter(self._statusBar.SetStatusText, "Archiving %d file(s) for %s" % (len(srcFiles), exportDir))
+                with self._stats.timed(EXPORT_ARCHIVE, len(srcFiles), sum(os.path.getsize(f) for f in srcFiles)):
+                    archived, failed = archive_files(archive, srcFiles, exportDir, options["FilingDir"],
+                                                     plan.names, plan.sidecars)
+                errors.extend(failed)
+                toFile[exportDir] = [srcFile for srcFile, name in archived]
+            try:
+                volumes = archive.close()
+            except ArchiveVolumeError, e:
+                errors.extend((srcFile, e) for srcFile in e.lost)
+                volumes = archive.volumes
+            self._stats.mark("export archived", volumes = volumes)
+            # Only the files that are safely in the archive are filed; a
+            # discarded volume may have taken some archived for earlier
+            # directories with it
+            failed = set(srcFile for srcFile, e in errors)
+            toFile = dict((exportDir, [f for f in srcFiles if f not in failed])
+                          for exportDir, srcFiles in toFile.iteritems())
+            if archiveOnly:
+                toFile = {}
+
+        for exportDir in plan.dirs():
+            if self._closing:
+                break
+            srcFiles = toFile.get(exportDir, [])
+            if len(srcFiles) == 0:
+                continue
+            try:
+                if exportDir in plan.missingDirs:
+                    os.makedirs(exportDir)
+            except (IOError, OSError), e:
+                errors.extend((srcFile, e) for srcFile in srcFiles)
+                continue
+            wx.CallAfter(self._statusBar.SetStatusText, "Exporting %d file(s) to %s" % (len(srcFiles), exportDir))
+            errors.extend(self._export_move(srcFiles, exportDir, images, plan.names, plan.sidecars))
+        self._hashIndex.save()
+        self._report_export_errors(errors, collisions, volumes)
+
+        for srcFile, exportDir in plan.conflicts:
+            if self._closing:
+                break
+            self._do_check(self._export_file_overwrite_check, os.path.basename(srcFile), exportDir, srcFile,
+                           images.get(srcFile), plan.sidecars)
 
     def OnExport(self, event):
-        fromDir = self._optionsDialog.options["WorkingDir"]
-        
-        # Walk and copy files to working dir
-        for dirpath, dirnames, filenames in os.walk(fromDir):
-            for f in filenames:
-                self._do_work(self._export_file_work, dirpath, f)
+        if not self._exiftool_check():
+            return
+        options = self._optionsDialog.options
+        if options["ExportArchive"] != ARCHIVE_NONE and not os.path.isdir(options["ExportArchiveDir"]):
+            wx.MessageBox("The archive directory '%s' does not exist" % options["ExportArchiveDir"],
+                          "Export", wx.OK | wx.ICON_ERROR, self)
+            return
+        for mirror in options["FilingMirrors"]:
+            # A mirror that isn't there (e.g. a NAS that isn't mounted) mustn't
+            # be created
+            if not os.path.isdir(mirror):
+                wx.MessageBox("The mirror directory '%s' does not exist" % mirror,
+                              "Export", wx.OK | wx.ICON_ERROR, self)
+                return
+        if uses_places(options["FilingStruct"]) and not os.path.isfile(options["PlaceIndex"]):
+            wx.MessageBox("The filing structure uses places but there is no place index; use Tools->Index gazetteer to create one",
+                          "Export", wx.OK | wx.ICON_ERROR, self)
+            return
+        fromDir = options["WorkingDir"]
+        self._stats.mark("export started", fromDir = fromDir)
+        self._do_work(self._export_work, fromDir)
 
 # End the "export files" operation
 
@@ -626,31 +872,212 @@ class MyFrame(wx.Frame):
 ####
 ################################################################################
 
-    def _geotag_work(self, img):
-        wx.CallAfter(self._statusBar.SetStatusText, "Geotagging " + img["FileName"])
-        geotag = img.geotag
+    def _geotag_all_work(self, images, gpsFiles):
+        """
+        Geotag the images in one batch: the positions of all of them are
+        found in a single sweep over the tracks, the image list is updated
+        once and the changes are written by a single exiftool session
+        """
+        wx.CallAfter(self._statusBar.SetStatusText, "Matching %d image(s) to the GPS tracks..." % len(images))
+        dated = [img for img in images if img.dateTime is not None]
+        with self._stats.timed(GEOTAG_MATCH, items = len(images)):
+            geotags = match_times(gpsFiles, [img.dateTime for img in dated],
+                                  offset = self._optionsDialog.options["GeotagClockOffset"])
+
+        matched = [(img, geotag) for img, geotag in zip(dated, geotags) if geotag is not None]
+        # Those already geotagged there have nothing to write
+        changes = [(img, geotag) for img, geotag in matched if not same_geotag(img.geotag, geotag)]
+        unchanged = len(matched) - len(changes)
+        unmatched = len(images) - len(matched)
+
+        # Record the geotags that are about to be overwritten so that the run
+        # can be undone
+        try:
+            self._geotagJournal.record([(img.get_filename(), img.geotag) for img, geotag in changes])
+        except (IOError, OSError), e:
+            wx.CallAfter(wx.MessageBox, "Unable to record the current geotags, so none have been written:\n\n%s" % e,
+                         "Geotag all images", wx.OK | wx.ICON_ERROR)
+            return
+        changed = []
+        for img, geotag in changes:
+            img.set_geotag(geotag)
+            changed.append(img)
+        wx.CallAfter(self._images.update_images, changed)
 
+        wx.CallAfter(self._statusBar.SetStatusText, "Writing the geotags of %d image(s)..." % len(changed))
+        with self._stats.timed(EXIF_WRITE, len(changed), sum(os.path.getsize(img.get_filename()) for img in changed)):
+            try:
+                errors = save_changes(changed, self._exiftoolChecked)
+            except (ExiftoolException, OSError), e:
+                errors = [(img, e) for img in changed if img.is_modified()]
+        # The images that couldn't be written go back to the geotag in their
+        # file, so that it is what a later run journals
+        for img, e in errors:
+            img.revert_geotag()
+        if len(errors) > 0:
+            wx.CallAfter(self._images.update_images, [img for img, e in errors])
+        self._stats.mark("geotag finished", geotagged = len(changed) - len(errors), unchanged = unchanged,
+                         unmatched = unmatched, failed = len(errors))
+
+        message = "%d image(s) geotagged\n%d skipped as they already had the same geotag\n%d didn't match the GPS tracks" % (
+                len(changed) - len(errors), unchanged, unmatched)
+        if len(errors) > 0:
+            message += "\n\nFailed to write %d geotag(s):\n\n" % len(errors) + \
+                       "\n".join("%s: %s" % (img.get_filename(), e) for img, e in errors[:20])
+        wx.CallAfter(wx.MessageBox, message, "Geotag all images",
+                     wx.OK | (wx.ICON_ERROR if len(errors) > 0 else wx.ICON_INFORMATION))
+
+    def _loaded_gps_files(self):
+        gpsFiles = []
         item, cookie = self._gpxTree.GetFirstChild(self._gpxRoot)
         while item.IsOk():
-            tracks, n = self._gpxTree.GetPyData(item)
-            geotag = tracks.gpsFile.match_time(img.dateTime)
-            if geotag is not None:
-                break
+            wrappedGpsFile, ns = self._gpxTree.GetPyData(item)
+            gpsFiles.append(wrappedGpsFile.gpsFile)
             item, cookie = self._gpxTree.GetNextChild(self._gpxRoot, cookie)
-
-        print img["FileName"], "taken at", geotag
-        if geotag is not None:
-            img.set_geotag(geotag)
-            wx.CallAfter(self._images.update_image, img)
-            img.save_changes()
+        return gpsFiles
 
     def OnGeotagAll(self, event):
         print "Geotag All"
-        for img in self._images.iter_images():
-            self._do_work(self._geotag_work, img)
+        if not self._exiftool_check():
+            return
+        self._stats.mark("geotag started")
+        self._do_work(self._geotag_all_work, list(self._images.iter_images()), self._loaded_gps_files())
+
+    def _use_offset(self, offset, message):
+        if wx.MessageBox(message, "Camera clock offset", wx.YES_NO | wx.ICON_QUESTION, self) == wx.YES:
+            self._optionsDialog.set_option("GeotagClockOffset", offset)
+
+    def _estimate_offset_work(self, images, gpsFiles):
+        # The estimator's table of the tracks is kept for as long as the same
+        # tracks are loaded, since building it takes longer than using it
+        if self._offsetEstimator is None or self._offsetEstimatorFiles != gpsFiles:
+            wx.CallAfter(self._statusBar.SetStatusText, "Indexing the GPS tracks...")
+            self._offsetEstimator = ClockOffsetEstimator(gpsFiles)
+            self._offsetEstimatorFiles = gpsFiles
+        wx.CallAfter(self._statusBar.SetStatusText, "Estimating the camera clock offset...")
+        dateTimes = [img.dateTime for img in images]
+        maxOffset = int_option(self._optionsDialog.options, "GeotagOffsetRange") * 3600
+        offset, covered, speed = self._offsetEstimator.estimate(dateTimes, maxOffset)
+        current = self._optionsDialog.options["GeotagClockOffset"]
+        print "Estimated camera clock offset", offset, "covering", covered, "photos at", speed, "m/s"
+        if covered == 0:
+            wx.CallAfter(wx.MessageBox, "None of the photos fall within the GPS tracks at any offset of up to %d hours" %
+                         (maxOffset // 3600), "Camera clock offset", wx.OK | wx.ICON_INFORMATION)
+            return
+        message = "The camera's clock appears to have been out by %s%s (%d seconds).\n\n" % (
+                "-" if offset < 0 else "+", datetime.timedelta(seconds = abs(offset)), offset)
+        message += "With that offset, %d of the %d photos fall within the GPS tracks.\n\n" % (covered, len(images))
+        message += "Use this offset (currently %d seconds) for geotagging?" % current
+        wx.CallAfter(self._use_offset, offset, message)
+
+    def OnEstimateOffset(self, event):
+        self._do_work(self._estimate_offset_work, list(self._images.iter_images()), self._loaded_gps_files())
+
+    def _undo_geotag_work(self, run, previous, images):
+        """
+        Put back the geotags that the run replaced, loading any of the files
+        that aren't in the image list
+        """
+        listed = set(os.path.abspath(img.get_filename()) for img in images)
+        unlisted = [f for f in previous if f not in listed]
+        missing = [f for f in unlisted if not os.path.isfile(f)]
+        loaded = []
+        if len(missing) < len(unlisted):
+            wx.CallAfter(self._statusBar.SetStatusText, "Loading %d image(s) to undo..." % (len(unlisted) - len(missing)))
+            with self._stats.timed(EXIF_READ, items = 0) as counts:
+                loaded = list(gen_images_from_files(
+                        [f for f in unlisted if os.path.isfile(f)],
+                        exiftool = self._exiftoolChecked,
+                        sidecarExtensions = self._optionsDialog.options["SidecarExtensions"]))
+                counts["items"] = len(loaded)
+
+        wx.CallAfter(self._statusBar.SetStatusText, "Restoring the geotags of %d image(s)..." % len(previous))
+        with self._stats.timed(EXIF_WRITE, items = 0) as counts:
+            restored, errors = restore_geotags(images + loaded, previous, self._exiftoolChecked)
+            counts["items"] = len(restored)
+        images = set(images)
+        wx.CallAfter(self._images.update_images, [img for img in restored if img in images])
+        if len(errors) == 0:
+            self._geotagJournal.discard([run])
+        self._stats.mark("geotag undone", run = run, restored = len(restored), missing = len(missing),
+                         failed = len(errors))
+
+        message = "%d image(s) restored to their previous geotag" % len(restored)
+        if len(missing) > 0:
+            message += "\n%d image(s) no longer exist where they were geotagged" % len(missing)
+        if len(errors) > 0:
+            message += "\n\nFailed to restore %d geotag(s), so the run can be undone again:\n\n" % len(errors) + \
+                       "\n".join("%s: %s" % (img.get_filename(), e) for img, e in errors[:20])
+        wx.CallAfter(wx.MessageBox, message, "Undo last geotag run",
+                     wx.OK | (wx.ICON_ERROR if len(errors) > 0 else wx.ICON_INFORMATION))
+
+    def OnUndoGeotag(self, event):
+        try:
+            runs = self._geotagJournal.runs()
+        except (IOError, OSError), e:
+            wx.MessageBox("Unable to read the geotag journal:\n\n%s" % e, "Undo last geotag run", wx.OK | wx.ICON_ERROR, self)
+            return
+        if len(runs) == 0:
+            wx.MessageBox("There is no geotag run to undo", "Undo last geotag run", wx.OK | wx.ICON_INFORMATION, self)
+            return
+        run, entries = runs[-1]
+        if wx.MessageBox("Restore the previous geotags of the %d image(s) geotagged at %s?" % (len(entries), run),
+                         "Undo last geotag run", wx.YES_NO | wx.ICON_QUESTION, self) != wx.YES:
+            return
+        if not self._exiftool_check():
+            return
+        previous = previous_geotags([runs[-1]])
+        images = [img for img in self._images.iter_images() if os.path.abspath(img.get_filename()) in previous]
+        self._do_work(self._undo_geotag_work, run, previous, images)
 
 # End the "geotag all files" operation
 
+    def _place_geocoder(self):
+        """
+        Returns the reverse geocoder for the place index in the options; it is
+        only opened once, since it reads more of the index as it is used
+        """
+        indexFile = self._optionsDialog.options["PlaceIndex"]
+        if self._geocoder is None or self._geocoderFile != indexFile:
+            if self._geocoder is not None:
+                self._geocoder.close()
+                self._geocoder = None
+            self._geocoder = ReverseGeocoder(indexFile)
+            self._geocoderFile = indexFile
+        return self._geocoder
+
+    def _index_gazetteer_work(self, gazetteerFile, indexFile):
+        wx.CallAfter(self._statusBar.SetStatusText, "Indexing the places in %s..." % gazetteerFile)
+        if self._geocoder is not None and self._geocoderFile == indexFile:
+            # The index is about to be replaced
+            self._geocoder.close()
+            self._geocoder = None
+        try:
+            count = build_index(gazetteerFile, indexFile)
+        except (IOError, OSError), e:
+            wx.CallAfter(wx.MessageBox, "Unable to index %s:\n\n%s" % (gazetteerFile, e),
+                         "Index gazetteer", wx.OK | wx.ICON_ERROR)
+            return
+        wx.CallAfter(self._optionsDialog.set_option, "PlaceIndex", indexFile)
+        wx.CallAfter(wx.MessageBox, "%d place(s) indexed in %s" % (count, indexFile),
+                     "Index gazetteer", wx.OK | wx.ICON_INFORMATION)
+
+    def OnIndexGazetteer(self, event):
+        dlg = wx.FileDialog(self, "Choose a gazetteer (e.g. GeoNames cities1000.txt)", style = wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
+        if dlg.ShowModal() == wx.ID_OK:
+            gazetteerFile = dlg.GetPath()
+            indexFile = self._optionsDialog.options["PlaceIndex"] or os.path.splitext(gazetteerFile)[0] + ".places"
+            self._do_work(self._index_gazetteer_work, gazetteerFile, indexFile)
+        dlg.Destroy()
+
+    def OnShowStats(self, event):
+        self._mgr.GetPane(self._statsPanel).Show()
+        self._mgr.Update()
+
+    def OnResetStats(self, event):
+        self._stats.reset()
+        self._statsPanel.refresh()
+
     def OnOptions(self, event):
         self._optionsDialog.ShowModal()
 
@@ -701,10 +1128,19 @@ class MyFrame(wx.Frame):
         self._workerQueue.put((None, None, None))
         if self._workerThread.is_alive():
             self._workerThread.join()
-        # Kill the import thread
-        self._importQueue.put(None)
-        if self._importThread.is_alive():
-            self._importThread.join()
+        # Kill the import threads. The queue may be full, in which case they
+        # stop (having seen _closing) once they finish their current batch;
+        # otherwise the end item wakes any waiting for files.
+        for t in self._importThreads:
+            while t.is_alive():
+                try:
+                    self._importQueue.put_nowait(None)
+                except Queue.Full:
+                    pass
+                t.join(0.1)
+        self._hashIndex.save()
+        self._stats.close()
+        self._catalog.close()
         # deinitialize the frame manager
         self._mgr.UnInit()
         # delete the frame
@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+"""
+Command line interface to PGTips, for running imports, geotagging and exports
+without a display (e.g. on an ingest server or from scripts).
+
+The options are read from pgtips.opt, as used by the GUI, and the result of
+each command is written to stdout as a single JSON object; anything else that
+is printed along the way goes to stderr. The exit status is 0 if every file
+was handled, 1 if any failed and 2 if the command couldn't be run at all.
+"""
+import os, sys, json, argparse, datetime, traceback
+
+# Include the sub-directory containing the sub-modules when looking for imports
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "sub-modules"))
+
+from gpsfiles import gen_tracks_from_files, match_times, ClockOffsetEstimator
+from imagefiles import gen_images_from_files, save_changes, same_geotag
+from pipeline import Pipeline
+from importer import copy_file, rotate_file, plan_import, RotateError
+from exporter import find_export_files, read_images, plan_export, resolve_collisions, catalog_entries, ExportMover
+from exporter import ExportArchive, ArchiveVolumeError, archive_files, archive_base
+from exporter import COLLISIONS, COLLISION_ASK, COLLISION_SKIP, ARCHIVES, ARCHIVE_NONE
+from exporter import find_places, uses_places
+from geocoder import ReverseGeocoder, GeocoderError, build_index
+from catalog import Catalog
+from geotagjournal import GeotagJournal, previous_geotags, restore_geotags
+from hashindex import HashIndex, CHECK_OFF
+from importjournal import ImportJournal, COPIED, ROTATED
+from optionsfile import load_options, int_option
+
+class CommandError(Exception): pass
+
+def _tool(path, name):
+    if path != "":
+        return os.path.join(path, name)
+    return name
+
+def _extensions(options, name):
+    extensions = options[name]
+    return extensions if len(extensions) > 0 else None
+
+def _load_tracks(paths, options):
+    return [t for t in gen_tracks_from_files(paths, include = _extensions(options, "GpsExtensions"))
+            if len(t) > 0]
+
+def cmd_import(args, options):
+    fromDir = os.path.abspath(args.source)
+    workingDir = os.path.abspath(args.working_dir or options["WorkingDir"])
+    if not os.path.isdir(fromDir):
+        raise CommandError("%s is not a directory" % fromDir)
+    if not os.path.isdir(workingDir):
+        raise CommandError("The working directory %s does not exist" % workingDir)
+    useJpegtran = options["JpegtranEnabled"] and not args.no_rotate
+    jpegtran = _tool(options["JpegtranPath"], "jpegtran")
+
+    hashIndex = HashIndex(args.index)
+    journal = ImportJournal(args.journal)
+    resume = False
+    unfinished = journal.unfinished()
+    if unfinished is not None:
+        if unfinished != (fromDir, workingDir):
+            raise CommandError("An unfinished import from %s into %s is recorded in %s" % (unfinished + (args.journal,)))
+        resume = True
+
+    if args.empty:
+        for f in os.listdir(workingDir):
+            os.remove(os.path.join(workingDir, f))
+
+    duplicateCheck = options["ImportDuplicateCheck"]
+    if duplicateCheck != CHECK_OFF:
+        hashIndex.refresh([d for d in [workingDir, options["FilingDir"]] if d != "" and os.path.isdir(d)])
+
+    records = journal.start(fromDir, workingDir, resume)
+    plan = plan_import(fromDir, workingDir,
+                       options["ImageExtensions"], options["OtherExtensions"], useJpegtran,
+                       hashIndex = hashIndex, duplicateCheck = duplicateCheck,
+                       journal = journal, records = records)
+    conflicts = plan.conflicts
+    plan.resolve_conflicts(range(len(conflicts)) if args.overwrite else [])
+
+    def copy(job):
+        if not job.copied:
+            job = copy_file(job)
+            journal.record(job, COPIED)
+        hashIndex.add_imported(job.destFile, job.size, job.partial, job.hash)
+        return job
+
+    def rotate(job):
+        try:
+            job = rotate_file(job, jpegtran)
+        except RotateError, e:
+            job.warnings.append(str(e))
+            return job
+        journal.record(job, ROTATED)
+        return job
+
+    imported = []
+    pipeline = Pipeline([
+            ("copy", copy, int_option(options, "ImportCopyWorkers")),
+            ("rotate", rotate, int_option(options, "ImportRotateWorkers")),
+            ],
+            sink = imported.append,
+            queueSize = int_option(options, "ImportQueueSize"))
+    for job in plan.jobs():
+        pipeline.put(job)
+    pipeline.close()
+    journal.finish()
+    hashIndex.save()
+
+    return {
+            "imported": sorted(job.destFile for job in imported),
+            "resumed": len(plan.resumed),
+            "identical": [{"file": job.srcFile, "heldAs": path} for job, path in plan.identical],
+            "conflicts": [{"file": job.srcFile, "reason": reason, "overwritten": args.overwrite}
+                          for job, reason in conflicts],
+            "warnings": [{"file": job.srcFile, "warning": w} for job in imported for w in job.warnings],
+            "errors": [{"file": job.srcFile, "stage": stage, "error": str(e)} for stage, job, e in pipeline.errors],
+            }
+
+def cmd_load_tracks(args, options):
+    files = []
+    for t in gen_tracks_from_files(args.paths, include = _extensions(options, "GpsExtensions"), returnEmpty = True):
+        files.append({
+                "file": t.get_filename(),
+                "tracks": [{"points": len(track), "start": track[0][0].isoformat(), "end": track[-1][0].isoformat()}
+                           for track in t],
+                })
+    return {"files": files, "errors": [{"file": f["file"], "error": "No tracks found"}
+                                       for f in files if len(f["tracks"]) == 0]}
+
+def cmd_geotag(args, options):
+    tracks = _load_tracks(args.tracks, options)
+    if len(tracks) == 0:
+        raise CommandError("No GPS tracks were found in %s" % ", ".join(args.tracks))
+    paths = args.paths or [options["WorkingDir"]]
+    exiftool = _tool(options["ExiftoolPath"], "exiftool")
+    images = list(gen_images_from_files(
+            paths,
+            include = _extensions(options, "ImageExtensions"),
+            exiftool = exiftool,
+            sidecarExtensions = options["SidecarExtensions"]))
+
+    # All of the images are matched in one sweep over the tracks
+    dated = [img for img in images if img.dateTime is not None]
+    offset = args.offset if args.offset is not None else options["GeotagClockOffset"]
+    geotags = dict(zip(dated, match_times(tracks, [img.dateTime for img in dated], offset = offset)))
+    unmatched = []
+    unchanged = []
+    changes = []
+    for img in images:
+        geotag = geotags.get(img)
+        if geotag is None:
+            unmatched.append(img.get_filename())
+        elif same_geotag(img.geotag, geotag):
+            unchanged.append(img.get_filename())
+        else:
+            changes.append((img, geotag))
+
+    if not args.dry_run:
+        # Record the geotags that are about to be overwritten so that the run
+        # can be undone
+        try:
+            GeotagJournal(args.geotag_journal).record([(img.get_filename(), img.geotag) for img, geotag in changes])
+        except (IOError, OSError), e:
+            raise CommandError("Unable to record the current geotags in %s: %s" % (args.geotag_journal, e))
+    changed = []
+    for img, geotag in changes:
+        img.set_geotag(geotag)
+        changed.append(img)
+
+    errors = []
+    if not args.dry_run:
+        for img, e in save_changes(changed, exiftool):
+            errors.append({"file": img.get_filename(), "error": str(e)})
+    failed = set(e["file"] for e in errors)
+    geotagged = []
+    for img in changed:
+        if img.get_filename() not in failed:
+            lat, lon, alt = img.geotag
+            geotagged.append({"file": img.get_filename(), "lat": lat, "lon": lon, "alt": alt})
+    return {"geotagged": geotagged, "unchanged": unchanged, "unmatched": unmatched, "errors": errors}
+
+def cmd_undo_geotag(args, options):
+    journal = GeotagJournal(args.geotag_journal)
+    runs = journal.runs()
+    if len(runs) == 0:
+        raise CommandError("There is no geotag run to undo in %s" % args.geotag_journal)
+    if not args.all:
+        runs = runs[-1:]
+    previous = previous_geotags(runs)
+    missing = sorted(f for f in previous if not os.path.isfile(f))
+    images = list(gen_images_from_files(
+            sorted(f for f in previous if os.path.isfile(f)),
+            exiftool = _tool(options["ExiftoolPath"], "exiftool"),
+            sidecarExtensions = options["SidecarExtensions"]))
+    restored, failed = restore_geotags(images, previous, _tool(options["ExiftoolPath"], "exiftool"))
+    errors = [{"file": img.get_filename(), "error": str(e)} for img, e in failed]
+    if len(errors) == 0:
+        # Those that failed can be tried again
+        journal.discard([run for run, entries in runs])
+    return {"runs": [run for run, entries in runs],
+            "restored": sorted(img.get_filename() for img in restored),
+            "missing": missing,
+            "errors": errors}
+
+def cmd_estimate_offset(args, options):
+    tracks = _load_tracks(args.tracks, options)
+    if len(tracks) == 0:
+        raise CommandError("No GPS tracks were found in %s" % ", ".join(args.tracks))
+    paths = args.paths or [options["WorkingDir"]]
+    images = gen_images_from_files(
+            paths,
+            include = _extensions(options, "ImageExtensions"),
+            exiftool = _tool(options["ExiftoolPath"], "exiftool"),
+            sidecarExtensions = options["SidecarExtensions"])
+    dateTimes = [img.dateTime for img in images]
+    hours = args.max_hours if args.max_hours is not None else int_option(options, "GeotagOffsetRange")
+    offset, covered, speed = ClockOffsetEstimator(tracks).estimate(dateTimes, hours * 3600)
+    return {"offset": offset, "covered": covered, "photos": len(dateTimes), "meanSpeed": speed}
+
+def _geocoder(options):
+    try:
+        return ReverseGeocoder(options["PlaceIndex"])
+    except (GeocoderError, IOError, OSError), e:
+        raise CommandError("Unable to open the place index '%s': %s" % (options["PlaceIndex"], e))
+
+def cmd_index_gazetteer(args, options):
+    indexFile = args.output or options["PlaceIndex"] or os.path.splitext(args.gazetteer)[0] + ".places"
+    try:
+        count = build_index(args.gazetteer, indexFile, args.min_population)
+    except (IOError, OSError), e:
+        raise CommandError("Unable to index %s: %s" % (args.gazetteer, e))
+    return {"index": indexFile, "places": count}
+
+def cmd_places(args, options):
+    paths = args.paths or [options["WorkingDir"]]
+    images = list(gen_images_from_files(
+            paths,
+            include = _extensions(options, "ImageExtensions"),
+            exiftool = _tool(options["ExiftoolPath"], "exiftool"),
+            sidecarExtensions = options["SidecarExtensions"]))
+    maxDistance = args.max_distance if args.max_distance is not None else int_option(options, "PlaceMaxDistance")
+    # All of the images are looked up in one batch
+    nearest = _geocoder(options).nearest([img.geotag for img in images], maxDistance)
+    places = []
+    unplaced = []
+    for img, found in zip(images, nearest):
+        if found is None:
+            unplaced.append(img.get_filename())
+        else:
+            place, distance = found
+            places.append({"file": img.get_filename(), "place": place.name, "region": place.region,
+                           "country": place.country, "distance": distance})
+    return {"places": places, "unplaced": unplaced}
+
+def cmd_export(args, options):
+    workingDir = os.path.abspath(args.working_dir or options["WorkingDir"])
+    filingDir = options["FilingDir"]
+    if filingDir == "" or not os.path.isdir(filingDir):
+        raise CommandError("The filing directory '%s' does not exist" % filingDir)
+    mirrors = args.mirror if args.mirror is not None else options["FilingMirrors"]
+    for mirror in mirrors:
+        if not os.path.isdir(mirror):
+            raise CommandError("The mirror directory '%s' does not exist" % mirror)
+    hashIndex = HashIndex(args.index)
+
+    # One exiftool run finds the date of every file before anything is moved
+    files = find_export_files(workingDir, options["ImageExtensions"], options["OtherExtensions"])
+    images = read_images(files, _tool(options["ExiftoolPath"], "exiftool"), options["SidecarExtensions"])
+    dates = dict((srcFile, img.dateTime) for srcFile, img in images.iteritems())
+    places = {}
+    if uses_places(options["FilingStruct"]):
+        places = find_places(images, _geocoder(options), int_option(options, "PlaceMaxDistance"))
+
+    plan = plan_export(files, dates, filingDir, options["FilingStruct"], places)
+
+    archive = None
+    archiveKind = args.archive or options["ExportArchive"]
+    archiveOnly = False
+    if archiveKind != ARCHIVE_NONE and not args.dry_run:
+        archiveDir = args.archive_dir or options["ExportArchiveDir"]
+        if not os.path.isdir(archiveDir):
+            raise CommandError("The archive directory '%s' does not exist" % archiveDir)
+        volumeSize = args.volume_size if args.volume_size is not None else options["ExportArchiveVolumeSize"]
+        archive = ExportArchive(archive_base(archiveDir), archiveKind, volumeSize * 1024 * 1024)
+        archiveOnly = args.archive_only or options["ExportArchiveOnly"]
+
+    exported = []
+    archived = []
+    skipped = [{"file": srcFile, "reason": "no date"} for srcFile in plan.undated]
+    errors = []
+    collisions = []
+    if archiveOnly:
+        # Nothing is filed, so nothing clashes
+        for srcFile, exportDir in plan.conflicts:
+            plan.moves.setdefault(exportDir, []).append(srcFile)
+        plan.conflicts = []
+    elif args.overwrite:
+        for srcFile, exportDir in plan.conflicts:
+            plan.moves.setdefault(exportDir, []).append(srcFile)
+            collisions.append({"file": srcFile, "to": plan.dest_file(srcFile, exportDir), "outcome": "overwritten"})
+    else:
+        policy = args.collisions or options["ExportCollisions"]
+        if policy == COLLISION_ASK:
+            # There's no one to ask
+            policy = COLLISION_SKIP
+        collisions = [{"file": srcFile, "to": destFile, "outcome": outcome}
+                      for srcFile, destFile, outcome in resolve_collisions(plan, policy)]
+
+    mover = ExportMover(int_option(options, "ExportCopyWorkers"), hashIndex, filingDir, mirrors)
+    catalog = Catalog(args.catalog)
+    toFile = dict(plan.moves)
+    if archive is not None:
+        # Everything is archived before anything is filed, so that no file
+        # leaves the working directory before the volume holding it has been
+        # closed and synced
+        failed = []
+        for exportDir in plan.dirs():
+            added, dirFailed = archive_files(archive, plan.moves[exportDir], exportDir, filingDir,
+                                             plan.names, plan.sidecars)
+            archived.extend({"file": srcFile, "name": name} for srcFile, name in added)
+            failed.extend(dirFailed)
+            toFile[exportDir] = [srcFile for srcFile, name in added]
+        volumes = []
+        try:
+            volumes = archive.close()
+        except ArchiveVolumeError, e:
+            failed.extend((srcFile, e) for srcFile in e.lost)
+            volumes = archive.volumes
+        errors.extend({"file": srcFile, "error": str(e)} for srcFile, e in failed)
+        # Only the files that are safely in the archive are filed; a discarded
+        # volume may have taken some archived for earlier directories with it
+        lost = set(srcFile for srcFile, e in failed)
+        archived = [a for a in archived if a["file"] not in lost]
+        toFile = dict((exportDir, [f for f in srcFiles if f not in lost])
+                      for exportDir, srcFiles in toFile.iteritems())
+
+    for exportDir in plan.dirs():
+        if archiveOnly:
+            break
+        srcFiles = toFile[exportDir]
+        if args.dry_run:
+            moved = [(srcFile, plan.dest_file(srcFile, exportDir)) for srcFile in srcFiles]
+        else:
+            try:
+                if exportDir in plan.missingDirs:
+                    os.makedirs(exportDir)
+            except (IOError, OSError), e:
+                errors.extend({"file": srcFile, "error": str(e)} for srcFile in srcFiles)
+                continue
+            moved, failed = mover.move_files(srcFiles, exportDir, plan.names, plan.sidecars)
+            errors.extend({"file": srcFile, "error": str(e)} for srcFile, e in failed)
+            catalog.add(catalog_entries(moved, images, hashIndex))
+        exported.extend({"file": srcFile, "to": destFile} for srcFile, destFile in moved)
+    hashIndex.save()
+    catalog.close()
+    result = {"exported": exported, "skipped": skipped, "collisions": collisions, "errors": errors}
+    if archive is not None:
+        result["volumes"] = volumes
+        result["archived"] = archived
+    return result
+
+def _parse_date(s):
+    try:
+        return datetime.datetime.strptime(s, "%Y-%m-%d")
+    except ValueError:
+        raise CommandError("%s is not a date (YYYY-MM-DD)" % s)
+
+def cmd_catalog(args, options):
+    if not os.path.isfile(args.catalog):
+        raise CommandError("There is no catalog %s" % args.catalog)
+    catalog = Catalog(args.catalog)
+    if args.taken is not None:
+        start = _parse_date(args.taken[0])
+        end = _parse_date(args.taken[1]) if len(args.taken) > 1 else start
+        # The times in the catalog are UTC
+        entries = catalog.find_taken(start, end + datetime.timedelta(days = 1))
+    elif args.area is not None:
+        entries = catalog.find_in_area(*args.area)
+    elif args.copies is not None:
+        entries = catalog.find_copies(args.copies)
+    else:
+        entries = [e for e in [catalog.find_path(args.path)] if e is not None]
+    catalog.close()
+    return {"files": [{
+            "path": e.path,
+            "taken": None if e.taken is None else datetime.datetime.utcfromtimestamp(e.taken).isoformat() + "Z",
+            "lat": e.lat, "lon": e.lon, "alt": e.alt,
+            "model": e.model,
+            "hash": e.hash,
+            } for e in entries]}
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = "PGTips: Photograph GeoTagger (command line)")
+    parser.add_argument("--options", default = "pgtips.opt", help = "the options file (default: %(default)s)")
+    parser.add_argument("--index", default = "pgtips.idx", help = "the hash index file (default: %(default)s)")
+    parser.add_argument("--catalog", default = "pgtips.db", help = "the catalog of the filing tree (default: %(default)s)")
+    parser.add_argument("--geotag-journal", default = "pgtips.undo",
+                        help = "the journal of the geotags replaced by each geotag run (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest = "command")
+
+    p = subparsers.add_parser("import", help = "copy (and losslessly rotate) files into the working directory")
+    p.add_argument("source", help = "the directory to import from")
+    p.add_argument("--working-dir", help = "the directory to import into (default: from the options)")
+    p.add_argument("--journal", default = "pgtips.jnl",
+                   help = "the import journal; use a different one for each import run at the same time (default: %(default)s)")
+    p.add_argument("--overwrite", action = "store_true", help = "overwrite files that clash with existing ones")
+    p.add_argument("--no-rotate", action = "store_true", help = "don't losslessly rotate JPEGs")
+    p.add_argument("--empty", action = "store_true", help = "delete the files in the working directory first")
+    p.set_defaults(fn = cmd_import)
+
+    p = subparsers.add_parser("load-tracks", help = "list the GPS tracks in files")
+    p.add_argument("paths", nargs = "+", help = "GPS files or directories containing them")
+    p.set_defaults(fn = cmd_load_tracks)
+
+    p = subparsers.add_parser("geotag", help = "geotag images from GPS tracks")
+    p.add_argument("--tracks", nargs = "+", required = True, help = "GPS files or directories containing them")
+    p.add_argument("--offset", type = int, metavar = "SECONDS",
+                   help = "the number of seconds that the camera's clock was slow, negative if it was fast (default: from the options)")
+    p.add_argument("--dry-run", action = "store_true", help = "report the geotags without writing them")
+    p.add_argument("paths", nargs = "*", help = "images or directories to geotag (default: the working directory)")
+    p.set_defaults(fn = cmd_geotag)
+
+    p = subparsers.add_parser("undo-geotag", help = "put back the geotags replaced by the last geotag run")
+    p.add_argument("--all", action = "store_true", help = "undo every geotag run in the journal")
+    p.set_defaults(fn = cmd_undo_geotag)
+
+    p = subparsers.add_parser("estimate-offset", help = "estimate how far out the camera's clock was from the GPS tracks")
+    p.add_argument("--tracks", nargs = "+", required = True, help = "GPS files or directories containing them")
+    p.add_argument("--max-hours", type = int, help = "how far either way the clock can be out (default: from the options)")
+    p.add_argument("paths", nargs = "*", help = "images or directories of images (default: the working directory)")
+    p.set_defaults(fn = cmd_estimate_offset)
+
+    p = subparsers.add_parser("index-gazetteer", help = "index the places in a gazetteer (e.g. GeoNames cities1000.txt) for finding where photos were taken")
+    p.add_argument("gazetteer", help = "the gazetteer, tab separated as the GeoNames dumps are")
+    p.add_argument("--output", help = "the index to write (default: from the options, or next to the gazetteer)")
+    p.add_argument("--min-population", type = int, default = 0, help = "leave out smaller places (default: %(default)s)")
+    p.set_defaults(fn = cmd_index_gazetteer)
+
+    p = subparsers.add_parser("places", help = "find the place nearest to where each geotagged image was taken")
+    p.add_argument("--max-distance", type = float, metavar = "KM",
+                   help = "leave images further than this from any place unplaced (default: from the options)")
+    p.add_argument("paths", nargs = "*", help = "images or directories of images (default: the working directory)")
+    p.set_defaults(fn = cmd_places)
+
+    p = subparsers.add_parser("export", help = "file the working directory into the filing tree")
+    p.add_argument("--working-dir", help = "the directory to export from (default: from the options)")
+    p.add_argument("--overwrite", action = "store_true", help = "overwrite files that already exist in the filing tree")
+    p.add_argument("--collisions", choices = [c for c in COLLISIONS if c != COLLISION_ASK],
+                   help = "what to do with files that clash with those already filed, other than identical ones,"
+                          " which are left where they are (default: from the options, skipping them if set to ask)")
+    p.add_argument("--mirror", action = "append", metavar = "DIR",
+                   help = "also file the files under this directory, which can be given more than once (default: from the options)")
+    p.add_argument("--archive", choices = ARCHIVES,
+                   help = "also write the files to an archive laid out as the filing tree (default: from the options)")
+    p.add_argument("--archive-dir", help = "the directory to create the archive in (default: from the options)")
+    p.add_argument("--volume-size", type = int, metavar = "MB",
+                   help = "split the archive into volumes of this size, 0 for one archive (default: from the options)")
+    p.add_argument("--archive-only", action = "store_true", help = "write the archive without filing the files")
+    p.add_argument("--dry-run", action = "store_true", help = "report where files would go without moving them")
+    p.set_defaults(fn = cmd_export)
+
+    p = subparsers.add_parser("catalog", help = "query the catalog of files that have been exported")
+    query = p.add_mutually_exclusive_group(required = True)
+    query.add_argument("--taken", nargs = "+", metavar = "DATE", help = "files taken on a date, or between two dates (YYYY-MM-DD)")
+    query.add_argument("--area", nargs = 4, type = float, metavar = ("SOUTH", "WEST", "NORTH", "EAST"),
+                       help = "files geotagged within the box")
+    query.add_argument("--copies", metavar = "FILE", help = "filed copies of the file")
+    query.add_argument("--path", help = "the catalog entry of a filed file")
+    p.set_defaults(fn = cmd_catalog)
+
+    args = parser.parse_args(argv)
+
+    # Keep stdout for the results
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        result = args.fn(args, load_options(args.options))
+    except CommandError, e:
+        result = {"error": str(e)}
+        status = 2
+    except Exception, e:
+        # e.g. exiftool or the filesystem failing part way through; the
+        # traceback goes to stderr but the caller still gets a result
+        traceback.print_exc()
+        result = {"error": "%s: %s" % (e.__class__.__name__, e)}
+        status = 2
+    else:
+        status = 1 if len(result.get("errors", [])) > 0 else 0
+    finally:
+        sys.stdout = out
+    result["command"] = args.command
+    json.dump(result, out, indent = 2, sort_keys = True)
+    out.write("\n")
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,136 @@
+"""
+A catalog of the files in the filing tree, kept in an SQLite database and
+updated as files are exported, so that questions such as what was taken on a
+particular day, what was taken near a place or whether a photo has already
+been filed can be answered without walking the tree.
+
+Capture times are held as UTC seconds since the epoch and geotags are also
+held against the cell of a grid of _GRID degree squares so that both can be
+looked up by index.
+"""
+import os, math, calendar, sqlite3, threading
+import filecopy, hashindex
+
+_DEBUG = True
+
+# The size (in degrees) of the cells of the grid of geotags
+_GRID = 0.1
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS files (
+           path TEXT PRIMARY KEY,
+           size INTEGER,
+           partial TEXT,
+           hash TEXT,
+           taken REAL,
+           lat REAL,
+           lon REAL,
+           alt REAL,
+           gridLat INTEGER,
+           gridLon INTEGER,
+           model TEXT)""",
+    "CREATE INDEX IF NOT EXISTS files_taken ON files (taken)",
+    "CREATE INDEX IF NOT EXISTS files_grid ON files (gridLat, gridLon)",
+    "CREATE INDEX IF NOT EXISTS files_partial ON files (size, partial)",
+    ]
+
+_COLUMNS = ["path", "size", "partial", "hash", "taken", "lat", "lon", "alt", "model"]
+
+def _timestamp(dateTime):
+    if dateTime is None:
+        return None
+    if dateTime.tzinfo is None:
+        return calendar.timegm(dateTime.timetuple())
+    return calendar.timegm(dateTime.utctimetuple())
+
+def _grid(value):
+    return int(math.floor(value / _GRID))
+
+class CatalogEntry(object):
+    def __init__(self, row):
+        for name, value in zip(_COLUMNS, row):
+            setattr(self, name, value)
+
+    @property
+    def geotag(self):
+        if self.lat is None:
+            return None
+        return self.lat, self.lon, self.alt
+
+class Catalog(object):
+    def __init__(self, dbFile):
+        self._lock = threading.Lock()
+        # The catalog is used by whichever thread is doing the work
+        self._db = sqlite3.connect(dbFile, check_same_thread = False)
+        with self._db:
+            for statement in _SCHEMA:
+                self._db.execute(statement)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def add(self, entries):
+        """
+        Add (or replace) the files, given as a list of (path, size, partial
+        hash, full hash, capture time, geotag, camera model) tuples, in a
+        single transaction
+        """
+        rows = []
+        for path, size, partial, hash, dateTime, geotag, model in entries:
+            lat = lon = alt = gridLat = gridLon = None
+            if geotag is not None:
+                lat, lon, alt = geotag
+                gridLat = _grid(lat)
+                gridLon = _grid(lon)
+            rows.append((os.path.abspath(path), size, partial, hash, _timestamp(dateTime),
+                         lat, lon, alt, gridLat, gridLon, model))
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                        "INSERT OR REPLACE INTO files "
+                        "(path, size, partial, hash, taken, lat, lon, alt, gridLat, gridLon, model) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def remove(self, paths):
+        with self._lock:
+            with self._db:
+                self._db.executemany("DELETE FROM files WHERE path = ?",
+                                     [(os.path.abspath(p),) for p in paths])
+
+    def _query(self, where, args):
+        with self._lock:
+            rows = self._db.execute("SELECT %s FROM files WHERE %s ORDER BY taken" % (", ".join(_COLUMNS), where),
+                                    args).fetchall()
+        return [CatalogEntry(row) for row in rows]
+
+    def find_path(self, path):
+        entries = self._query("path = ?", (os.path.abspath(path),))
+        return entries[0] if len(entries) > 0 else None
+
+    def find_taken(self, start, end):
+        """
+        Returns the files taken from start up to (but not including) end
+        """
+        return self._query("taken >= ? AND taken < ?", (_timestamp(start), _timestamp(end)))
+
+    def find_in_area(self, south, west, north, east):
+        """
+        Returns the files with a geotag within the box
+        """
+        return self._query("gridLat BETWEEN ? AND ? AND gridLon BETWEEN ? AND ? "
+                           "AND lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?",
+                           (_grid(south), _grid(north), _grid(west), _grid(east),
+                            south, north, west, east))
+
+    def find_copies(self, filename):
+        """
+        Returns the files in the catalog with the same size and partial hash
+        (and full hash, if that is known) as the given file
+        """
+        size = os.path.getsize(filename)
+        entries = self._query("size = ? AND partial = ?", (size, hashindex.partial_hash(filename)))
+        if any(e.hash is not None for e in entries):
+            full = filecopy.hash_file(filename)
+            entries = [e for e in entries if e.hash is None or e.hash == full]
+        return entries
@@ -0,0 +1,680 @@
+"""
+The work involved in exporting (filing) files from the working directory into
+the filing tree, kept separate from the GUI.
+"""
+import os, sys, shutil, tarfile, zipfile, datetime
+import filecopy
+from hashindex import partial_hash
+from pipeline import Pipeline
+from xmpsidecar import sidecar_filename, SIDECAR_EXTENSION
+from imagefiles import gen_images_from_files
+
+_DEBUG = True
+
+# Copies are written under a temporary name until they are safely on disk
+_TMP_SUFFIX = ".pgtips~"
+
+# A sidecar shared by a JPEG and another file (e.g. a RAW+JPEG pair) belongs
+# to the other file, as that is the one whose geotag is written to it
+_JPEG_EXTENSIONS = [".jpg", ".jpeg"]
+
+def sidecar_owners(filenames):
+    """
+    Given the names of the files in a directory, returns a dictionary of the
+    name of the XMP sidecar belonging to each file that has one
+    """
+    byBase = {}
+    for f in filenames:
+        byBase.setdefault(os.path.splitext(f)[0], []).append(f)
+    owners = {}
+    for base, names in byBase.iteritems():
+        sidecars = [f for f in names if os.path.splitext(f)[1].lower() == SIDECAR_EXTENSION]
+        others = sorted(f for f in names if f not in sidecars)
+        if len(sidecars) == 0 or len(others) == 0:
+            continue
+        owner = ([f for f in others if os.path.splitext(f)[1].lower() not in _JPEG_EXTENSIONS] or others)[0]
+        # As with sidecar_filename(), the lower-case extension is preferred
+        owners[owner] = sorted(sidecars, key = lambda f: not f.endswith(SIDECAR_EXTENSION))[0]
+    return owners
+
+# Fields of the filing structure that are filled in from the place nearest to
+# where a photo was taken, as found by a ReverseGeocoder, so that photos can
+# be filed by place as well as by time
+PLACE_FIELDS = {
+        "{place}": lambda place: place.name,
+        "{region}": lambda place: place.region,
+        "{country}": lambda place: place.country,
+        }
+# What the fields are filled in with for a photo that isn't near anywhere known
+UNKNOWN_PLACE = "Unknown"
+
+def uses_places(filingStruct):
+    return any(field in filingStruct for field in PLACE_FIELDS)
+
+def _place_field(value):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    value = value.strip().replace(os.sep, "-").replace("/", "-")
+    if value in ("", ".", ".."):
+        value = UNKNOWN_PLACE
+    # Keep strftime from treating the name as a format
+    return value.replace("%", "%%")
+
+def export_dir(dateTime, filingDir, filingStruct, place = None):
+    """
+    Returns the directory in the filing tree for a file taken at the time and
+    (if the filing structure uses them) nearest to the place
+    """
+    for field, fn in PLACE_FIELDS.iteritems():
+        if field in filingStruct:
+            filingStruct = filingStruct.replace(field, _place_field(fn(place) if place is not None else UNKNOWN_PLACE))
+    return os.path.join(filingDir, dateTime.strftime(filingStruct))
+
+# The ways in which a file whose name is already taken in the filing tree can
+# be handled. All but COLLISION_ASK first skip files that are identical to the
+# one already filed.
+COLLISION_ASK = "Ask"
+COLLISION_SKIP = "Skip"
+COLLISION_RENAME = "Rename"
+COLLISION_NEWEST = "Keep newest"
+COLLISIONS = [COLLISION_ASK, COLLISION_SKIP, COLLISION_RENAME, COLLISION_NEWEST]
+
+# The outcomes of a collision that are reported
+IDENTICAL = "identical to the filed file"
+SKIPPED = "not exported"
+RENAMED = "renamed"
+REPLACED = "replaced the older filed file"
+OLDER = "older than the filed file"
+
+def _file_pairs(srcFile, destFile, sidecars = None):
+    """
+    Returns the (src, dest) pairs of the file and its sidecar, if any, which
+    takes the file's new name. The sidecars are those of the export plan; if
+    they aren't given, any sidecar with the file's base name is taken.
+    """
+    pairs = [(srcFile, destFile)]
+    if sidecars is not None:
+        sidecar = sidecars.get(srcFile)
+    else:
+        sidecar = sidecar_filename(srcFile)
+        if not os.path.isfile(sidecar):
+            sidecar = None
+    if sidecar is not None:
+        pairs.append((sidecar, os.path.splitext(destFile)[0] + os.path.splitext(sidecar)[1]))
+    return pairs
+
+def move_file(srcFile, destFile, hashIndex = None, sidecars = None):
+    """
+    Rename the file, along with any sidecar holding its geotag, replacing any
+    existing file, keeping the hash index (if any) up to date. The
+    destination must be on the same filesystem.
+    """
+    for src, dest in _file_pairs(srcFile, destFile, sidecars):
+        _replace(src, dest)
+    if hashIndex is not None:
+        hashIndex.move(srcFile, destFile)
+
+def find_export_files(fromDir, imageExtensions, otherExtensions):
+    """
+    Returns the absolute paths of the files in the directory that are to be
+    exported; sidecars are left out as they go with the file that they belong to
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(fromDir):
+        sidecars = set(sidecar_owners(filenames).values())
+        for f in filenames:
+            ext = os.path.splitext(f)[1].lower()
+            if not (ext in imageExtensions or len(imageExtensions) == 0 or
+                    ext in otherExtensions or len(otherExtensions) == 0):
+                continue
+            if f in sidecars:
+                continue
+            files.append(os.path.abspath(os.path.join(dirpath, f)))
+    return files
+
+def read_images(files, exiftool = "exiftool", sidecarExtensions = None):
+    """
+    Returns a dictionary of the ExifFile object for each file, keyed by its
+    absolute path. The files are all read by a single exiftool run rather
+    than starting exiftool for each one. Files with the sidecar extensions
+    take their geotag from their sidecar, if they have one.
+    """
+    images = {}
+    if len(files) > 0:
+        for f in gen_images_from_files(files, exiftool = exiftool, sidecarExtensions = sidecarExtensions):
+            images[os.path.abspath(f.get_filename())] = f
+    return images
+
+def find_places(images, geocoder, maxDistance = None):
+    """
+    Returns a dictionary of the place nearest to each of the images, given as
+    a dictionary of ExifFile objects, that is geotagged and within the
+    maximum distance (in km) of a place. All of the images are looked up in
+    one batch.
+    """
+    files = [f for f, img in images.iteritems() if img.geotag is not None]
+    nearest = geocoder.nearest([images[f].geotag for f in files], maxDistance)
+    return dict((f, found[0]) for f, found in zip(files, nearest) if found is not None)
+
+def catalog_entries(moved, images, hashIndex = None):
+    """
+    Returns the catalog entries for the (srcFile, destFile) pairs of files that
+    have been exported, given the ExifFile objects keyed by srcFile. The hashes
+    are those in the hash index, if there are any, so an imported file is
+    catalogued by the contents of the original.
+    """
+    entries = []
+    for srcFile, destFile in moved:
+        hashes = None
+        if hashIndex is not None:
+            hashes = hashIndex.get_hashes(destFile)
+        if hashes is None:
+            hashes = os.path.getsize(destFile), partial_hash(destFile), None
+        img = images.get(srcFile)
+        dateTime = geotag = model = None
+        if img is not None:
+            dateTime = img.dateTime
+            geotag = img.geotag
+            try:
+                model = img["Model"]
+            except KeyError:
+                pass
+        entries.append((destFile,) + tuple(hashes) + (dateTime, geotag, model))
+    return entries
+
+class ExportPlan(object):
+    """
+    The result of working out where each file being exported goes:
+    - moves: the files to be moved, grouped by the directory they go to
+    - missingDirs: those directories that need creating
+    - conflicts: (srcFile, exportDir) pairs of files whose name is already
+      taken in the directory they go to
+    - undated: files that can't be exported since when they were taken is
+      unknown
+    - names: the names that files are given in the filing tree where they
+      differ from their own
+    - sidecars: the sidecar belonging to each file that has one, which goes
+      with it
+    """
+    def __init__(self):
+        self.moves = {}
+        self.missingDirs = set()
+        self.conflicts = []
+        self.undated = []
+        self.names = {}
+        self.listings = {}
+        self.sidecars = {}
+
+    def dirs(self):
+        return sorted(self.moves.keys())
+
+    def dest_file(self, srcFile, exportDir):
+        return os.path.join(exportDir, self.names.get(srcFile, os.path.basename(srcFile)))
+
+def plan_export(files, dates, filingDir, filingStruct, places = {}):
+    """
+    Work out where each of the files goes in the filing tree, returning an
+    ExportPlan. Each destination directory is listed once, whatever the
+    number of files going to it, and nothing is created or moved, so the
+    round trips to the filing tree (which may be on a network share) are
+    kept to a minimum. The places, if the filing structure uses them, are
+    those found by find_places().
+    """
+    plan = ExportPlan()
+    listings = plan.listings
+    # Each directory that the files come from is only listed once
+    for srcDir in set(os.path.dirname(f) for f in files):
+        try:
+            owners = sidecar_owners(os.listdir(srcDir))
+        except OSError:
+            continue
+        for owner, sidecar in owners.iteritems():
+            plan.sidecars[os.path.join(srcDir, owner)] = os.path.join(srcDir, sidecar)
+    for srcFile in files:
+        dateTime = dates.get(srcFile)
+        if dateTime is None:
+            plan.undated.append(srcFile)
+            continue
+        exportDir = export_dir(dateTime, filingDir, filingStruct, places.get(srcFile))
+        listing = listings.get(exportDir)
+        if listing is None:
+            try:
+                listing = set(os.listdir(exportDir))
+            except OSError:
+                listing = set()
+                plan.missingDirs.add(exportDir)
+            listings[exportDir] = listing
+        f = os.path.basename(srcFile)
+        if f in listing:
+            plan.conflicts.append((srcFile, exportDir))
+        else:
+            listing.add(f)
+            plan.moves.setdefault(exportDir, []).append(srcFile)
+    return plan
+
+def _same_contents(file1, file2):
+    # Files that differ almost always do so in size or in their first or last
+    # blocks, so they are only read in full when those match
+    if os.path.getsize(file1) != os.path.getsize(file2):
+        return False
+    if partial_hash(file1) != partial_hash(file2):
+        return False
+    return filecopy.hash_file(file1) == filecopy.hash_file(file2)
+
+def _unused_name(f, listing):
+    base, ext = os.path.splitext(f)
+    n = 1
+    while "%s_%d%s" % (base, n, ext) in listing:
+        n += 1
+    return "%s_%d%s" % (base, n, ext)
+
+def resolve_collisions(plan, policy):
+    """
+    Deal with the conflicts in the plan according to the policy (one of
+    COLLISIONS other than COLLISION_ASK), adding those that are to be
+    exported after all to the moves. Returns (srcFile, destFile, outcome)
+    tuples reporting what happened to each.
+    """
+    report = []
+    for srcFile, exportDir in plan.conflicts:
+        f = os.path.basename(srcFile)
+        destFile = os.path.join(exportDir, f)
+        if policy == COLLISION_SKIP:
+            # The file stays where it is whatever the filed one holds, so
+            # there's no need to read them
+            report.append((srcFile, destFile, SKIPPED))
+        elif os.path.isfile(destFile) and _same_contents(srcFile, destFile):
+            report.append((srcFile, destFile, IDENTICAL))
+        elif policy == COLLISION_RENAME:
+            listing = plan.listings[exportDir]
+            name = _unused_name(f, listing)
+            listing.add(name)
+            plan.names[srcFile] = name
+            plan.moves.setdefault(exportDir, []).append(srcFile)
+            report.append((srcFile, os.path.join(exportDir, name), RENAMED))
+        elif policy == COLLISION_NEWEST and os.path.getmtime(srcFile) > os.path.getmtime(destFile):
+            plan.moves.setdefault(exportDir, []).append(srcFile)
+            report.append((srcFile, destFile, REPLACED))
+        elif policy == COLLISION_NEWEST:
+            report.append((srcFile, destFile, OLDER))
+        else:
+            report.append((srcFile, destFile, SKIPPED))
+    plan.conflicts = []
+    return report
+
+def _fsync_file(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _fsync_dir(dirname):
+    # Windows can't open a directory, so renames there can't be synced
+    if sys.platform != "win32":
+        _fsync_file(dirname)
+
+def _replace(tmpFile, destFile):
+    if sys.platform == "win32" and os.path.exists(destFile):
+        # os.rename() won't replace an existing file on Windows
+        os.remove(destFile)
+    os.rename(tmpFile, destFile)
+
+def _remove_tmp_copies(fileCopies):
+    # Remove whichever of the temporary copies of a file are still there
+    for c in fileCopies:
+        for src, dest in c:
+            if os.path.exists(dest + _TMP_SUFFIX):
+                try:
+                    os.remove(dest + _TMP_SUFFIX)
+                except OSError, e:
+                    if _DEBUG: print dest + _TMP_SUFFIX, "- unable to remove:", e
+
+class ExportMover(object):
+    """
+    Moves files into the filing tree a directory at a time. Files on the same
+    filesystem as the directory are simply renamed. Others (e.g. when filing
+    to a NAS) are copied by several workers at once, with each copy checked
+    against its source, and then all of the copies in the directory are
+    synced to disk together before any of the sources are removed, so that a
+    source is never removed before its copy is safely stored.
+
+    The files can also be mirrored to other filing trees (given by their
+    mirrors, the directories at the top of the trees, and the filing
+    directory, which is mirrored by each of them), e.g. a local disk and a
+    NAS. Each file is then read once and copied to all of the trees at the
+    same time, and the source is only removed once every copy has been
+    checked and synced. Files in a mirror are replaced by the ones being
+    filed, whatever the clashes in the filing tree itself.
+    """
+    def __init__(self, workers = 4, hashIndex = None, filingDir = None, mirrors = []):
+        self._workers = workers
+        self._hashIndex = hashIndex
+        self._filingDir = filingDir
+        self._mirrors = mirrors
+
+    def _mirror_dirs(self, exportDir):
+        if self._filingDir is None:
+            return []
+        relDir = os.path.relpath(exportDir, self._filingDir)
+        return [os.path.normpath(os.path.join(mirror, relDir)) for mirror in self._mirrors]
+
+    def move_files(self, srcFiles, exportDir, names = {}, sidecars = None):
+        """
+        Move the files (and any sidecars, as given by the export plan) into
+        the directory, which must exist, replacing any existing files. Files
+        are given the name in the names dictionary, if they are in it,
+        otherwise they keep their own.
+        Returns a list of the (srcFile, destFile) pairs of the files that were
+        moved and a list of (srcFile, exception) pairs for any that failed.
+        """
+        moved = []
+        errors = []
+        dev = os.stat(exportDir).st_dev
+        mirrorDirs = self._mirror_dirs(exportDir)
+        try:
+            for mirrorDir in mirrorDirs:
+                if not os.path.isdir(mirrorDir):
+                    os.makedirs(mirrorDir)
+        except OSError, e:
+            return moved, [(srcFile, e) for srcFile in srcFiles]
+        copies = []
+        for srcFile in srcFiles:
+            name = names.get(srcFile, os.path.basename(srcFile))
+            destFile = os.path.join(exportDir, name)
+            try:
+                rename = os.stat(srcFile).st_dev == dev
+                if rename and len(mirrorDirs) == 0:
+                    move_file(srcFile, destFile, self._hashIndex, sidecars)
+                    moved.append((srcFile, destFile))
+                else:
+                    copies.append((srcFile, destFile, [os.path.join(d, name) for d in mirrorDirs], rename, sidecars))
+            except (IOError, OSError), e:
+                errors.append((srcFile, e))
+        if len(copies) > 0:
+            copied, failed = self._copy_files(copies, [exportDir] + mirrorDirs)
+            moved.extend(copied)
+            errors.extend(failed)
+        return moved, errors
+
+    def _copy(self, srcFile, destFile, mirrorFiles, rename, sidecars):
+        # The file and its sidecar (if any) are each read once and copied to
+        # every destination at once; a file that is to be renamed into the
+        # filing tree is only copied to the mirrors
+        copyFiles = mirrorFiles if rename else [destFile] + mirrorFiles
+        pairs = _file_pairs(srcFile, destFile, sidecars)
+        copies = [_file_pairs(srcFile, f, sidecars) for f in copyFiles]
+        try:
+            for n, (src, dest) in enumerate(pairs):
+                tmpFiles = [c[n][1] + _TMP_SUFFIX for c in copies]
+                filecopy.copy_file_to_many(src, tmpFiles)
+                for tmpFile in tmpFiles:
+                    shutil.copystat(src, tmpFile)
+        except:
+            _remove_tmp_copies(copies)
+            raise
+        return srcFile, destFile, rename, sidecars, copies
+
+    def _copy_files(self, copies, dirs):
+        copied = []
+        pipeline = Pipeline([("export copy", lambda args: self._copy(*args), self._workers)],
+                            sink = copied.append)
+        for copy in copies:
+            pipeline.put(copy)
+        pipeline.close()
+        errors = [(item[0], e) for stage, item, e in pipeline.errors]
+
+        # Sync the copies to disk in one go, then put them in place, sync the
+        # directories and only then remove (or rename) the sources. A file
+        # that fails at any step keeps its source and loses its temporary
+        # copies.
+        synced = []
+        for item in copied:
+            try:
+                for c in item[4]:
+                    for src, dest in c:
+                        _fsync_file(dest + _TMP_SUFFIX)
+            except (IOError, OSError), e:
+                _remove_tmp_copies(item[4])
+                errors.append((item[0], e))
+                continue
+            synced.append(item)
+        placed = []
+        for item in synced:
+            try:
+                for c in item[4]:
+                    for src, dest in c:
+                        _replace(dest + _TMP_SUFFIX, dest)
+            except (IOError, OSError), e:
+                _remove_tmp_copies(item[4])
+                errors.append((item[0], e))
+                continue
+            placed.append(item)
+        try:
+            for d in dirs:
+                _fsync_dir(d)
+        except (IOError, OSError), e:
+            # The copies may not survive a crash, so none of the sources can go
+            errors.extend((item[0], e) for item in placed)
+            placed = []
+        moved = []
+        for srcFile, destFile, rename, sidecars, fileCopies in placed:
+            if rename:
+                try:
+                    move_file(srcFile, destFile, self._hashIndex, sidecars)
+                except OSError, e:
+                    errors.append((srcFile, e))
+                    continue
+            else:
+                try:
+                    for src, dest in _file_pairs(srcFile, destFile, sidecars):
+                        os.remove(src)
+                except OSError, e:
+                    errors.append((srcFile, e))
+                    continue
+                if self._hashIndex is not None:
+                    self._hashIndex.move(srcFile, destFile)
+            moved.append((srcFile, destFile))
+        return moved, errors
+
+# The kinds of archive that exports can be written to
+ARCHIVE_NONE = "None"
+ARCHIVE_TAR = "tar"
+ARCHIVE_ZIP = "zip"
+ARCHIVES = [ARCHIVE_NONE, ARCHIVE_TAR, ARCHIVE_ZIP]
+
+def archive_base(archiveDir, when = None):
+    """
+    Returns the path (without the extension) of the archive of an export
+    made at the time, by default now
+    """
+    if when is None:
+        when = datetime.datetime.now()
+    return os.path.join(archiveDir, when.strftime("pgtips-%Y%m%d-%H%M%S"))
+
+def _tar_size(name, size):
+    # A header block, the data padded to whole blocks and, for long names,
+    # the extra header and blocks holding the name
+    blocks = 1 + (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+    if len(name) >= tarfile.LENGTH_NAME:
+        blocks += 1 + (len(name) + tarfile.BLOCKSIZE) // tarfile.BLOCKSIZE
+    return blocks * tarfile.BLOCKSIZE
+
+def _zip_size(name, size):
+    # The local header and the central directory entry, both with the name
+    # and ZIP64 extra fields
+    return size + 30 + 46 + 2 * (len(name) + 28)
+
+class ArchiveVolumeError(Exception):
+    """
+    A file couldn't be added to an archive volume, which was discarded along
+    with the files already in it (lost, their source files)
+    """
+    def __init__(self, volume, error, lost):
+        Exception.__init__(self, "The archive volume %s was discarded: %s" % (volume, error))
+        self.lost = lost
+
+class ExportArchive(object):
+    """
+    Writes exported files straight into a tar or zip archive, laid out as
+    they are in the filing tree, so that a backup of an export is made by
+    reading each file once as it is exported rather than by archiving the
+    filing tree afterwards.
+
+    If a volume size (in bytes) is given, the archive is split into volumes
+    named base.001.tar, base.002.tar etc., each of them a complete archive,
+    with a new volume started whenever the next file (with its sidecar, if
+    any) would take the current one over the size. A file and its sidecar
+    are never split across volumes, so a volume only exceeds the size if it
+    holds a single such file larger than that. Otherwise the archive is
+    simply base.tar (or base.zip).
+
+    Each volume is written under a temporary name and only given its own
+    once it has been closed and synced to disk. A volume that can't be
+    written is discarded and the next file starts a new one. Files are
+    stored rather than compressed, since photos don't compress.
+    """
+    def __init__(self, base, kind = ARCHIVE_TAR, volumeSize = 0):
+        self._base = base
+        self._kind = kind
+        self._ext = "." + kind
+        self._volumeSize = volumeSize
+        self._archive = None
+        self._used = 0
+        self._names = set()
+        self.volumes = []
+        # The source files and names in the volume being written
+        self._volumeFiles = []
+        self._volumeNames = set()
+
+    def _volume_name(self):
+        if self._volumeSize > 0:
+            return "%s.%03d%s" % (self._base, len(self.volumes) + 1, self._ext)
+        return self._base + self._ext
+
+    def _open_volume(self):
+        name = self._volume_name()
+        if self._kind == ARCHIVE_ZIP:
+            self._archive = zipfile.ZipFile(name + _TMP_SUFFIX, "w", zipfile.ZIP_STORED, allowZip64 = True)
+        else:
+            self._archive = tarfile.open(name + _TMP_SUFFIX, "w")
+        self._used = 0
+        self.volumes.append(name)
+
+    def _close_volume(self):
+        self._archive.close()
+        self._archive = None
+        name = self.volumes[-1]
+        _fsync_file(name + _TMP_SUFFIX)
+        _replace(name + _TMP_SUFFIX, name)
+        _fsync_dir(os.path.dirname(os.path.abspath(name)))
+        self._volumeFiles = []
+        self._volumeNames = set()
+
+    def _discard_volume(self):
+        # Once a write has failed the volume can't be trusted, so it is
+        # removed; returns the source files that were in it
+        if self._archive is not None:
+            try:
+                self._archive.close()
+            except (IOError, OSError, tarfile.TarError, zipfile.BadZipfile):
+                pass
+            self._archive = None
+        lost = self._volumeFiles
+        if len(self.volumes) > 0 and (len(lost) > 0 or os.path.exists(self.volumes[-1] + _TMP_SUFFIX)):
+            name = self.volumes.pop()
+            for f in [name + _TMP_SUFFIX, name]:
+                if os.path.exists(f):
+                    try:
+                        os.remove(f)
+                    except OSError, e:
+                        if _DEBUG: print f, "- unable to remove:", e
+        self._names -= self._volumeNames
+        self._volumeFiles = []
+        self._volumeNames = set()
+        return lost
+
+    def _entry_size(self, name, size):
+        if self._kind == ARCHIVE_ZIP:
+            return _zip_size(name, size)
+        return _tar_size(name, size)
+
+    def _add(self, src, name):
+        if self._kind == ARCHIVE_ZIP:
+            self._archive.write(src, name)
+        else:
+            info = self._archive.gettarinfo(src, name)
+            with open(src, "rb") as f:
+                self._archive.addfile(info, f)
+
+    def add_file(self, srcFile, destFile, filingDir, sidecars = None):
+        """
+        Add the file (and its sidecar, if any) to the archive under its
+        destination's path within the filing tree. If that name has already
+        been used in the archive, the file is added under an unused one.
+        Returns the name of the file within the archive. If the file can't
+        be added, the volume is discarded and ArchiveVolumeError raised.
+        """
+        name = os.path.relpath(destFile, filingDir).replace(os.sep, "/")
+        if name in self._names:
+            base, ext = os.path.splitext(name)
+            n = 1
+            while "%s_%d%s" % (base, n, ext) in self._names:
+                n += 1
+            name = "%s_%d%s" % (base, n, ext)
+        pairs = _file_pairs(srcFile, name, sidecars)
+        # A file that can't be read at all doesn't touch the volume
+        size = sum(self._entry_size(dest, os.path.getsize(src)) for src, dest in pairs)
+        try:
+            if self._archive is not None and self._volumeSize > 0 and self._used > 0 \
+                    and self._used + size > self._volumeSize:
+                self._close_volume()
+            if self._archive is None:
+                self._open_volume()
+            for src, dest in pairs:
+                self._add(src, dest)
+            self._used += size
+        except (IOError, OSError, tarfile.TarError, zipfile.BadZipfile), e:
+            volume = self.volumes[-1] if len(self.volumes) > 0 else self._volume_name()
+            raise ArchiveVolumeError(volume, e, self._discard_volume())
+        for src, dest in pairs:
+            self._names.add(dest)
+            self._volumeNames.add(dest)
+        self._volumeFiles.append(srcFile)
+        return name
+
+    def close(self):
+        """
+        Finish the archive, returning the names of its volumes. If the last
+        volume can't be finished, it is discarded and ArchiveVolumeError
+        raised.
+        """
+        if self._archive is not None:
+            try:
+                self._close_volume()
+            except (IOError, OSError, tarfile.TarError, zipfile.BadZipfile), e:
+                raise ArchiveVolumeError(self.volumes[-1], e, self._discard_volume())
+        return self.volumes
+
+def archive_files(archive, srcFiles, exportDir, filingDir, names = {}, sidecars = None):
+    """
+    Add the files going to the directory in the filing tree to the archive
+    (along with their sidecars), under the names given, if any, returning a
+    list of the (srcFile, name in the archive) pairs of the files added and a
+    list of (srcFile, exception) pairs for any that couldn't be. The latter
+    includes the files lost with a volume that had to be discarded, which may
+    have been added by an earlier call.
+    """
+    archived = []
+    errors = []
+    for srcFile in srcFiles:
+        destFile = os.path.join(exportDir, names.get(srcFile, os.path.basename(srcFile)))
+        try:
+            archived.append((srcFile, archive.add_file(srcFile, destFile, filingDir, sidecars)))
+        except ArchiveVolumeError, e:
+            lost = set(e.lost)
+            archived = [(f, name) for f, name in archived if f not in lost]
+            errors.extend((f, e) for f in [srcFile] + e.lost)
+        except (IOError, OSError, tarfile.TarError, zipfile.BadZipfile), e:
+            errors.append((srcFile, e))
+    return archived, errors
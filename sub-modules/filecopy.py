@@ -0,0 +1,171 @@
+"""
+Copying of files with verification. The source is hashed as it is read, so
+that it only needs reading once, and the copy is then read back and checked
+against that hash.
+"""
+import os, shutil, hashlib, threading
+import Queue
+
+# A large buffer keeps the number of system calls down; it is a multiple of
+# the page size so that reads and writes stay aligned
+_BUFFER_SIZE = 4 * 1024 * 1024
+
+# The number of buffers read ahead of the slowest destination of a tee copy
+_TEE_DEPTH = 4
+
+class CopyVerifyError(Exception): pass
+
+def new_hash():
+    return hashlib.md5()
+
+def _hash_into(f, h, buf):
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if n == 0:
+            break
+        h.update(view[:n])
+    return h
+
+def hash_file(filename, bufferSize = _BUFFER_SIZE):
+    """
+    Returns the hex digest of the file's contents
+    """
+    buf = bytearray(bufferSize)
+    with open(filename, "rb") as f:
+        return _hash_into(f, new_hash(), buf).hexdigest()
+
+def copy_file(srcFile, destFile, verify = True, bufferSize = _BUFFER_SIZE):
+    """
+    Copy the file (and its permissions), returning the hex digest of the
+    source's contents. If verify is set, the copy is read back and, if it
+    doesn't match, removed and CopyVerifyError raised.
+
+    Note that Python 2 doesn't provide sendfile() or copy_file_range(), so
+    the data is passed through a single buffer that is reused for every read
+    and the hash is calculated from that same buffer.
+    """
+    buf = bytearray(bufferSize)
+    view = memoryview(buf)
+    h = new_hash()
+    with open(srcFile, "rb") as src:
+        with open(destFile, "wb") as dest:
+            while True:
+                n = src.readinto(buf)
+                if n == 0:
+                    break
+                chunk = view[:n]
+                h.update(chunk)
+                dest.write(chunk)
+    shutil.copymode(srcFile, destFile)
+    digest = h.hexdigest()
+
+    if verify:
+        with open(destFile, "rb") as f:
+            copied = _hash_into(f, new_hash(), buf).hexdigest()
+        if copied != digest:
+            os.remove(destFile)
+            raise CopyVerifyError("Copy of %s to %s is corrupt" % (srcFile, destFile))
+    return digest
+
+class _TeeWriter(object):
+    """
+    Writes the chunks put into its queue to a file on its own thread and then,
+    if verifying, reads the file back to hash it
+    """
+    def __init__(self, destFile, verify, bufferSize):
+        self.destFile = destFile
+        self.queue = Queue.Queue(_TEE_DEPTH)
+        self.error = None
+        self.digest = None
+        self._verify = verify
+        self._bufferSize = bufferSize
+        self.thread = threading.Thread(target = self._run, name = "tee " + destFile)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self):
+        dest = None
+        finished = False
+        try:
+            dest = open(self.destFile, "wb")
+            while True:
+                chunk = self.queue.get()
+                if chunk is None:
+                    finished = True
+                    break
+                dest.write(chunk)
+            dest.close()
+            dest = None
+            if self._verify:
+                with open(self.destFile, "rb") as f:
+                    self.digest = _hash_into(f, new_hash(), bytearray(self._bufferSize)).hexdigest()
+        except Exception, e:
+            self.error = e
+        finally:
+            if dest is not None:
+                try:
+                    dest.close()
+                except (IOError, OSError):
+                    pass
+            # Whatever went wrong, the rest of the chunks are taken so that
+            # the reader is never left blocked on a full queue
+            while not finished:
+                finished = self.queue.get() is None
+
+def copy_file_to_many(srcFile, destFiles, verify = True, bufferSize = _BUFFER_SIZE):
+    """
+    Copy the file (and its permissions) to each of the destinations, reading
+    it only once, returning the hex digest of the source's contents. Each
+    buffer read is handed to a thread per destination, so that the copies
+    are written (and, if verify is set, read back and checked) at the same
+    time and a slow destination (e.g. a NAS) only holds up the others once
+    it falls a few buffers behind.
+
+    If any of the copies fails, all of them are removed and the error (or
+    CopyVerifyError) is raised, so the copies either all succeed or none do.
+    """
+    writers = [_TeeWriter(destFile, verify, bufferSize) for destFile in destFiles]
+    h = new_hash()
+    error = None
+    try:
+        with open(srcFile, "rb") as src:
+            while True:
+                # Each chunk is a new string, so it can be shared by the
+                # writers while the next one is read
+                chunk = src.read(bufferSize)
+                if len(chunk) == 0:
+                    break
+                h.update(chunk)
+                for w in writers:
+                    w.queue.put(chunk)
+    except Exception, e:
+        # The writers have to be told to finish whatever went wrong
+        error = e
+    for w in writers:
+        w.queue.put(None)
+    for w in writers:
+        w.thread.join()
+    digest = h.hexdigest()
+
+    for w in writers:
+        if error is not None:
+            break
+        if w.error is not None:
+            error = w.error
+            break
+        if verify and w.digest != digest:
+            error = CopyVerifyError("Copy of %s to %s is corrupt" % (srcFile, w.destFile))
+            break
+    if error is None:
+        try:
+            for destFile in destFiles:
+                shutil.copymode(srcFile, destFile)
+        except (IOError, OSError), e:
+            error = e
+    if error is not None:
+        for destFile in destFiles:
+            if os.path.exists(destFile):
+                os.remove(destFile)
+        raise error
+    return digest
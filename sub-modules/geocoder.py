@@ -0,0 +1,321 @@
+"""
+Offline reverse geocoding: finding the nearest named place to a geotag using
+a local gazetteer rather than a network service.
+
+The gazetteer is a GeoNames-style dump (tab separated, with the name in the
+second column, the latitude and longitude in the fifth and sixth, the feature
+class in the seventh, the country code in the ninth, the first level
+administrative division code in the eleventh and the population in the
+fifteenth), e.g. cities1000.txt from http://download.geonames.org/export/dump/.
+It is converted once, by build_index(), into an index file holding the places
+sorted into a grid of cells, which is memory-mapped when it is used so that
+only the cells around the photos being looked up are ever read.
+
+Distances are compared as chords between points on a unit sphere, which puts
+places in the same order as the distance over the surface does, so the
+nearest place is found exactly wherever the photo was taken.
+"""
+import os, sys, math, mmap, struct, array
+from collections import defaultdict
+
+_DEBUG = True
+
+_MAGIC = "PGTGEO1\n"
+_HEADER = struct.Struct("<8sIII")
+_RANGE = struct.Struct("<II")
+
+# The coordinates of places are held as integer millionths of a degree
+_SCALE = 1000000
+
+# Aim for no more than this many places in the grid cell of a place, on
+# average, when building an index
+_PLACES_PER_CELL = 64
+_MAX_CELLS_PER_DEGREE = 8
+
+# Photos are looked up together with the others within a square of this size
+# (in degrees), since the few places that can be nearest to any point in it
+# are only searched for once
+_QUERY_CELL = 0.02
+
+_EARTH_RADIUS = 6371.0
+
+# The columns of a GeoNames dump that are used
+_NAME = 1
+_LATITUDE = 4
+_LONGITUDE = 5
+_FEATURE_CLASS = 6
+_COUNTRY = 8
+_ADMIN1 = 10
+_POPULATION = 14
+
+# Only populated places (cities, towns, villages, etc.) are used
+_POPULATED = "P"
+
+class GeocoderError(Exception): pass
+
+def _vector(lat, lon):
+    lat = math.radians(lat)
+    lon = math.radians(lon)
+    c = math.cos(lat)
+    return c * math.cos(lon), c * math.sin(lon), math.sin(lat)
+
+def _chord(a, b):
+    return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2)
+
+def _km(chord):
+    return 2 * _EARTH_RADIUS * math.asin(min(1.0, chord / 2))
+
+def _native(a):
+    # The index is little-endian whatever machine it was built on
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a
+
+def _read_gazetteer(gazetteerFile, minPopulation):
+    places = []
+    with open(gazetteerFile) as f:
+        for line in f:
+            fields = line.rstrip("\r\n").split("\t")
+            try:
+                if len(fields) > _FEATURE_CLASS and fields[_FEATURE_CLASS] not in ("", _POPULATED):
+                    continue
+                lat = int(round(float(fields[_LATITUDE]) * _SCALE))
+                lon = int(round(float(fields[_LONGITUDE]) * _SCALE))
+                population = int(fields[_POPULATION] or 0) if len(fields) > _POPULATION else 0
+            except (IndexError, ValueError):
+                if _DEBUG: print gazetteerFile, "- ignoring invalid line:", line
+                continue
+            if population < minPopulation or abs(lat) > 90 * _SCALE or abs(lon) > 180 * _SCALE:
+                continue
+            country = fields[_COUNTRY] if len(fields) > _COUNTRY else ""
+            admin1 = fields[_ADMIN1] if len(fields) > _ADMIN1 else ""
+            places.append((lat, lon, population, "\t".join([fields[_NAME], country, admin1])))
+    return places
+
+def build_index(gazetteerFile, indexFile, minPopulation = 0):
+    """
+    Build the index file from the gazetteer, keeping the populated places
+    with at least the given population. Returns the number of places indexed.
+    """
+    places = _read_gazetteer(gazetteerFile, minPopulation)
+    # Places are bunched together (and there are none at sea), so the size of
+    # the cells is set by the number of places in the cell of a typical place
+    # rather than the number in a typical cell
+    cellsPerDegree = 1
+    while cellsPerDegree < _MAX_CELLS_PER_DEGREE and len(places) > 0:
+        counts = defaultdict(int)
+        for lat, lon, population, name in places:
+            counts[lat * cellsPerDegree // _SCALE, lon * cellsPerDegree // _SCALE] += 1
+        if sum(c * c for c in counts.itervalues()) <= _PLACES_PER_CELL * len(places):
+            break
+        cellsPerDegree *= 2
+    rows = 180 * cellsPerDegree
+    cols = 360 * cellsPerDegree
+
+    def cell(place):
+        row = min(rows - 1, (place[0] + 90 * _SCALE) * cellsPerDegree // _SCALE)
+        col = (place[1] + 180 * _SCALE) * cellsPerDegree // _SCALE % cols
+        return row * cols + col
+    keyed = sorted((cell(p), p) for p in places)
+
+    starts = array.array("I", [0] * (rows * cols + 1))
+    for c, p in keyed:
+        starts[c + 1] += 1
+    for c in xrange(rows * cols):
+        starts[c + 1] += starts[c]
+    lats = array.array("i", [p[0] for c, p in keyed])
+    lons = array.array("i", [p[1] for c, p in keyed])
+    populations = array.array("I", [min(p[2], 0xffffffff) for c, p in keyed])
+    names = [p[3] for c, p in keyed]
+    nameStarts = array.array("I", [0])
+    for name in names:
+        nameStarts.append(nameStarts[-1] + len(name))
+
+    tmpFile = indexFile + ".tmp"
+    with open(tmpFile, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, cellsPerDegree, len(keyed), nameStarts[-1]))
+        for a in [starts, lats, lons, populations, nameStarts]:
+            f.write(_native(a).tostring())
+        f.write("".join(names))
+        f.flush()
+        os.fsync(f.fileno())
+    if sys.platform == "win32" and os.path.exists(indexFile):
+        # os.rename() won't replace an existing file on Windows
+        os.remove(indexFile)
+    os.rename(tmpFile, indexFile)
+    return len(keyed)
+
+class Place(object):
+    """
+    A place in the gazetteer. The country is the ISO code and the region is the
+    code of the first level administrative division (e.g. state or county)
+    as given in the gazetteer.
+    """
+    def __init__(self, name, country, region, lat, lon, population):
+        self.name = name
+        self.country = country
+        self.region = region
+        self.lat = lat
+        self.lon = lon
+        self.population = population
+
+class ReverseGeocoder(object):
+    def __init__(self, indexFile):
+        self._indexFile = indexFile
+        with open(indexFile, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError), e:
+                raise GeocoderError("%s is not a place index: %s" % (indexFile, e))
+        try:
+            magic, self._cellsPerDegree, self._count, namesSize = _HEADER.unpack_from(self._map, 0)
+        except struct.error:
+            magic = None
+        if magic != _MAGIC:
+            self._map.close()
+            raise GeocoderError("%s is not a place index" % indexFile)
+        self._rows = 180 * self._cellsPerDegree
+        self._cols = 360 * self._cellsPerDegree
+        self._startsOffset = _HEADER.size
+        self._latsOffset = self._startsOffset + 4 * (self._rows * self._cols + 1)
+        self._lonsOffset = self._latsOffset + 4 * self._count
+        self._populationsOffset = self._lonsOffset + 4 * self._count
+        self._nameStartsOffset = self._populationsOffset + 4 * self._count
+        self._namesOffset = self._nameStartsOffset + 4 * (self._count + 1)
+        if len(self._map) < self._namesOffset + namesSize:
+            self._map.close()
+            raise GeocoderError("%s is truncated" % indexFile)
+        # Only the cells (and places) that are looked at are read
+        self._cells = {}
+        self._places = {}
+
+    def close(self):
+        self._map.close()
+
+    def __len__(self):
+        return self._count
+
+    def _array(self, typecode, offset, start, end):
+        a = array.array(typecode)
+        a.fromstring(self._map[offset + 4 * start:offset + 4 * end])
+        return _native(a)
+
+    def _cell(self, row, col):
+        """
+        Returns a list of the (x, y, z, index) of each place in the cell
+        """
+        index = row * self._cols + col
+        cell = self._cells.get(index)
+        if cell is None:
+            start, end = _RANGE.unpack_from(self._map, self._startsOffset + 4 * index)
+            lats = self._array("i", self._latsOffset, start, end)
+            lons = self._array("i", self._lonsOffset, start, end)
+            cell = [_vector(float(lat) / _SCALE, float(lon) / _SCALE) + (i,)
+                    for i, lat, lon in zip(xrange(start, end), lats, lons)]
+            self._cells[index] = cell
+        return cell
+
+    def _place(self, i):
+        place = self._places.get(i)
+        if place is None:
+            lat, = self._array("i", self._latsOffset, i, i + 1)
+            lon, = self._array("i", self._lonsOffset, i, i + 1)
+            population, = self._array("I", self._populationsOffset, i, i + 1)
+            start, end = self._array("I", self._nameStartsOffset, i, i + 2)
+            name, country, region = self._map[self._namesOffset + start:self._namesOffset + end].split("\t")
+            place = Place(name.decode("utf-8"), country, region,
+                          float(lat) / _SCALE, float(lon) / _SCALE, population)
+            self._places[i] = place
+        return place
+
+    def _within(self, centre, lat, lon, radius):
+        """
+        Returns the (x, y, z, index, chord) of the places within the chord
+        radius of the centre, which is at the latitude and longitude given
+        """
+        angle = math.degrees(2 * math.asin(min(1.0, radius / 2)))
+        south = lat - angle
+        north = lat + angle
+        cols = xrange(self._cols)
+        if radius < 2 and south > -90 and north < 90:
+            # How far the circle reaches east and west of its centre
+            s = math.sin(math.radians(angle)) / math.cos(math.radians(lat))
+            if s < 1:
+                spread = math.degrees(math.asin(s))
+                west = int(math.floor((lon - spread + 180) * self._cellsPerDegree))
+                east = int(math.floor((lon + spread + 180) * self._cellsPerDegree))
+                if east - west + 1 < self._cols:
+                    cols = [col % self._cols for col in xrange(west, east + 1)]
+        first = max(0, int(math.floor((south + 90) * self._cellsPerDegree)))
+        last = min(self._rows - 1, int(math.floor((north + 90) * self._cellsPerDegree)))
+        # Allow for rounding in the comparison
+        radius = radius * (1 + 1e-9) + 1e-12
+
+        x, y, z = centre
+        found = []
+        for row in xrange(first, last + 1):
+            for col in cols:
+                for px, py, pz, i in self._cell(row, col):
+                    d = math.sqrt((px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2)
+                    if d <= radius:
+                        found.append((px, py, pz, i, d))
+        return found
+
+    def _candidates(self, south, west, size):
+        """
+        Returns the (x, y, z, index) of the places that could be the nearest to
+        some point in the square of the given size whose south west corner is
+        given
+        """
+        north = min(90.0, south + size)
+        south = max(-90.0, south)
+        lat = (south + north) / 2
+        lon = west + size / 2
+        centre = _vector(lat, lon)
+        # Any point of the square is within this chord of its centre
+        reach = max(_chord(centre, _vector(cornerLat, cornerLon))
+                    for cornerLat in (south, north) for cornerLon in (west, west + size))
+
+        # The place nearest a point of the square is no further from that point
+        # than the place nearest the centre is from the centre plus the reach,
+        # so can be no further than that plus the reach again from the centre
+        radius = max(4 * reach, 10 / _EARTH_RADIUS)
+        while True:
+            found = self._within(centre, lat, lon, radius)
+            if len(found) > 0:
+                bound = min(f[4] for f in found) + 2 * reach
+                if bound > radius:
+                    found = self._within(centre, lat, lon, bound)
+                return [f[:4] for f in found if f[4] <= bound * (1 + 1e-9) + 1e-12]
+            if radius >= 2:
+                return []
+            radius = min(2.0, radius * 4)
+
+    def nearest(self, geotags, maxDistance = None):
+        """
+        Find the nearest place to each of the geotags, returning a list of
+        (place, distance in km) pairs in the same order, with None for any
+        geotag that is None or, if a maximum distance (in km) is given, further
+        than that from any place. Photos taken near to each other are looked up
+        together, so it's much quicker to look up a batch of geotags than each
+        of them in turn.
+        """
+        results = [None] * len(geotags)
+        squares = {}
+        for n, geotag in enumerate(geotags):
+            if geotag is not None:
+                key = (int(math.floor(geotag[0] / _QUERY_CELL)), int(math.floor(geotag[1] / _QUERY_CELL)))
+                squares.setdefault(key, []).append(n)
+
+        for (south, west), indices in squares.iteritems():
+            candidates = self._candidates(south * _QUERY_CELL, west * _QUERY_CELL, _QUERY_CELL)
+            if len(candidates) == 0:
+                continue
+            for n in indices:
+                x, y, z = _vector(geotags[n][0], geotags[n][1])
+                best, nearest = min(((px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2, i)
+                                    for px, py, pz, i in candidates)
+                distance = _km(math.sqrt(best))
+                if maxDistance is None or distance <= maxDistance:
+                    results[n] = (self._place(nearest), distance)
+        return results
@@ -0,0 +1,124 @@
+"""
+A journal of geotagging runs, recording the geotag that each file had before
+the run changed it so that a run can be undone. The previous geotags are
+taken from the images as they were loaded, so the journal costs a line of a
+few tens of bytes per file rather than a backup copy of it.
+
+Each run starts with a line giving its identity (the time that it started)
+followed by a line for each file with its previous latitude, longitude and
+altitude, the fields being separated by tabs and left empty for a file that
+had no geotag (or no altitude).
+"""
+import os, sys, datetime
+from imagefiles import save_changes, ExiftoolException
+
+_DEBUG = True
+
+_RUN = "RUN"
+
+def _format(value):
+    return "" if value is None else repr(value)
+
+def _parse(value):
+    return None if value == "" else float(value)
+
+def _lines(run, entries):
+    lines = ["%s\t%s\n" % (_RUN, run)]
+    for filename, geotag in entries:
+        lat, lon, alt = geotag if geotag is not None else (None, None, None)
+        lines.append("%s\t%s\t%s\t%s\n" % (os.path.abspath(filename), _format(lat), _format(lon), _format(alt)))
+    return lines
+
+class GeotagJournal(object):
+    def __init__(self, journalFile):
+        self._journalFile = journalFile
+
+    def runs(self):
+        """
+        Returns the runs in the journal, oldest first, as a list of (run,
+        entries) pairs where the entries are a list of (filename, previous
+        geotag) pairs
+        """
+        runs = []
+        if not os.path.isfile(self._journalFile):
+            return runs
+        with open(self._journalFile) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) == 2 and fields[0] == _RUN:
+                    runs.append((fields[1], []))
+                    continue
+                try:
+                    filename, lat, lon, alt = fields
+                    lat, lon, alt = _parse(lat), _parse(lon), _parse(alt)
+                    if len(runs) == 0:
+                        raise ValueError("no run")
+                except ValueError:
+                    # Most likely the final line was only partially written
+                    if _DEBUG: print self._journalFile, "- ignoring invalid line:", line
+                    continue
+                runs[-1][1].append((filename, None if lat is None else (lat, lon, alt)))
+        return runs
+
+    def record(self, entries):
+        """
+        Record the previous geotags of the files, given as a list of (filename,
+        geotag) pairs, as a new run. The journal is synced before returning so
+        that the run can be undone however the writing of the new geotags ends.
+        """
+        if len(entries) == 0:
+            return None
+        run = datetime.datetime.now().isoformat()
+        with open(self._journalFile, "a") as f:
+            f.write("".join(_lines(run, entries)))
+            f.flush()
+            os.fsync(f.fileno())
+        return run
+
+    def discard(self, runs):
+        """
+        Remove the runs, e.g. once they have been undone
+        """
+        kept = [(run, entries) for run, entries in self.runs() if run not in runs]
+        tmpFile = self._journalFile + ".tmp"
+        with open(tmpFile, "w") as f:
+            for run, entries in kept:
+                f.write("".join(_lines(run, entries)))
+            f.flush()
+            os.fsync(f.fileno())
+        if sys.platform == "win32" and os.path.exists(self._journalFile):
+            # os.rename() won't replace an existing file on Windows
+            os.remove(self._journalFile)
+        os.rename(tmpFile, self._journalFile)
+
+def previous_geotags(runs):
+    """
+    Returns a dictionary of the geotag of each file before the earliest of the
+    runs that changed it, i.e. what undoing all of the runs restores
+    """
+    previous = {}
+    for run, entries in reversed(runs):
+        for filename, geotag in entries:
+            previous[filename] = geotag
+    return previous
+
+def restore_geotags(images, previous, exiftool = "exiftool"):
+    """
+    Set the images back to their previous geotags, given as a dictionary from
+    filename (as recorded in the journal) to geotag, and write them. Returns
+    the images that were changed and a list of (image, exception) pairs for
+    any that couldn't be written, which are left with the geotag that is
+    still in their file.
+    """
+    # A previous geotag without an altitude removes the current altitude in
+    # the same write
+    changed = [img for img in images
+               if img.set_geotag(previous[os.path.abspath(img.get_filename())], clearAltitude = True)]
+    try:
+        errors = save_changes(changed, exiftool)
+    except (ExiftoolException, OSError), e:
+        errors = [(img, e) for img in changed if img.is_modified()]
+    for img, e in errors:
+        img.revert_geotag()
+    failed = set(img for img, e in errors)
+    return [img for img in changed if img not in failed], errors
@@ -1,5 +1,5 @@
 import xml.etree.cElementTree as ET
-import datetime, os, re
+import datetime, os, re, math
 from itertools import imap
 
 _DEBUG = True
@@ -263,6 +263,19 @@ def _gen_remove_short_tracks(filename, tracks, minPointsPerTrack):
         else:
             yield t
 
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_UTC = datetime.datetime(1970, 1, 1, tzinfo = _gps_tzinfo())
+
+def _epoch(dateTime):
+    # Subtracting is much quicker than calendar.timegm(), which matters for
+    # tracks of a million points
+    if dateTime.tzinfo is None:
+        # A naive time is taken to be UTC
+        d = dateTime - _EPOCH
+    else:
+        d = dateTime - _EPOCH_UTC
+    return d.days * 86400 + d.seconds
+
 class _Tracks(object):
     def __init__(self,
                  filename,
@@ -273,6 +286,7 @@ class _Tracks(object):
                  joinTrackGap = 10):
         self._filename = filename
         self._filetype = filetype
+        self._times = None
         if tracks is None:
             self._tracks = []
             self._valid = False
@@ -314,6 +328,15 @@ class _Tracks(object):
     def get_filename(self):
         return self._filename
 
+    def track_times(self):
+        """
+        Returns the times of the points of each track as UTC seconds since the
+        epoch, which are only worked out the first time that they are needed
+        """
+        if self._times is None:
+            self._times = [[_epoch(pt[0]) for pt in t] for t in self._tracks]
+        return self._times
+
     def match_time(self, dateTime, endTolerance = 300, utcOffsetHours = None, utcOffsetMinutes = 0):
         matches = []
         if dateTime.tzinfo is None and utcOffsetHours is not None:
@@ -342,6 +365,7 @@ class _Tracks(object):
                         # Check for minimum proximity?
                         matches.append((last, pt))
                         break
+                    last = pt
                 else:
                     assert False, "Shouldn't get here!"
         if len(matches) == 0:
@@ -362,6 +386,194 @@ class _Tracks(object):
 
             return lat, lon, alt
 
+def _interpolate(t1, t2, ratio):
+    lat1, lon1, alt1 = t1[1:]
+    lat2, lon2, alt2 = t2[1:]
+    lat = lat1 + (lat2 - lat1) * ratio
+    lon = lon1 + (lon2 - lon1) * ratio
+    if alt1 is None or alt2 is None:
+        alt = None
+    else:
+        alt = alt1 + (alt2 - alt1) * ratio
+    return lat, lon, alt
+
+def match_times(gpsFiles, dateTimes, endTolerance = 300, offset = 0):
+    """
+    Returns the geotag (or None) for each of the times, as match_time() would
+    if each file were tried in turn until one matched, but working through
+    the times in order in a single sweep over all of the tracks rather than
+    searching every track for every time.
+
+    Each track becomes a candidate once the time is within the tolerance of
+    its start and stops being one once the time is more than the tolerance
+    past its end; a time is matched by the first of the candidates in the
+    files' order and the point that it falls after is found by moving on
+    from where that track's previous match was.
+
+    The offset (in seconds) is added to the times first, to correct for a
+    camera clock that is wrong.
+    """
+    geotags = [None] * len(dateTimes)
+    tracks = []
+    for gpsFile in gpsFiles:
+        for t, times in zip(gpsFile._tracks, gpsFile.track_times()):
+            tracks.append((times[0] - endTolerance, len(tracks), t, times))
+    tracks.sort()
+    photos = sorted((_epoch(dt) + offset, n) for n, dt in enumerate(dateTimes) if dt is not None)
+
+    # [order, track, times, index of the last point matched] of each candidate
+    candidates = []
+    nextTrack = 0
+    for when, n in photos:
+        while nextTrack < len(tracks) and tracks[nextTrack][0] <= when:
+            start, order, t, times = tracks[nextTrack]
+            candidates.append([order, t, times, 0])
+            nextTrack += 1
+        candidates = [c for c in candidates if c[2][-1] + endTolerance >= when]
+        if len(candidates) == 0:
+            continue
+        c = min(candidates)
+        order, t, times, i = c
+        if when < times[0]:
+            geotags[n] = t[0][1:]
+        elif when >= times[-1]:
+            geotags[n] = t[-1][1:]
+        else:
+            while times[i + 1] <= when:
+                i += 1
+            c[3] = i
+            geotags[n] = _interpolate(t[i], t[i + 1], (when - times[i]) / float(times[i + 1] - times[i]))
+    return geotags
+
+# Metres per degree of latitude (and of longitude at the equator)
+_METRES_PER_DEGREE = 111320.0
+
+# The most entries in an estimator's table of the tracks
+_MAX_TABLE = 1 << 25
+
+class ClockOffsetEstimator(object):
+    """
+    Estimates how far out a camera's clock was from the GPS by trying
+    candidate offsets (in seconds, added to the times of the photos) and
+    scoring each one by:
+    - coverage: the number of photos whose corrected time falls within a
+      track
+    - motion: the mean speed of the tracks at those times, since photos tend
+      to be taken when stopped or moving slowly
+    The best offset is the one that covers the most photos, with the lowest
+    mean speed breaking ties.
+
+    When the estimator is created, the tracks are turned into a table with
+    an entry per second (or a little more, for tracks spanning years) from
+    the first point to the last, holding 0 where there is no track and
+    otherwise 1 plus the speed in km/h. Trying an offset is then just a
+    lookup per photo, done by built-in functions over the whole sorted list
+    of photos at once, so each offset takes a millisecond or two even for
+    many thousands of photos and millions of points. The estimator can be
+    kept and reused for as long as the tracks are loaded.
+    """
+    def __init__(self, gpsFiles):
+        tracks = []
+        for gpsFile in gpsFiles:
+            tracks.extend(zip(gpsFile.track_times(), gpsFile._tracks))
+        tracks.sort(key = lambda (times, t): times[0])
+        if len(tracks) == 0:
+            self._start = 0
+            self._resolution = 1
+            self._table = bytearray(1)
+            self._padding = 0
+            return
+        self._start = tracks[0][0][0]
+        end = max(times[-1] for times, t in tracks)
+        self._resolution = max(1, (end - self._start) // _MAX_TABLE + 1)
+
+        table = bytearray((end - self._start) // self._resolution + 1)
+        start = self._start
+        resolution = self._resolution
+        cos = math.cos
+        sqrt = math.sqrt
+        radians = math.radians
+        for times, t in tracks:
+            for n in range(1, len(times)):
+                if times[n] <= times[n - 1]:
+                    continue
+                # An equirectangular approximation is plenty for the distance
+                # between neighbouring points
+                pt1, pt2 = t[n - 1], t[n]
+                dLat = pt2[1] - pt1[1]
+                dLon = (pt2[2] - pt1[2]) * cos(radians((pt1[1] + pt2[1]) / 2))
+                speed = sqrt(dLat * dLat + dLon * dLon) * _METRES_PER_DEGREE / (times[n] - times[n - 1])
+                a = (times[n - 1] - start) // resolution
+                b = (times[n] - start) // resolution
+                table[a:b] = chr(1 + min(254, int(speed * 3.6))) * (b - a)
+        self._table = table
+        self._padding = 0
+
+    def _index(self, when):
+        return (when - self._start) // self._resolution
+
+    def _padded(self, shift):
+        # The table with enough empty entries at each end that none of the
+        # photos (having been shifted) fall outside it
+        if self._padding < shift:
+            padding = bytearray(shift - self._padding)
+            self._table = padding + self._table + padding
+            self._padding = shift
+        return self._table, self._padding
+
+    def evaluate(self, dateTimes, offsets):
+        """
+        Returns a list of (offset, photos covered, mean speed in m/s) tuples
+        for each of the offsets
+        """
+        return self._evaluate(self._photos(dateTimes), offsets)
+
+    def _photos(self, dateTimes):
+        return sorted(self._index(_epoch(dt)) for dt in dateTimes if dt is not None)
+
+    def _evaluate(self, photos, offsets):
+        if len(offsets) == 0:
+            return []
+        shifts = [offset // self._resolution for offset in offsets]
+        maxShift = max(abs(shift) for shift in shifts)
+        # Photos that are too far from the tracks can't be covered by any of
+        # the offsets and the rest stay within the padding whatever the offset
+        table, padding = self._padded(2 * maxShift)
+        length = len(table) - 2 * padding
+        photos = [p + padding for p in photos if -maxShift <= p < length + maxShift]
+        results = []
+        for offset, shift in zip(offsets, shifts):
+            values = map(table.__getitem__, [p + shift for p in photos])
+            covered = len(values) - values.count(0)
+            speed = (sum(values) - covered) / 3.6
+            results.append((offset, covered, speed / covered if covered > 0 else 0.0))
+        return results
+
+    def best(self, results):
+        """
+        Returns the best of the results of evaluate(), preferring the
+        smallest offset if there's nothing to choose between them
+        """
+        return max(results, key = lambda (offset, covered, speed): (covered, -speed, -abs(offset)))
+
+    def estimate(self, dateTimes, maxOffset = 12 * 3600, steps = [900, 60, 5, 1]):
+        """
+        Returns the best result, as a tuple of (offset, photos covered, mean
+        speed), of the offsets up to maxOffset seconds either way. The whole
+        range is tried at the first step and then the range around the best
+        offset at each finer step.
+        """
+        photos = self._photos(dateTimes)
+        low, high = -maxOffset, maxOffset
+        best = None
+        for step in steps:
+            offsets = range(low, high + 1, step)
+            if best is not None and best[0] not in offsets:
+                offsets.append(best[0])
+            best = self.best(self._evaluate(photos, offsets))
+            low, high = best[0] - step, best[0] + step
+        return best
+
 class _TrackProxy(object):
     """
     A class that provides read-only access (and possibly managed modification in the future,
@@ -0,0 +1,218 @@
+"""
+A persistent index of the contents of the files that PGTips already holds
+(i.e. those in the working directory and the filing tree) so that files that
+have already been imported can be recognised without copying them again.
+
+Hashes are only calculated when they are needed: a file can only be a
+duplicate of a file of the same size, then a partial hash (of the start and
+end of the file) has to match before, optionally, the full hash is compared.
+
+Files that PGTips imports are indexed by the contents of the original, since
+the copy is then modified (rotated, geotagged) but is still the same photo.
+"""
+import os, threading
+import filecopy
+
+_DEBUG = True
+
+# The amount of data at each end of a file that is covered by the partial hash
+_PARTIAL_SIZE = 64 * 1024
+
+# The duplicate checks that can be made
+CHECK_OFF = "Off"
+CHECK_QUICK = "Quick"
+CHECK_FULL = "Full"
+CHECKS = [CHECK_OFF, CHECK_QUICK, CHECK_FULL]
+
+def partial_hash(filename):
+    """
+    Returns the hex digest of the size and the first and last blocks of the file
+    """
+    h = filecopy.new_hash()
+    with open(filename, "rb") as f:
+        f.seek(0, 2)
+        size = f.tell()
+        h.update(str(size))
+        f.seek(0)
+        h.update(f.read(_PARTIAL_SIZE))
+        if size > _PARTIAL_SIZE:
+            f.seek(max(_PARTIAL_SIZE, size - _PARTIAL_SIZE))
+            h.update(f.read(_PARTIAL_SIZE))
+    return h.hexdigest()
+
+class _Entry(object):
+    __slots__ = ["size", "mtime", "partial", "full", "imported"]
+
+    def __init__(self, size, mtime, partial = None, full = None, imported = False):
+        self.size = size
+        self.mtime = mtime
+        self.partial = partial
+        self.full = full
+        self.imported = imported
+
+class HashIndex(object):
+    def __init__(self, indexFile = None):
+        self._indexFile = indexFile
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._bySize = {}
+        if indexFile is not None and os.path.isfile(indexFile):
+            self._load()
+
+    def _load(self):
+        with open(self._indexFile) as f:
+            for line in f:
+                try:
+                    size, mtime, partial, full, imported, path = line.rstrip("\n").split("\t", 5)
+                    entry = _Entry(int(size), float(mtime),
+                                   None if partial == "-" else partial,
+                                   None if full == "-" else full,
+                                   imported == "i")
+                except ValueError:
+                    if _DEBUG: print self._indexFile, "- ignoring invalid line:", line
+                    continue
+                self._add(path, entry)
+
+    def save(self):
+        if self._indexFile is None:
+            return
+        tmpFile = self._indexFile + ".pgtips~"
+        with self._lock:
+            with open(tmpFile, "w") as f:
+                for path, e in self._entries.iteritems():
+                    f.write("%d\t%r\t%s\t%s\t%s\t%s\n" % (
+                            e.size, e.mtime, e.partial or "-", e.full or "-", "i" if e.imported else "-", path))
+        if os.path.exists(self._indexFile):
+            os.remove(self._indexFile)
+        os.rename(tmpFile, self._indexFile)
+
+    def _add(self, path, entry):
+        self._remove(path)
+        self._entries[path] = entry
+        self._bySize.setdefault(entry.size, set()).add(path)
+
+    def _remove(self, path):
+        try:
+            entry = self._entries.pop(path)
+        except KeyError:
+            return
+        paths = self._bySize[entry.size]
+        paths.discard(path)
+        if len(paths) == 0:
+            del self._bySize[entry.size]
+
+    def refresh(self, dirs):
+        """
+        Bring the index up to date with the files in the directories. Only
+        files that are new to the index are stat'ed; files that have changed
+        since they were indexed are spotted when their hashes are needed.
+        """
+        with self._lock:
+            for d in dirs:
+                d = os.path.abspath(d)
+                found = set()
+                for dirpath, dirnames, filenames in os.walk(d):
+                    for f in filenames:
+                        path = os.path.join(dirpath, f)
+                        found.add(path)
+                        if path not in self._entries:
+                            try:
+                                st = os.stat(path)
+                            except OSError:
+                                continue
+                            self._add(path, _Entry(st.st_size, st.st_mtime))
+                prefix = os.path.join(d, "")
+                for path in [p for p in self._entries if p.startswith(prefix) and p not in found]:
+                    self._remove(path)
+
+    def add_imported(self, path, size, partialHash, fullHash):
+        """
+        Add a file that has been imported along with the size and hashes of
+        the original. The file stays indexed by the original's contents for as
+        long as it exists, even though it may be modified.
+        """
+        path = os.path.abspath(path)
+        entry = _Entry(size, os.path.getmtime(path), partialHash, fullHash, imported = True)
+        with self._lock:
+            self._add(path, entry)
+
+    def move(self, oldPath, newPath):
+        """
+        Record that a file has been moved, keeping any hashes already known
+        """
+        oldPath = os.path.abspath(oldPath)
+        newPath = os.path.abspath(newPath)
+        with self._lock:
+            entry = self._entries.get(oldPath)
+            self._remove(oldPath)
+            if entry is not None:
+                self._add(newPath, entry)
+
+    def get_hashes(self, path):
+        """
+        Returns the (size, partial hash, full hash) of the file in the index,
+        calculating the partial hash if it isn't yet known, or None if the
+        file isn't in the index. The full hash is None if it isn't known.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return None
+            entry = self._current(path, entry)
+            if entry is None:
+                return None
+            if entry.partial is None:
+                entry.partial = partial_hash(path)
+            return entry.size, entry.partial, entry.full
+
+    def _current(self, path, entry):
+        """
+        Check that the entry still describes the file, returning the entry or
+        a fresh one if the file has changed, or None if it no longer exists
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._remove(path)
+            return None
+        if not entry.imported and (st.st_size != entry.size or st.st_mtime != entry.mtime):
+            entry = _Entry(st.st_size, st.st_mtime)
+            self._add(path, entry)
+        return entry
+
+    def find_duplicate(self, filename, check = CHECK_QUICK):
+        """
+        Returns the path of a file in the index with the same contents as the
+        given file or None. With CHECK_QUICK, files are considered the same if
+        their size and partial hash match; CHECK_FULL also compares full hashes.
+        """
+        if check == CHECK_OFF:
+            return None
+        size = os.path.getsize(filename)
+        with self._lock:
+            candidates = list(self._bySize.get(size, []))
+            if len(candidates) == 0:
+                return None
+            partial = partial_hash(filename)
+            full = None
+            for path in candidates:
+                entry = self._current(path, self._entries[path])
+                if entry is None or entry.size != size:
+                    continue
+                if entry.partial is None:
+                    entry.partial = partial_hash(path)
+                if entry.partial != partial:
+                    continue
+                if check == CHECK_QUICK:
+                    return path
+                if full is None:
+                    full = filecopy.hash_file(filename)
+                if entry.full is None:
+                    if entry.imported:
+                        # The file has been modified since so can't be checked
+                        continue
+                    entry.full = filecopy.hash_file(path)
+                if entry.full == full:
+                    return path
+        return None
@@ -1,9 +1,15 @@
-import os, sys, datetime, re
+import os, sys, datetime, re, threading
+from cStringIO import StringIO
 import xml.etree.cElementTree as ET
 from subprocess import Popen, PIPE
+from jpegexif import write_geotag, same_geotag, JpegExifUnsafe
+import xmpsidecar
 
 _DEBUG = True
 
+# Extensions of files whose geotag can be written without resorting to exiftool
+_nativeExtensions = [".jpg", ".jpeg"]
+
 class ExiftoolException(Exception): pass
 
 def _find_all_files(files, include, exclude):
@@ -111,12 +117,14 @@ class ExifFile(object):
             "geotag",
             ]
 
-    def __init__(self, filename, exifDict, defaultTz, exiftool = "exiftool"):
+    def __init__(self, filename, exifDict, defaultTz, exiftool = "exiftool", sidecar = False):
         self._exiftool = exiftool
         self._filename = filename
+        self._sidecar = sidecar
         self._namespaces = exifDict
         self._defaultTz = defaultTz
         self._modified = False
+        self._clearAltitude = False
         try:
             self._dateTime = _parse_exiftool_datetime(self["DateTimeOriginal"], defaultTz)
         except KeyError:
@@ -137,6 +145,12 @@ class ExifFile(object):
             self._geotag = (lat, lon, alt)
         except:
             self._geotag = None
+        if sidecar:
+            # A geotag in the sidecar takes precedence over an embedded one
+            # since that is where any geotag that PGTips sets will be written
+            geotag = xmpsidecar.read_geotag(filename)
+            if geotag is not None:
+                self._geotag = geotag
 
     def __getattr__(self, attr):
         if attr in self.managedAttributes:
@@ -166,39 +180,97 @@ class ExifFile(object):
     def get_filename(self):
         return self._filename
 
-    def set_geotag(self, geotag):
+    def uses_sidecar(self):
+        return self._sidecar
+
+    def set_geotag(self, geotag, clearAltitude = False):
+        """
+        Set the geotag, returning whether it changed. A geotag within the
+        tolerance of the existing one is ignored so that the file isn't
+        rewritten. As with exiftool, a geotag without an altitude leaves any
+        existing altitude in place unless clearAltitude is set.
+        """
         assert geotag is None or len(geotag) == 3, "geotag must be (lat, lon, alt) or None"
+        clearAltitude = (clearAltitude and geotag is not None and geotag[2] is None and
+                         self._geotag is not None and self._geotag[2] is not None)
+        if not clearAltitude and same_geotag(self._geotag, geotag):
+            return False
+        if not self._modified:
+            # The geotag in the file, for revert_geotag()
+            self._savedGeotag = self._geotag
         self._geotag = geotag
+        self._clearAltitude = clearAltitude
         self._modified = True
+        return True
 
-    def save_changes(self):
+    def revert_geotag(self):
+        """
+        Go back to the geotag in the file, discarding any change that hasn't
+        been written (e.g. because writing it failed)
+        """
         if self._modified:
-            if self._geotag is None:
-                # Remove geotag
-                exiftoolCmd = " -q -overwrite_original -gps:all= " + self._filename
-            else:
-                lat, lon, alt = self._geotag
-                latRef, lonRef, altRef = "N", "E", 0
-
-                if lat < 0:
-                    lat = -lat
-                    latRef = "S"
-
-                if lon < 0:
-                    lon = -lon
-                    lonRef = "W"
+            self._geotag = self._savedGeotag
+            self._clearAltitude = False
+            self._modified = False
 
-                if alt is not None and alt < 0:
-                    alt = -alt
-                    altRef = 1
+    def is_modified(self):
+        return self._modified
 
-                exiftoolCmd = " -q -n -overwrite_original "
-                exiftoolCmd += "-GPSLatitude=%f -GPSLatitudeRef=%s " % (lat, latRef)
-                exiftoolCmd += "-GPSLongitude=%f -GPSLongitudeRef=%s " % (lon, lonRef)
-                if alt is not None:
-                    exiftoolCmd += "-GPSAltitude=%f -GPSAltitudeRef=%d " % (alt, altRef)
-                exiftoolCmd += self._filename
+    def _save_natively(self):
+        """
+        Write the geotag without exiftool where that is possible, returning
+        whether it was written
+        """
+        if self._sidecar:
+            xmpsidecar.write_geotag(self._filename, self._geotag, self._clearAltitude)
+            self._modified = False
+            return True
+        if os.path.splitext(self._filename)[1].lower() in _nativeExtensions:
+            try:
+                write_geotag(self._filename, self._geotag, self._clearAltitude)
+                self._modified = False
+                return True
+            except JpegExifUnsafe, e:
+                if _DEBUG: print self._filename, "- falling back to exiftool:", e
+        return False
+
+    def _exiftool_args(self):
+        """
+        Returns the exiftool arguments (other than the file) that write the
+        geotag
+        """
+        if self._geotag is None:
+            # Remove geotag
+            return ["-overwrite_original", "-gps:all="]
+        lat, lon, alt = self._geotag
+        latRef, lonRef, altRef = "N", "E", 0
+
+        if lat < 0:
+            lat = -lat
+            latRef = "S"
+
+        if lon < 0:
+            lon = -lon
+            lonRef = "W"
+
+        if alt is not None and alt < 0:
+            alt = -alt
+            altRef = 1
+
+        args = ["-n", "-overwrite_original",
+                "-GPSLatitude=%f" % lat, "-GPSLatitudeRef=%s" % latRef,
+                "-GPSLongitude=%f" % lon, "-GPSLongitudeRef=%s" % lonRef]
+        if alt is not None:
+            args += ["-GPSAltitude=%f" % alt, "-GPSAltitudeRef=%d" % altRef]
+        elif self._clearAltitude:
+            args += ["-GPSAltitude=", "-GPSAltitudeRef="]
+        return args
 
+    def save_changes(self):
+        if self._modified:
+            if self._save_natively():
+                return
+            exiftoolCmd = " -q " + " ".join(self._exiftool_args()) + " " + self._filename
             pipe = Popen(self._exiftool + exiftoolCmd, stdin = PIPE, stdout = PIPE, **_popenKwds)
             pipe.communicate()
             if pipe.returncode != 0:
@@ -217,16 +289,17 @@ class ExifFile(object):
                 return False
 
 class _ExifContext(object):
-    def __init__(self, defaultTz, exiftool):
+    def __init__(self, defaultTz, exiftool, sidecarExtensions):
         self._root = None
         self._namespaces = []
         self._defaultTz = defaultTz
         self._exiftool = exiftool
+        self._sidecarExtensions = sidecarExtensions
 
-    def gen_exif_files(self, pipe):
+    def gen_exif_files(self, source):
         for exiffiles in self._gen_exiffile_objects(
                          self._gen_file_descriptions(
-                         pipe), self._exiftool):
+                         source), self._exiftool):
             yield exiffiles
 
     def _reverse_namespace(self, tag):
@@ -241,8 +314,8 @@ class _ExifContext(object):
         else:
             return "", item.tag
 
-    def _gen_file_descriptions(self, pipe):
-        for event, item in ET.iterparse(pipe.stdout,
+    def _gen_file_descriptions(self, source):
+        for event, item in ET.iterparse(source,
                                         events = ("start",
                                                   "end",
                                                   "start-ns",
@@ -273,7 +346,8 @@ class _ExifContext(object):
                     exif[key[0]] = {}
                     exif[key[0]][key[1]] = item.text
             self._root.clear()
-            yield ExifFile(about, exif, self._defaultTz, exiftool)
+            ext = os.path.splitext(about)[1].lower()
+            yield ExifFile(about, exif, self._defaultTz, exiftool, ext in self._sidecarExtensions)
 
 _tagsToExtract = "\n".join([
         "-PreviewImage",
@@ -298,10 +372,12 @@ def gen_images_from_files(files,
                           exclude = None,
                           exiftool = "exiftool",
                           defaultTzHours = 0,
-                          defaultTzMinutes = 0):
+                          defaultTzMinutes = 0,
+                          sidecarExtensions = None):
     defaultTz = _exiftool_tzinfo(defaultTzHours, defaultTzMinutes)
     if include is not None: include = map(str.lower, include)
     if exclude is not None: exclude = map(str.lower, exclude)
+    sidecarExtensions = [] if sidecarExtensions is None else map(str.lower, sidecarExtensions)
     files = _find_all_files(files, include, exclude)
     files = "\n".join(files)
     if files == "":
@@ -312,10 +388,119 @@ def gen_images_from_files(files,
     pipe.stdin.write(files)
     pipe.stdin.close()
 
-    context = _ExifContext(defaultTz, exiftool)
-    for v in context.gen_exif_files(pipe):
+    context = _ExifContext(defaultTz, exiftool, sidecarExtensions)
+    for v in context.gen_exif_files(pipe.stdout):
         yield v
 
+# exiftool's summary of a file that it has written (or had nothing to write to)
+_updated = re.compile(r"^\s*1 image files (updated|unchanged)")
+
+def save_changes(images, exiftool = "exiftool"):
+    """
+    Write the changes made to the images, returning a list of (image,
+    exception) pairs for any that couldn't be written. Those whose geotag
+    can be written without exiftool are, and a single exiftool session is
+    started for all of the rest rather than exiftool being run for each.
+    """
+    errors = []
+    remaining = []
+    for img in images:
+        if not img.is_modified():
+            continue
+        try:
+            if not img._save_natively():
+                remaining.append(img)
+        except Exception, e:
+            errors.append((img, e))
+    if len(remaining) > 0:
+        session = ExiftoolSession(exiftool)
+        try:
+            errors += session.save_changes(remaining)
+        finally:
+            session.close()
+    return errors
+
+class ExiftoolSession(object):
+    """
+    A resident exiftool process (using its -stay_open option) that reads the
+    metadata of batches of files, avoiding the cost of starting exiftool (and
+    Perl) for every batch. Each batch is sent as the arguments of a single
+    -execute and exiftool signals the end of its output with {ready}.
+    """
+    def __init__(self,
+                 exiftool = "exiftool",
+                 defaultTzHours = 0,
+                 defaultTzMinutes = 0,
+                 sidecarExtensions = None):
+        self.exiftool = exiftool
+        self._defaultTz = _exiftool_tzinfo(defaultTzHours, defaultTzMinutes)
+        self._sidecarExtensions = [] if sidecarExtensions is None else map(str.lower, sidecarExtensions)
+        self._lock = threading.Lock()
+        self._pipe = Popen(exiftool + " -stay_open True -@ -",
+                           stdin = PIPE, stdout = PIPE, **_popenKwds)
+
+    def read_images(self, files):
+        """
+        Returns a list of the ExifFile objects for the files
+        """
+        if len(files) == 0:
+            return []
+        output = self._execute(["-q", "-n", "-X"] + _tagsToExtract.split("\n") + files)
+        if len(output) == 0:
+            # None of the files could be read
+            return []
+        context = _ExifContext(self._defaultTz, self.exiftool, self._sidecarExtensions)
+        return list(context.gen_exif_files(StringIO("".join(output))))
+
+    def _execute(self, args):
+        # Returns exiftool's output, which ends at {ready}
+        with self._lock:
+            if self._pipe is None:
+                raise ExiftoolException("The exiftool session has been closed")
+            try:
+                self._pipe.stdin.write("\n".join(args) + "\n-execute\n")
+                self._pipe.stdin.flush()
+            except IOError, e:
+                raise ExiftoolException("exiftool is no longer running: %s" % e)
+            output = []
+            while True:
+                line = self._pipe.stdout.readline()
+                if line == "":
+                    raise ExiftoolException("exiftool stopped unexpectedly")
+                if line.rstrip() == "{ready}":
+                    break
+                output.append(line)
+        return output
+
+    def save_changes(self, images):
+        """
+        Write the changes made to the images, each one as a command to this
+        exiftool, returning a list of (image, exception) pairs for any that
+        couldn't be written
+        """
+        errors = []
+        for img in images:
+            if not img.is_modified():
+                continue
+            output = self._execute(img._exiftool_args() + [img.get_filename()])
+            if not any(_updated.match(line) for line in output):
+                errors.append((img, ExiftoolException("".join(output).strip() or "Not updated")))
+                continue
+            img._modified = False
+        return errors
+
+    def close(self):
+        with self._lock:
+            if self._pipe is None:
+                return
+            try:
+                self._pipe.stdin.write("-stay_open\nFalse\n")
+                self._pipe.stdin.close()
+            except IOError:
+                pass
+            self._pipe.wait()
+            self._pipe = None
+
 if __name__ == "__main__":
     for i in gen_images_from_files("Images", [".jpg", ".mrw"]):
         print i[("System", "FileName")], i["FileType"], i["Model"]
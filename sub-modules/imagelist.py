@@ -1,8 +1,11 @@
 #!/usr/bin/python
-import wx, sys
+import wx, sys, os
 import  wx.lib.mixins.listctrl as listmix
 import images
 
+def _normalise_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
 class _ImageListCtrl(wx.ListCtrl, listmix.ListCtrlAutoWidthMixin):
     """
     Create a sub-class of the ListCtrl class which includes the mix-in
@@ -42,6 +45,12 @@ class ImageListCtrlPanel(wx.Panel, listmix.ColumnSorterMixin):
         sizer.Add(self._listCtrl, 1, wx.EXPAND)
 
         self._itemDataMap = {}
+        # The ident of each image, keyed by its normalised path, so that an
+        # image can be found from its file without searching the whole list
+        self._identByPath = {}
+        # The last known index of each ident's item, which is checked before
+        # being used since sorting, inserting and deleting items move them
+        self._indexByIdent = {}
         self._uuidCounter = 0
         listmix.ColumnSorterMixin.__init__(self, 3)
         #self.SortListItems(0, True)
@@ -108,36 +117,79 @@ class ImageListCtrlPanel(wx.Panel, listmix.ColumnSorterMixin):
     def add_image_deselect_notify(self, notify):
         self._imageDeselectNotifyList.append(notify)
     
-    def update_image(self, img):
-        # TODO: Lots of commonality with add_image - refactor
-        for ident, image in self._itemDataMap.iteritems():
-            if img is image:
-                index = self._listCtrl.FindItemData(-1, ident)
-                a = img["FileName"]
-                b = img.dateTime.isoformat(" ")
-                c = img.geotag
-                if c is None:
-                    c = '-'
-                else:
-                    alt = c[2]
-                    c = "%.3f, %.3f" % (c[0], c[1])
-                    if alt is not None:
-                        c += " (%dm)" % alt
-                self._listCtrl.SetStringItem(index, 0, a)
-                self._listCtrl.SetStringItem(index, 1, b)
-                self._listCtrl.SetStringItem(index, 2, c)
-
-                self._listCtrl.SetColumnWidth(0, wx.LIST_AUTOSIZE)
-                self._listCtrl.SetColumnWidth(1, wx.LIST_AUTOSIZE)
-                self._listCtrl.SetColumnWidth(2, wx.LIST_AUTOSIZE)
+    def _find_ident(self, img):
+        ident = self._identByPath.get(_normalise_path(img.get_filename()))
+        if ident is not None and self._itemDataMap[ident] is img:
+            return ident
+        return None
+
+    def _item_indices(self, idents):
+        """
+        Returns a dictionary of the index of the item of each of the idents,
+        only looking through the whole control if one of them has moved
+        """
+        count = self._listCtrl.GetItemCount()
+        for ident in idents:
+            index = self._indexByIdent.get(ident)
+            if index is None or index >= count or self._listCtrl.GetItemData(index) != ident:
+                self._indexByIdent = dict((self._listCtrl.GetItemData(index), index)
+                                          for index in range(count))
                 break
+        return dict((ident, self._indexByIdent[ident]) for ident in idents if ident in self._indexByIdent)
+
+    def _update_item(self, index, img):
+        # TODO: Lots of commonality with add_image - refactor
+        a = img["FileName"]
+        b = img.dateTime.isoformat(" ")
+        c = img.geotag
+        if c is None:
+            c = '-'
+        else:
+            alt = c[2]
+            c = "%.3f, %.3f" % (c[0], c[1])
+            if alt is not None:
+                c += " (%dm)" % alt
+        self._listCtrl.SetStringItem(index, 0, a)
+        self._listCtrl.SetStringItem(index, 1, b)
+        self._listCtrl.SetStringItem(index, 2, c)
+
+    def _autosize_columns(self):
+        self._listCtrl.SetColumnWidth(0, wx.LIST_AUTOSIZE)
+        self._listCtrl.SetColumnWidth(1, wx.LIST_AUTOSIZE)
+        self._listCtrl.SetColumnWidth(2, wx.LIST_AUTOSIZE)
+
+    def update_image(self, img):
+        self.update_images([img])
+
+    def update_images(self, imgs):
+        """
+        Update a batch of images in one go, finding all of their items at
+        once and redrawing the control (and sizing the columns) once rather
+        than for each image
+        """
+        idents = [(ident, img) for ident, img in ((self._find_ident(img), img) for img in imgs) if ident is not None]
+        if len(idents) == 0:
+            return
+        indices = self._item_indices([ident for ident, img in idents])
+        self._listCtrl.Freeze()
+        try:
+            for ident, img in idents:
+                if ident in indices:
+                    self._update_item(indices[ident], img)
+        finally:
+            self._listCtrl.Thaw()
+        self._autosize_columns()
 
     def add_image(self, img):
         """
         Add an image to the control. It is assumed to be a object
         returned from gen_images_from_files()
         """
-        assert img not in self._itemDataMap.values()
+        assert self._find_ident(img) is None
+        previous = self.find_image(img.get_filename())
+        if previous is not None:
+            # The file has been loaded again so this replaces it
+            self.rm_image(previous)
         a = img["FileName"]
         b = img.dateTime.isoformat(" ")
         c = img.geotag
@@ -153,6 +205,7 @@ class ImageListCtrlPanel(wx.Panel, listmix.ColumnSorterMixin):
         ident = self._uuidCounter
         self._uuidCounter += 1
         self._itemDataMap[ident] = img
+        self._identByPath[_normalise_path(img.get_filename())] = ident
         index = self._listCtrl.InsertStringItem(sys.maxint, a)
         self._listCtrl.SetStringItem(index, 1, b)
         self._listCtrl.SetStringItem(index, 2, c)
@@ -170,6 +223,31 @@ class ImageListCtrlPanel(wx.Panel, listmix.ColumnSorterMixin):
         for img in self._itemDataMap.values():
             yield img
 
+    def find_image(self, path):
+        """
+        Returns the image object for the file or None if it isn't in the list
+        """
+        # This is called from worker threads while the UI thread changes the
+        # list, so the image may have gone between the two lookups
+        ident = self._identByPath.get(_normalise_path(path))
+        if ident is None:
+            return None
+        return self._itemDataMap.get(ident)
+
+    def find_images(self, paths):
+        """
+        Returns a dictionary of the image object for each of the files that is
+        in the list, as of a single snapshot of it
+        """
+        identByPath = dict(self._identByPath)
+        itemDataMap = dict(self._itemDataMap)
+        found = {}
+        for path in paths:
+            img = itemDataMap.get(identByPath.get(_normalise_path(path)))
+            if img is not None:
+                found[path] = img
+        return found
+
     def _get_image_from_index(self, index):
         """
         Given the item index, e.g. m_itemIndex from an event, this
@@ -179,10 +257,27 @@ class ImageListCtrlPanel(wx.Panel, listmix.ColumnSorterMixin):
         return self._itemDataMap[ident]
         
     def rm_image(self, img):
-        for ident, image in self._itemDataMap.iteritems():
-            if img is image:
-                index = self._listCtrl.FindItemData(-1, ident)
+        self.rm_images([img])
+
+    def rm_images(self, imgs):
+        """
+        Remove a batch of images in one go, finding all of their items at
+        once and deleting them from the last up so that the indices of those
+        still to go don't move
+        """
+        idents = [ident for ident in (self._find_ident(img) for img in imgs) if ident is not None]
+        if len(idents) == 0:
+            return
+        indices = self._item_indices(idents)
+        self._listCtrl.Freeze()
+        try:
+            for index in sorted(indices.values(), reverse = True):
                 self._listCtrl.DeleteItem(index)
-                del self._itemDataMap[ident]
-                break
+        finally:
+            self._listCtrl.Thaw()
+        for ident in idents:
+            img = self._itemDataMap.pop(ident)
+            self._identByPath.pop(_normalise_path(img.get_filename()), None)
+        # The items after those deleted have moved
+        self._indexByIdent = {}
 
@@ -0,0 +1,211 @@
+"""
+The work involved in importing a file into the working directory (copying it
+and losslessly rotating it), kept separate from the GUI. Each function takes
+an ImportJob and returns it so that they can be used as the stages of an
+import pipeline.
+"""
+import os, sys
+from subprocess import Popen, PIPE
+import filecopy
+from hashindex import partial_hash, CHECK_OFF
+from jpegexif import read_orientation, write_orientation, JpegExifUnsafe
+
+_DEBUG = True
+
+# Define the jpegtran command-line options to losslessly correct
+# the possible orientations for an image
+_jpegtranOptions = [
+    None, # 0 - not present
+    [], # 1 - no translation
+    ["-flip", "horizontal"], # 2 - Shouldn't get this with a photo?
+    ["-rotate", "180"], # 3 - Camera was upside down!
+    ["-flip", "vertical"], # 4 - Shouldn't get this with a photo?
+    ["-transpose"], # 5 - Shouldn't get this with a photo?
+    ["-rotate", "90"], # 6 - Camera was on its side
+    ["-transverse"], # 7 - Shouldn't get this with a photo?
+    ["-rotate", "270"], # 8 - Camera was on its other side
+]
+
+_jpegExtensions = [".jpg", ".jpeg"]
+
+class RotateError(Exception): pass
+
+class ImportJob(object):
+    """
+    A single file being imported. process indicates that it is an image (so
+    its metadata is to be loaded) and rotate that it should be losslessly
+    rotated according to its orientation flag.
+    """
+    def __init__(self, srcFile, workingDir, process, useJpegtran):
+        self.srcFile = srcFile
+        self.filename = os.path.basename(srcFile)
+        self.destFile = os.path.join(workingDir, self.filename)
+        self.process = process
+        ext = os.path.splitext(self.filename)[1].lower()
+        self.rotate = process and useJpegtran and ext in _jpegExtensions
+        # The size and the partial and full hashes of the source file, once it
+        # has been copied
+        self.size = None
+        self.partial = None
+        self.hash = None
+        # Set when resuming an import to skip stages that have already been done
+        self.copied = False
+        self.rotated = False
+        # Problems that didn't stop the file being imported
+        self.warnings = []
+
+    def __str__(self):
+        return self.srcFile
+
+def copy_file(job):
+    if job.copied:
+        return job
+    if os.path.exists(job.destFile):
+        # User must have OK'd this so delete the destination file then copy the new one into place
+        os.remove(job.destFile)
+    job.hash = filecopy.copy_file(job.srcFile, job.destFile)
+    job.size = os.path.getsize(job.destFile)
+    job.partial = partial_hash(job.destFile)
+    job.copied = True
+    return job
+
+def rotate_file(job, jpegtran = "jpegtran"):
+    """
+    Losslessly rotate the imported copy according to its orientation flag.
+    jpegtran writes to a temporary file, which only replaces the copy once it
+    is complete; if anything goes wrong, RotateError is raised and the copy is
+    left as it was.
+
+    Each call runs its own jpegtran process, so calling this from several
+    threads (such as the workers of the rotate stage of the pipeline) rotates
+    files in parallel across the CPUs.
+    """
+    if not job.rotate or job.rotated:
+        return job
+    destFile = job.destFile
+    try:
+        orient = read_orientation(destFile)
+    except JpegExifUnsafe, e:
+        if _DEBUG: print destFile, "- unable to read orientation:", e
+        orient = None
+    except (IOError, OSError), e:
+        raise RotateError("Unable to read the orientation: %s" % e)
+    if orient is None or orient >= len(_jpegtranOptions):
+        # No (valid) orientation flag? Set orient to the value that prevents any further work
+        orient = 1
+    if orient > 1:
+        if _DEBUG: print destFile, "- using option:", _jpegtranOptions[orient]
+        tmpFile = destFile + ".pgtips~.jpg"
+        try:
+            try:
+                p = Popen([jpegtran, "-copy", "all"] + _jpegtranOptions[orient] + ["-outfile", tmpFile, destFile],
+                          stdin = PIPE, stdout = PIPE, stderr = PIPE)
+            except OSError, e:
+                raise RotateError("Unable to run %s: %s" % (jpegtran, e))
+            stdout, stderr = p.communicate()
+            if p.returncode != 0:
+                raise RotateError("jpegtran failed (%d): %s" % (p.returncode, stderr.strip()))
+
+            # jpegtran copies the EXIF data as it is so the orientation needs resetting
+            try:
+                write_orientation(tmpFile, 1)
+            except (JpegExifUnsafe, IOError, OSError), e:
+                raise RotateError("Unable to reset the orientation: %s" % e)
+
+            try:
+                if sys.platform == "win32":
+                    # os.rename() won't replace an existing file on Windows
+                    os.remove(destFile)
+                os.rename(tmpFile, destFile)
+            except OSError, e:
+                raise RotateError("Unable to replace the copy with the rotated one: %s" % e)
+        finally:
+            # The rotated file is only kept if it's all there is (i.e. the
+            # copy was removed on Windows but the rename then failed)
+            if os.path.exists(tmpFile) and os.path.exists(destFile):
+                try:
+                    os.remove(tmpFile)
+                except OSError, e:
+                    if _DEBUG: print tmpFile, "- unable to remove:", e
+    job.rotated = True
+    return job
+
+class ImportPlan(object):
+    """
+    The result of walking the source of an import, with every file found
+    classified as one of:
+    - new: to be imported
+    - resumed: partially or completely imported by an import being resumed
+    - identical: (job, path) pairs of files already held at path
+    - conflicts: (job, reason) pairs of files whose destination is already
+      taken by a different file; those to be imported anyway (overwriting the
+      destination) are moved to overwrite
+    """
+    def __init__(self, fromDir, workingDir):
+        self.fromDir = fromDir
+        self.workingDir = workingDir
+        self.new = []
+        self.resumed = []
+        self.identical = []
+        self.conflicts = []
+        self.overwrite = []
+
+    def resolve_conflicts(self, overwrite):
+        """
+        Given the indices of the conflicts that are to be overwritten, move
+        those to be overwritten and drop the rest
+        """
+        for n in overwrite:
+            job = self.conflicts[n][0]
+            # If the clash is with another file being imported, this one replaces it
+            self.new = [j for j in self.new if j.destFile != job.destFile]
+            self.overwrite = [j for j in self.overwrite if j.destFile != job.destFile]
+            self.overwrite.append(job)
+        self.conflicts = []
+
+    def jobs(self):
+        return self.resumed + self.new + self.overwrite
+
+def plan_import(fromDir, workingDir, imageExtensions, otherExtensions, useJpegtran,
+                hashIndex = None, duplicateCheck = CHECK_OFF,
+                journal = None, records = {}, cancelled = lambda: False):
+    """
+    Walk the source and classify each file that is to be imported, returning
+    an ImportPlan. No files are copied and no questions are asked, so the
+    whole plan can be checked and then run in one go.
+    """
+    plan = ImportPlan(fromDir, workingDir)
+    planned = set()
+    for dirpath, dirnames, filenames in os.walk(fromDir):
+        if cancelled():
+            break
+        for f in filenames:
+            ext = os.path.splitext(f)[1].lower()
+            copy = False
+            process = False
+            if ext in otherExtensions or len(otherExtensions) == 0:
+                copy = True
+            if ext in imageExtensions or len(imageExtensions) == 0:
+                copy = True
+                process = True
+            if not copy:
+                continue
+            job = ImportJob(os.path.join(dirpath, f), workingDir, process, useJpegtran)
+            record = records.get(job.srcFile)
+            if record is not None and journal.restore(job, record):
+                plan.resumed.append(job)
+                planned.add(job.destFile)
+                continue
+            duplicate = None
+            if hashIndex is not None:
+                duplicate = hashIndex.find_duplicate(job.srcFile, duplicateCheck)
+            if duplicate is not None:
+                plan.identical.append((job, duplicate))
+            elif job.destFile in planned:
+                plan.conflicts.append((job, "another file being imported has the same name"))
+            elif os.path.exists(job.destFile):
+                plan.conflicts.append((job, "already exists in the working directory"))
+            else:
+                plan.new.append(job)
+                planned.add(job.destFile)
+    return plan
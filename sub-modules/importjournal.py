@@ -0,0 +1,153 @@
+"""
+An append-only journal of an import, recording the plan (where the files are
+being imported from and to) and how far each file has got. If PGTips stops
+part way through an import, the journal allows it to be resumed without
+copying again the files that were completed.
+"""
+import os, threading
+from hashindex import partial_hash
+
+_DEBUG = True
+
+# The states that a file goes through, in order
+PLANNED = "PLANNED"
+COPIED = "COPIED"
+ROTATED = "ROTATED"
+LOADED = "LOADED"
+_STATES = [PLANNED, COPIED, ROTATED, LOADED]
+
+_PLAN = "PLAN"
+
+class _Record(object):
+    def __init__(self, state, destFile, size, partial, hash):
+        self.state = state
+        self.destFile = destFile
+        self.size = size
+        self.partial = partial
+        self.hash = hash
+        # The size and partial hash of the file in the working directory as
+        # of its latest state, which differ from the original once rotated
+        self.outputSize = size
+        self.outputPartial = partial
+
+class ImportJournal(object):
+    def __init__(self, journalFile):
+        self._journalFile = journalFile
+        self._lock = threading.Lock()
+        self._f = None
+
+    def unfinished(self):
+        """
+        Returns the (fromDir, workingDir) of an import that didn't finish, or
+        None if there isn't one
+        """
+        if not os.path.isfile(self._journalFile):
+            return None
+        with open(self._journalFile) as f:
+            fields = f.readline().rstrip("\n").split("\t")
+        if len(fields) != 3 or fields[0] != _PLAN:
+            return None
+        return fields[1], fields[2]
+
+    def _read_records(self):
+        records = {}
+        with open(self._journalFile) as f:
+            f.readline()
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                try:
+                    state, srcFile, destFile, size, partial, hash = fields
+                    size = int(size)
+                    if state not in _STATES:
+                        raise ValueError(state)
+                except ValueError:
+                    # Most likely the final line was only partially written
+                    if _DEBUG: print self._journalFile, "- ignoring invalid line:", line
+                    continue
+                previous = records.get(srcFile)
+                if previous is not None and destFile == "":
+                    # Later states only record the change of state, along
+                    # with the file as it now is if that was changed
+                    previous.state = state
+                    if partial != "":
+                        previous.outputSize = size
+                        previous.outputPartial = partial
+                else:
+                    records[srcFile] = _Record(state, destFile, size, partial or None, hash or None)
+        return records
+
+    def start(self, fromDir, workingDir, resume = False):
+        """
+        Start the journal for a new import or, if resume is set, continue the
+        existing one, returning the records of the files that it contains
+        """
+        records = {}
+        if resume:
+            records = self._read_records()
+            self._f = open(self._journalFile, "a")
+        else:
+            self._f = open(self._journalFile, "w")
+            self._write(_PLAN, fromDir, workingDir)
+        return records
+
+    def _write(self, *fields):
+        with self._lock:
+            # Stages may still be recording their progress once the import
+            # has been finished
+            if self._f is not None:
+                self._f.write("\t".join(fields) + "\n")
+                self._f.flush()
+
+    def record(self, job, state):
+        if state in (PLANNED, COPIED):
+            self._write(state, job.srcFile, job.destFile, str(job.size or 0), job.partial or "", job.hash or "")
+        elif state == ROTATED and job.rotate:
+            # Rotating rewrites the copy, so its new contents are what a
+            # resumed import has to check
+            self._write(state, job.srcFile, "", str(os.path.getsize(job.destFile)), partial_hash(job.destFile), "")
+        else:
+            self._write(state, job.srcFile, "", "0", "", "")
+
+    def _verify(self, destFile, record):
+        """
+        Returns whether the file is as it was when its latest state was recorded
+        """
+        if record.outputPartial is None:
+            return False
+        try:
+            return (os.path.getsize(destFile) == record.outputSize and
+                    partial_hash(destFile) == record.outputPartial)
+        except (IOError, OSError):
+            return False
+
+    def restore(self, job, record):
+        """
+        Bring the job up to date with the state of the file in the journal,
+        returning False if the file has to be imported again from scratch. In
+        that case anything left at the destination by the unfinished import
+        is deleted, so that the file is simply copied again.
+        """
+        if record.destFile != job.destFile:
+            return False
+        if _STATES.index(record.state) >= _STATES.index(COPIED) and self._verify(job.destFile, record):
+            job.copied = True
+            job.size = record.size
+            job.partial = record.partial
+            job.hash = record.hash
+            job.rotated = record.state != COPIED
+            return True
+        if os.path.exists(job.destFile):
+            try:
+                os.remove(job.destFile)
+            except OSError, e:
+                # It will be reported as a clash instead
+                if _DEBUG: print job.destFile, "- unable to remove the unfinished copy:", e
+        return False
+
+    def finish(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+        if os.path.exists(self._journalFile):
+            os.remove(self._journalFile)
@@ -0,0 +1,424 @@
+"""
+In-process access to the EXIF data held in the APP1 segment of a JPEG file.
+
+This avoids the cost of launching exiftool (and having it rewrite the whole
+file through Perl) for the small, well-defined changes that PGTips makes. It
+only handles the common layouts; anything unexpected raises JpegExifUnsafe so
+that the caller can fall back to exiftool.
+"""
+import os, sys, struct, shutil
+
+class JpegExifUnsafe(Exception): pass
+
+_APP1 = 0xe1
+_SOS = 0xda
+_EOI = 0xd9
+_EXIF_HEADER = "Exif\x00\x00"
+
+# The maximum size of the payload of a JPEG segment (the length field includes itself)
+_MAX_SEGMENT = 0xffff - 2
+
+# Size, in bytes, of each of the TIFF field types
+_typeSizes = {
+        1: 1,  # BYTE
+        2: 1,  # ASCII
+        3: 2,  # SHORT
+        4: 4,  # LONG
+        5: 8,  # RATIONAL
+        6: 1,  # SBYTE
+        7: 1,  # UNDEFINED
+        8: 2,  # SSHORT
+        9: 4,  # SLONG
+        10: 8, # SRATIONAL
+        11: 4, # FLOAT
+        12: 8, # DOUBLE
+        }
+
+_BYTE, _ASCII, _SHORT, _LONG, _RATIONAL = 1, 2, 3, 4, 5
+
+_ORIENTATION = 0x0112
+_GPS_IFD_POINTER = 0x8825
+
+_GPS_VERSION_ID = 0
+_GPS_LATITUDE_REF = 1
+_GPS_LATITUDE = 2
+_GPS_LONGITUDE_REF = 3
+_GPS_LONGITUDE = 4
+_GPS_ALTITUDE_REF = 5
+_GPS_ALTITUDE = 6
+
+# Denominators used when encoding the GPS rationals; seconds of arc to
+# 1/10000 is a few millimetres, which is well beyond any GPS receiver
+_SECONDS_DENOMINATOR = 10000
+_ALTITUDE_DENOMINATOR = 1000
+
+# Tolerance (in degrees and metres) when verifying a written geotag
+_VERIFY_TOLERANCE = 1e-5
+
+def _find_exif_segment(f):
+    """
+    Walk the segments at the start of the JPEG file, returning the offset of
+    the APP1 marker holding the EXIF data along with the segment payload
+    """
+    f.seek(0)
+    if f.read(2) != "\xff\xd8":
+        raise JpegExifUnsafe("Not a JPEG file")
+    while True:
+        offset = f.tell()
+        header = f.read(4)
+        if len(header) < 2 or header[0] != "\xff":
+            raise JpegExifUnsafe("Corrupt JPEG segment at %d" % offset)
+        marker = ord(header[1])
+        if marker in (_SOS, _EOI):
+            raise JpegExifUnsafe("No EXIF segment")
+        if len(header) < 4:
+            raise JpegExifUnsafe("Truncated JPEG segment at %d" % offset)
+        length = struct.unpack(">H", header[2:])[0]
+        if length < 2:
+            raise JpegExifUnsafe("Invalid JPEG segment length at %d" % offset)
+        if marker == _APP1:
+            payload = f.read(length - 2)
+            if len(payload) != length - 2:
+                raise JpegExifUnsafe("Truncated APP1 segment")
+            if payload.startswith(_EXIF_HEADER):
+                return offset, payload
+        else:
+            f.seek(length - 2, 1)
+
+class _Tiff(object):
+    """
+    A wrapper around the TIFF structure inside an EXIF APP1 segment. Entries are
+    represented as (tag, type, count, valueBytes) tuples with the value bytes
+    in the file's byte order.
+    """
+    def __init__(self, data):
+        self.data = data
+        if data[:4] == "II*\x00":
+            self.endian = "<"
+        elif data[:4] == "MM\x00*":
+            self.endian = ">"
+        else:
+            raise JpegExifUnsafe("Invalid TIFF header")
+        self.ifd0Offset = self.unpack("L", 4)[0]
+
+    def unpack(self, fmt, offset):
+        fmt = self.endian + fmt
+        end = offset + struct.calcsize(fmt)
+        if offset < 0 or end > len(self.data):
+            raise JpegExifUnsafe("Offset %d outside EXIF data" % offset)
+        return struct.unpack(fmt, self.data[offset:end])
+
+    def read_ifd(self, offset):
+        """
+        Returns the entries in the IFD at the given offset along with the offset
+        of the next IFD (zero if there isn't one)
+        """
+        count = self.unpack("H", offset)[0]
+        entries = []
+        for n in range(count):
+            entryOffset = offset + 2 + 12 * n
+            tag, typ, num = self.unpack("HHL", entryOffset)
+            try:
+                size = _typeSizes[typ] * num
+            except KeyError:
+                raise JpegExifUnsafe("Unknown TIFF type %d for tag 0x%04x" % (typ, tag))
+            if size <= 4:
+                value = self.data[entryOffset + 8:entryOffset + 8 + size]
+            else:
+                valueOffset = self.unpack("L", entryOffset + 8)[0]
+                if valueOffset + size > len(self.data):
+                    raise JpegExifUnsafe("Value of tag 0x%04x outside EXIF data" % tag)
+                value = self.data[valueOffset:valueOffset + size]
+            entries.append((tag, typ, num, value))
+        nextIfd = self.unpack("L", offset + 2 + 12 * count)[0]
+        return entries, nextIfd
+
+    def find_entry(self, ifdOffset, tag):
+        """
+        Returns the offset of the entry for the tag in the IFD, or None
+        """
+        count = self.unpack("H", ifdOffset)[0]
+        for n in range(count):
+            entryOffset = ifdOffset + 2 + 12 * n
+            if self.unpack("H", entryOffset)[0] == tag:
+                return entryOffset
+        return None
+
+    def pack_ifd(self, entries, offset, nextIfd = 0):
+        """
+        Serialise the entries as an IFD that will be placed at the given offset,
+        with any values that don't fit in the entry immediately following it
+        """
+        entries = sorted(entries)
+        valueOffset = offset + 2 + 12 * len(entries) + 4
+        ifd = [struct.pack(self.endian + "H", len(entries))]
+        values = []
+        for tag, typ, num, value in entries:
+            if len(value) <= 4:
+                field = value + "\x00" * (4 - len(value))
+            else:
+                field = struct.pack(self.endian + "L", valueOffset)
+                if len(value) % 2:
+                    value += "\x00"
+                values.append(value)
+                valueOffset += len(value)
+            ifd.append(struct.pack(self.endian + "HHL", tag, typ, num) + field)
+        ifd.append(struct.pack(self.endian + "L", nextIfd))
+        return "".join(ifd + values)
+
+    def pack_rationals(self, rationals):
+        return "".join(struct.pack(self.endian + "LL", n, d) for n, d in rationals)
+
+    def unpack_rationals(self, value):
+        fmt = self.endian + "LL"
+        rationals = []
+        for n in range(0, len(value), 8):
+            num, den = struct.unpack(fmt, value[n:n + 8])
+            if den == 0:
+                raise JpegExifUnsafe("Zero denominator in rational")
+            rationals.append(num / float(den))
+        return rationals
+
+def _dms(value):
+    """
+    Convert an unsigned decimal number of degrees into the (degrees, minutes,
+    seconds) rationals used by the GPS IFD
+    """
+    total = int(round(value * 3600 * _SECONDS_DENOMINATOR))
+    deg, rem = divmod(total, 3600 * _SECONDS_DENOMINATOR)
+    mins, secs = divmod(rem, 60 * _SECONDS_DENOMINATOR)
+    return [(deg, 1), (mins, 1), (secs, _SECONDS_DENOMINATOR)]
+
+def _gps_entries(tiff, geotag, existing, clearAltitude = False):
+    """
+    Merge the geotag into the existing GPS IFD entries (if any), returning the
+    new list of entries. As with exiftool, tags that aren't being set are left
+    alone and a missing altitude leaves any existing altitude in place, unless
+    clearAltitude is set. A geotag of None removes all of the entries but the
+    GPS version.
+    """
+    entries = dict((e[0], e) for e in existing)
+    entries.setdefault(_GPS_VERSION_ID, (_GPS_VERSION_ID, _BYTE, 4, "\x02\x03\x00\x00"))
+    if geotag is None:
+        # Only the version is kept, so that the GPS IFD can stay where it is
+        return [entries[_GPS_VERSION_ID]]
+    lat, lon, alt = geotag
+    entries[_GPS_LATITUDE_REF] = (_GPS_LATITUDE_REF, _ASCII, 2, "S\x00" if lat < 0 else "N\x00")
+    entries[_GPS_LATITUDE] = (_GPS_LATITUDE, _RATIONAL, 3, tiff.pack_rationals(_dms(abs(lat))))
+    entries[_GPS_LONGITUDE_REF] = (_GPS_LONGITUDE_REF, _ASCII, 2, "W\x00" if lon < 0 else "E\x00")
+    entries[_GPS_LONGITUDE] = (_GPS_LONGITUDE, _RATIONAL, 3, tiff.pack_rationals(_dms(abs(lon))))
+    if alt is None and clearAltitude:
+        entries.pop(_GPS_ALTITUDE_REF, None)
+        entries.pop(_GPS_ALTITUDE, None)
+    elif alt is not None:
+        entries[_GPS_ALTITUDE_REF] = (_GPS_ALTITUDE_REF, _BYTE, 1, "\x01" if alt < 0 else "\x00")
+        altitude = int(round(abs(alt) * _ALTITUDE_DENOMINATOR))
+        entries[_GPS_ALTITUDE] = (_GPS_ALTITUDE, _RATIONAL, 1, tiff.pack_rationals([(altitude, _ALTITUDE_DENOMINATOR)]))
+    return entries.values()
+
+def _decode_gps(tiff, entries):
+    """
+    Convert the GPS IFD entries into a (lat, lon, alt) tuple, or None if there
+    is no position
+    """
+    tags = dict((e[0], e[3]) for e in entries)
+    try:
+        d, m, s = tiff.unpack_rationals(tags[_GPS_LATITUDE])
+        lat = d + m / 60.0 + s / 3600.0
+        if tags[_GPS_LATITUDE_REF][:1] == "S":
+            lat = -lat
+        d, m, s = tiff.unpack_rationals(tags[_GPS_LONGITUDE])
+        lon = d + m / 60.0 + s / 3600.0
+        if tags[_GPS_LONGITUDE_REF][:1] == "W":
+            lon = -lon
+    except (KeyError, ValueError):
+        return None
+    try:
+        alt = tiff.unpack_rationals(tags[_GPS_ALTITUDE])[0]
+        if tags.get(_GPS_ALTITUDE_REF, "\x00")[:1] == "\x01":
+            alt = -alt
+    except (KeyError, IndexError):
+        alt = None
+    return lat, lon, alt
+
+def _read_gps(tiff):
+    entryOffset = tiff.find_entry(tiff.ifd0Offset, _GPS_IFD_POINTER)
+    if entryOffset is None:
+        return None, []
+    gpsOffset = tiff.unpack("L", entryOffset + 8)[0]
+    return entryOffset, tiff.read_ifd(gpsOffset)[0]
+
+def _set_gps(tiff, geotag, clearAltitude = False):
+    """
+    Returns the new TIFF data with the GPS IFD replaced. Where the existing GPS
+    IFD is laid out exactly as it would be written (as it is once PGTips has
+    written it) its extent is known, so a new one that is no larger (or any
+    new one, if the old one is at the end of the data) is written over it;
+    geotagging a file again therefore doesn't grow it.
+    Otherwise existing structures are never moved: the new GPS IFD (and, if
+    a pointer to it has to be added to IFD0, a new copy of IFD0) is appended
+    to the end of the data and the relevant offset patched, leaving the old
+    copy as unused space.
+    """
+    data = tiff.data
+    pointerOffset, existing = _read_gps(tiff)
+    if geotag is None and pointerOffset is None:
+        return data
+    entries = _gps_entries(tiff, geotag, existing, clearAltitude)
+
+    if pointerOffset is not None:
+        oldOffset = tiff.unpack("L", pointerOffset + 8)[0]
+        old = tiff.pack_ifd(existing, oldOffset)
+        gps = tiff.pack_ifd(entries, oldOffset)
+        if data[oldOffset:oldOffset + len(old)] == old:
+            rest = data[oldOffset + len(old):]
+            if rest.strip("\x00") == "":
+                # It's at the end (with only the padding left by a smaller one
+                # written over it), so the new one can be any size
+                return data[:oldOffset] + gps
+            if len(gps) <= len(old):
+                return data[:oldOffset] + gps + "\x00" * (len(old) - len(gps)) + rest
+
+    if pointerOffset is not None:
+        gpsOffset = len(data) + len(data) % 2
+        data = data + "\x00" * (gpsOffset - len(data)) + tiff.pack_ifd(entries, gpsOffset)
+        valueOffset = pointerOffset + 8
+        return data[:valueOffset] + struct.pack(tiff.endian + "L", gpsOffset) + data[valueOffset + 4:]
+
+    # The GPS IFD goes after the new copy of IFD0, at the end of the data,
+    # so that it can later be replaced by one of any size
+    ifd0, nextIfd = tiff.read_ifd(tiff.ifd0Offset)
+    pointer = lambda offset: (_GPS_IFD_POINTER, _LONG, 1, struct.pack(tiff.endian + "L", offset))
+    ifd0Offset = len(data) + len(data) % 2
+    gpsOffset = ifd0Offset + len(tiff.pack_ifd(ifd0 + [pointer(0)], ifd0Offset, nextIfd))
+    gpsOffset += gpsOffset % 2
+    data = data + "\x00" * (ifd0Offset - len(data)) + tiff.pack_ifd(ifd0 + [pointer(gpsOffset)], ifd0Offset, nextIfd)
+    data = data + "\x00" * (gpsOffset - len(data)) + tiff.pack_ifd(entries, gpsOffset)
+    return data[:4] + struct.pack(tiff.endian + "L", ifd0Offset) + data[8:]
+
+def _replace_file(tmpFile, filename):
+    shutil.copystat(filename, tmpFile)
+    if sys.platform == "win32":
+        # os.rename() won't replace an existing file on Windows
+        os.remove(filename)
+    os.rename(tmpFile, filename)
+
+def _rewrite_segment(filename, segmentOffset, oldPayload, newPayload, verify):
+    """
+    Write a copy of the file with the segment at the given offset replaced,
+    check it with the verify function and then move it over the original
+    """
+    if len(newPayload) > _MAX_SEGMENT:
+        raise JpegExifUnsafe("EXIF data would exceed the maximum segment size")
+    tmpFile = filename + ".pgtips~"
+    try:
+        with open(filename, "rb") as src:
+            with open(tmpFile, "wb") as dest:
+                dest.write(src.read(segmentOffset))
+                dest.write(struct.pack(">BBH", 0xff, _APP1, len(newPayload) + 2))
+                dest.write(newPayload)
+                src.seek(segmentOffset + 4 + len(oldPayload))
+                shutil.copyfileobj(src, dest, 1024 * 1024)
+        verify(tmpFile)
+        _replace_file(tmpFile, filename)
+    except:
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+        raise
+
+def same_geotag(old, new, tolerance = 1e-5, altitudeTolerance = 1.0):
+    """
+    Returns whether setting the new geotag on an image whose geotag is old
+    would leave it effectively unchanged, i.e. the latitudes and longitudes
+    differ by no more than tolerance (in degrees) and the altitudes by no more
+    than altitudeTolerance (in metres). The defaults are well below what a
+    GPS receiver can resolve.
+    """
+    if old is None or new is None:
+        return old is None and new is None
+    if abs(old[0] - new[0]) > tolerance or abs(old[1] - new[1]) > tolerance:
+        return False
+    if new[2] is None:
+        # No altitude is written so whatever is there stays there
+        return True
+    return old[2] is not None and abs(old[2] - new[2]) <= altitudeTolerance
+
+def _find_orientation(f):
+    """
+    Returns the TIFF data, the offset of the TIFF data in the file and the
+    offset of the orientation value within the TIFF data (or None if there is
+    no orientation tag)
+    """
+    segmentOffset, payload = _find_exif_segment(f)
+    tiff = _Tiff(payload[len(_EXIF_HEADER):])
+    # The segment marker and length precede the payload
+    tiffOffset = segmentOffset + 4 + len(_EXIF_HEADER)
+    entryOffset = tiff.find_entry(tiff.ifd0Offset, _ORIENTATION)
+    if entryOffset is None:
+        return tiff, tiffOffset, None
+    tag, typ, num = tiff.unpack("HHL", entryOffset)
+    if typ != _SHORT or num != 1:
+        raise JpegExifUnsafe("Unexpected orientation type %d (count %d)" % (typ, num))
+    return tiff, tiffOffset, entryOffset + 8
+
+def read_orientation(filename):
+    """
+    Returns the value of the orientation tag or None if the file doesn't have
+    one
+    """
+    with open(filename, "rb") as f:
+        tiff, tiffOffset, valueOffset = _find_orientation(f)
+    if valueOffset is None:
+        return None
+    return tiff.unpack("H", valueOffset)[0]
+
+def write_orientation(filename, orientation):
+    """
+    Set the value of an existing orientation tag. The tag is a fixed size so
+    this simply overwrites the two bytes in place.
+    """
+    with open(filename, "r+b") as f:
+        tiff, tiffOffset, valueOffset = _find_orientation(f)
+        if valueOffset is None:
+            raise JpegExifUnsafe("No orientation tag")
+        f.seek(tiffOffset + valueOffset)
+        f.write(struct.pack(tiff.endian + "H", orientation))
+
+def read_geotag(filename):
+    """
+    Returns the (lat, lon, alt) tuple from the file's GPS IFD or None if it
+    doesn't have one
+    """
+    with open(filename, "rb") as f:
+        segmentOffset, payload = _find_exif_segment(f)
+    tiff = _Tiff(payload[len(_EXIF_HEADER):])
+    return _decode_gps(tiff, _read_gps(tiff)[1])
+
+def write_geotag(filename, geotag, clearAltitude = False):
+    """
+    Set (or, if geotag is None, remove) the GPS position in the file's existing
+    EXIF data. A geotag without an altitude leaves any existing altitude in
+    place unless clearAltitude is set. The file is rewritten to a temporary file, which is re-read to
+    verify the geotag before it replaces the original. Raises JpegExifUnsafe,
+    leaving the original untouched, if the file's layout isn't one that can be
+    handled safely.
+    """
+    with open(filename, "rb") as f:
+        segmentOffset, payload = _find_exif_segment(f)
+    tiff = _Tiff(payload[len(_EXIF_HEADER):])
+    newTiff = _set_gps(tiff, geotag, clearAltitude)
+    if newTiff == tiff.data:
+        # Nothing to change
+        return
+
+    def verify(tmpFile):
+        written = read_geotag(tmpFile)
+        if not same_geotag(written, geotag, _VERIFY_TOLERANCE, _VERIFY_TOLERANCE) or \
+                (clearAltitude and written is not None and written[2] is not None):
+            raise JpegExifUnsafe("Verification failed: wrote %s but read back %s" % (geotag, written))
+
+    _rewrite_segment(filename, segmentOffset, payload, _EXIF_HEADER + newTiff, verify)
+
+if __name__ == "__main__":
+    for f in sys.argv[1:]:
+        print f, read_geotag(f)
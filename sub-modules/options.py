@@ -1,12 +1,18 @@
 import wx
 from subprocess import Popen, PIPE, STDOUT
 import os.path
+from hashindex import CHECKS
+from exporter import COLLISIONS, ARCHIVES
+from optionsfile import int_option, load_options, save_options
 
 _TEXT_WIDTH = 500
 _FILETYPES_TEXT = "PGTips handles individual files as being one of three types. Specify the file extensions that you want to be handled in that way.\n\nNote that specifying no filetypes in a box means that PGTips should attempt to handle all files that it encounters in that way."
 _DIRECTORIES_TEXT = "Specify the directories to be used by PGTips."
 _EXIFTOOL_TEXT = "EXIFtool is the de-facto standard tool for reading and writing EXIF data in images. At the time of writing, it supports the largest number of file formats (including most camera RAW formats) and provides the most complete support of tag types. It also supports two different structured interfaces (JSON and XML) to allow easy interfacing to other applications as well as its human interface. Hence, PGTips uses it to read information like the shooting date from your images and write back the geotagging infomation."
-_JPEGTRAN_TEXT = "jpegtran is an application that supports lossless operations on JPEG images. In particular, it allows JPEGs to be losslessly rotated.\n\nWhile PGTips doesn't require jpegtran, if it is available, it can be used to losslessly rotate (either manually or automatically, if the companion application jpegexiforient is also available) JPEGs if required."
+_IMPORT_TEXT = "Files are imported by a pipeline in which copying, lossless rotation and loading of the metadata all happen at the same time. Specify how many files can be worked on in parallel at each stage and how many files can be waiting between stages.\n\nA change to the number of metadata workers takes effect when PGTips is next started."
+_EXPORT_TEXT = "Files are exported into the filing directory by renaming them where it is on the same filesystem as the working directory. Otherwise, several files are copied at the same time and each copy is checked and safely written to disk before the file in the working directory is removed.\n\nExported files can also be written into a tar or zip archive (e.g. for an off-site backup) as they are filed, or instead of being filed."
+_GEOTAG_TEXT = "Photos are geotagged by matching the time that they were taken against the GPS tracks. If the camera's clock was wrong (e.g. it was set to a different time zone or has drifted), set how far out it was here, or use Geotag->Estimate camera clock offset to work it out from the tracks.\n\nThe place nearest to where a photo was taken is found from a local gazetteer (e.g. cities1000.txt from GeoNames), indexed by Tools->Index gazetteer, so that photos can be filed by place."
+_JPEGTRAN_TEXT = "jpegtran is an application that supports lossless operations on JPEG images. In particular, it allows JPEGs to be losslessly rotated.\n\nWhile PGTips doesn't require jpegtran, if it is available, it can be used to losslessly rotate (either manually or automatically, according to their orientation flag) JPEGs if required."
 
 def _split_csl(csl, prefix = ""):
     l1 = [e.strip() for e in csl.split(",")]
@@ -38,6 +44,18 @@ class OptionsDialog(wx.Dialog):
         hSizer.Add(ctrl, 1, wx.EXPAND, 0)
         sizer.Add(hSizer, 1 if multiline else 0, wx.EXPAND | wx.TOP, border)
 
+    def _create_labelled_choice(self, parent, label, sizer, ctrlAttr, choices, border = 3, tooltip = None):
+        label = wx.StaticText(parent, -1, label)
+        label.Wrap(_TEXT_WIDTH/2)
+        ctrl = wx.Choice(parent, -1, choices = choices)
+        setattr(self, ctrlAttr, ctrl)
+        if tooltip is not None:
+            ctrl.SetToolTip(wx.ToolTip(tooltip))
+        hSizer = wx.BoxSizer(wx.HORIZONTAL)
+        hSizer.Add(label, 1, wx.ALIGN_RIGHT | wx.ALIGN_CENTRE_VERTICAL, 0)
+        hSizer.Add(ctrl, 1, wx.EXPAND, 0)
+        sizer.Add(hSizer, 0, wx.EXPAND | wx.TOP, border)
+
     def _create_filetypes_page(self):
         self.filetypesPage = wx.Panel(self.categoryNotebook, -1)
         explanation = wx.StaticText(self.filetypesPage, -1, _FILETYPES_TEXT)
@@ -68,6 +86,14 @@ class OptionsDialog(wx.Dialog):
                 border = 10,
                 tooltip = "'Other' files are additional file types (e.g. Video files) that will be imported and filed but otherwise will not be processed",
                 multiline = True)
+        self._create_labelled_text_ctrl(
+                self.filetypesPage,
+                "Sidecar geotag extensions:",
+                vSizer,
+                "_sidecarExtTextCtrl",
+                border = 10,
+                tooltip = "Image files (typically camera RAW files) with these extensions are geotagged by writing an XMP sidecar file next to them rather than by modifying the file itself",
+                multiline = True)
         self.filetypesPage.SetSizer(vSizer)
         return self.filetypesPage
 
@@ -75,6 +101,7 @@ class OptionsDialog(wx.Dialog):
         self._imageExtTextCtrl.SetValue(", ".join([e.lstrip('.') for e in self.options["ImageExtensions"]]))
         self._gpsExtTextCtrl.SetValue(", ".join([e.lstrip('.') for e in self.options["GpsExtensions"]]))
         self._otherExtTextCtrl.SetValue(", ".join([e.lstrip('.') for e in self.options["OtherExtensions"]]))
+        self._sidecarExtTextCtrl.SetValue(", ".join([e.lstrip('.') for e in self.options["SidecarExtensions"]]))
 
     def _update_filetypes_options(self):
         v = str(self._imageExtTextCtrl.GetValue().lower())
@@ -83,6 +110,8 @@ class OptionsDialog(wx.Dialog):
         self.options["GpsExtensions"] = _split_csl(v, prefix = ".")
         v = str(self._otherExtTextCtrl.GetValue().lower())
         self.options["OtherExtensions"] = _split_csl(v, prefix = ".")
+        v = str(self._sidecarExtTextCtrl.GetValue().lower())
+        self.options["SidecarExtensions"] = _split_csl(v, prefix = ".")
 
     def _create_directories_page(self):
         self.directoriesPage = wx.Panel(self.categoryNotebook, -1)
@@ -110,7 +139,15 @@ class OptionsDialog(wx.Dialog):
                 vSizer,
                 "_filingStruct",
                 border = 10,
-                tooltip = "This is the directory structure to create underneath the filing directory above")
+                tooltip = "This is the directory structure to create underneath the filing directory above. As well as the date and time fields (e.g. %Y), {country}, {region} and {place} are filled in from the place nearest to where the photo was taken")
+        self._create_labelled_text_ctrl(
+                self.directoriesPage,
+                "Mirror directories:",
+                vSizer,
+                "_filingMirrors",
+                border = 10,
+                tooltip = "Files are also filed under each of these directories (one per line), in the same structure, as they are exported. Each file is read once and copied to all of them at the same time, and is only removed from the working directory once every copy has been checked",
+                multiline = True)
         self.directoriesPage.SetSizer(vSizer)
         return self.directoriesPage
 
@@ -118,13 +155,215 @@ class OptionsDialog(wx.Dialog):
         self._workingDir.SetValue(self.options["WorkingDir"])
         self._filingDir.SetValue(self.options["FilingDir"])
         self._filingStruct.SetValue(self.options["FilingStruct"])
+        self._filingMirrors.SetValue("\n".join(self.options["FilingMirrors"]))
 
     def _update_directories_options(self):
         self.options["WorkingDir"] = os.path.normpath(self._workingDir.GetValue())
         self.options["FilingDir"] = os.path.normpath(self._filingDir.GetValue())
         self.options["FilingStruct"] = os.path.normpath(self._filingStruct.GetValue())
+        self.options["FilingMirrors"] = [os.path.normpath(d.strip()) for d in self._filingMirrors.GetValue().splitlines()
+                                         if d.strip() != ""]
         pass
 
+    def _create_import_page(self):
+        self.importPage = wx.Panel(self.categoryNotebook, -1)
+        explanation = wx.StaticText(self.importPage, -1, _IMPORT_TEXT)
+        explanation.Wrap(_TEXT_WIDTH)
+
+        vSizer = wx.BoxSizer(wx.VERTICAL)
+        vSizer.Add(explanation, 0, wx.TOP, 3)
+        self._create_labelled_text_ctrl(
+                self.importPage,
+                "Copy workers:",
+                vSizer,
+                "_importCopyWorkers",
+                tooltip = "The number of files that are copied from the source at the same time")
+        self._create_labelled_text_ctrl(
+                self.importPage,
+                "Rotation workers:",
+                vSizer,
+                "_importRotateWorkers",
+                tooltip = "The number of JPEGs that are losslessly rotated at the same time; this is CPU bound so defaults to the number of CPUs")
+        self._create_labelled_text_ctrl(
+                self.importPage,
+                "Metadata workers:",
+                vSizer,
+                "_importMetadataWorkers",
+                tooltip = "The number of batches of files for which the metadata is read by EXIFtool at the same time")
+        self._create_labelled_text_ctrl(
+                self.importPage,
+                "Queue size:",
+                vSizer,
+                "_importQueueSize",
+                tooltip = "The maximum number of files waiting between each stage of the import")
+        self._create_labelled_text_ctrl(
+                self.importPage,
+                "Metadata batch size:",
+                vSizer,
+                "_importBatchSize",
+                tooltip = "The number of files for which EXIFtool is asked to read the metadata at once")
+        self._create_labelled_text_ctrl(
+                self.importPage,
+                "Metadata batch wait (ms):",
+                vSizer,
+                "_importBatchLatency",
+                border = 10,
+                tooltip = "The longest time that a file waits for others to fill its batch before the metadata is read anyway")
+        self._create_labelled_choice(
+                self.importPage,
+                "Skip files already held:",
+                vSizer,
+                "_importDuplicateCheck",
+                CHECKS,
+                border = 10,
+                tooltip = "Files that are already in the working or filing directories are not imported again. 'Quick' compares the size and the start and end of the files; 'Full' also compares the whole of the files, which means reading every file being imported")
+        self.importPage.SetSizer(vSizer)
+        return self.importPage
+
+    def _populate_import_options(self):
+        self._importCopyWorkers.SetValue(str(self.options["ImportCopyWorkers"]))
+        self._importRotateWorkers.SetValue(str(self.options["ImportRotateWorkers"]))
+        self._importMetadataWorkers.SetValue(str(self.options["ImportMetadataWorkers"]))
+        self._importQueueSize.SetValue(str(self.options["ImportQueueSize"]))
+        self._importBatchSize.SetValue(str(self.options["ImportBatchSize"]))
+        self._importBatchLatency.SetValue(str(self.options["ImportBatchLatency"]))
+        self._importDuplicateCheck.SetStringSelection(self.options["ImportDuplicateCheck"])
+
+    def _update_import_options(self):
+        for name, ctrl in [
+                ("ImportCopyWorkers", self._importCopyWorkers),
+                ("ImportRotateWorkers", self._importRotateWorkers),
+                ("ImportMetadataWorkers", self._importMetadataWorkers),
+                ("ImportQueueSize", self._importQueueSize),
+                ("ImportBatchSize", self._importBatchSize),
+                ("ImportBatchLatency", self._importBatchLatency),
+                ]:
+            self.options[name] = int_option({name: ctrl.GetValue().strip()}, name)
+        self.options["ImportDuplicateCheck"] = self._importDuplicateCheck.GetStringSelection()
+
+    def _create_export_page(self):
+        self.exportPage = wx.Panel(self.categoryNotebook, -1)
+        explanation = wx.StaticText(self.exportPage, -1, _EXPORT_TEXT)
+        explanation.Wrap(_TEXT_WIDTH)
+
+        vSizer = wx.BoxSizer(wx.VERTICAL)
+        vSizer.Add(explanation, 0, wx.TOP, 3)
+        self._create_labelled_text_ctrl(
+                self.exportPage,
+                "Copy workers:",
+                vSizer,
+                "_exportCopyWorkers",
+                border = 10,
+                tooltip = "The number of files that are copied to the filing directory at the same time when it is on a different filesystem (e.g. a NAS)")
+        self._create_labelled_choice(
+                self.exportPage,
+                "When a file is already filed:",
+                vSizer,
+                "_exportCollisions",
+                COLLISIONS,
+                border = 10,
+                tooltip = "What to do when a file of the same name is already in the filing directory. Other than 'Ask', files identical to the one already filed are not exported and the rest are skipped, renamed with a numbered suffix or replace the filed file if they are newer, and the clashes are reported at the end")
+        self._create_labelled_choice(
+                self.exportPage,
+                "Archive:",
+                vSizer,
+                "_exportArchive",
+                ARCHIVES,
+                border = 10,
+                tooltip = "The kind of archive that exported files are also written to, laid out as they are in the filing directory. Clashes can't be asked about while an archive is written, so files that clash are skipped if 'Ask' is chosen above")
+        self._create_labelled_text_ctrl(
+                self.exportPage,
+                "Archive directory:",
+                vSizer,
+                "_exportArchiveDir",
+                tooltip = "The directory in which an archive is created for each export")
+        self._create_labelled_text_ctrl(
+                self.exportPage,
+                "Archive volume size (MB):",
+                vSizer,
+                "_exportArchiveVolumeSize",
+                tooltip = "The size at which an archive is split into volumes, each of which is a complete archive; 0 means that it isn't split")
+        self._exportArchiveOnly = wx.CheckBox(self.exportPage, -1, "Only write the archive")
+        self._exportArchiveOnly.SetToolTip(wx.ToolTip("Write the files to the archive without filing them, leaving them in the working directory"))
+        vSizer.Add(self._exportArchiveOnly, 0, wx.TOP | wx.ALIGN_LEFT, 3)
+        self.exportPage.SetSizer(vSizer)
+        return self.exportPage
+
+    def _populate_export_options(self):
+        self._exportCopyWorkers.SetValue(str(self.options["ExportCopyWorkers"]))
+        self._exportCollisions.SetStringSelection(self.options["ExportCollisions"])
+        self._exportArchive.SetStringSelection(self.options["ExportArchive"])
+        self._exportArchiveDir.SetValue(self.options["ExportArchiveDir"])
+        self._exportArchiveVolumeSize.SetValue(str(self.options["ExportArchiveVolumeSize"]))
+        self._exportArchiveOnly.SetValue(self.options["ExportArchiveOnly"])
+
+    def _update_export_options(self):
+        for name, ctrl in [
+                ("ExportCopyWorkers", self._exportCopyWorkers),
+                ]:
+            self.options[name] = int_option({name: ctrl.GetValue().strip()}, name)
+        self.options["ExportCollisions"] = self._exportCollisions.GetStringSelection()
+        self.options["ExportArchive"] = self._exportArchive.GetStringSelection()
+        v = self._exportArchiveDir.GetValue()
+        self.options["ExportArchiveDir"] = os.path.normpath(v) if v != "" else ""
+        self.options["ExportArchiveVolumeSize"] = int_option({"ExportArchiveVolumeSize": self._exportArchiveVolumeSize.GetValue().strip()},
+                                                             "ExportArchiveVolumeSize")
+        self.options["ExportArchiveOnly"] = self._exportArchiveOnly.GetValue()
+
+    def _create_geotag_page(self):
+        self.geotagPage = wx.Panel(self.categoryNotebook, -1)
+        explanation = wx.StaticText(self.geotagPage, -1, _GEOTAG_TEXT)
+        explanation.Wrap(_TEXT_WIDTH)
+
+        vSizer = wx.BoxSizer(wx.VERTICAL)
+        vSizer.Add(explanation, 0, wx.TOP, 3)
+        self._create_labelled_text_ctrl(
+                self.geotagPage,
+                "Camera clock offset (s):",
+                vSizer,
+                "_geotagClockOffset",
+                tooltip = "The number of seconds added to the time that a photo was taken before matching it against the GPS tracks; negative if the camera's clock was fast")
+        self._create_labelled_text_ctrl(
+                self.geotagPage,
+                "Offset search range (hours):",
+                vSizer,
+                "_geotagOffsetRange",
+                border = 10,
+                tooltip = "How far either way the camera's clock can be out when estimating the offset")
+        self._create_labelled_text_ctrl(
+                self.geotagPage,
+                "Place index:",
+                vSizer,
+                "_placeIndex",
+                border = 10,
+                tooltip = "The index of the gazetteer that places are looked up in, as written by Tools->Index gazetteer")
+        self._create_labelled_text_ctrl(
+                self.geotagPage,
+                "Maximum distance to a place (km):",
+                vSizer,
+                "_placeMaxDistance",
+                border = 10,
+                tooltip = "Photos taken further than this from any place in the gazetteer are filed under Unknown")
+        self.geotagPage.SetSizer(vSizer)
+        return self.geotagPage
+
+    def _populate_geotag_options(self):
+        self._geotagClockOffset.SetValue(str(self.options["GeotagClockOffset"]))
+        self._geotagOffsetRange.SetValue(str(self.options["GeotagOffsetRange"]))
+        self._placeIndex.SetValue(self.options["PlaceIndex"])
+        self._placeMaxDistance.SetValue(str(self.options["PlaceMaxDistance"]))
+
+    def _update_geotag_options(self):
+        try:
+            self.options["GeotagClockOffset"] = int(self._geotagClockOffset.GetValue().strip() or 0)
+        except ValueError:
+            pass
+        self.options["GeotagOffsetRange"] = int_option({"GeotagOffsetRange": self._geotagOffsetRange.GetValue().strip()},
+                                                       "GeotagOffsetRange")
+        self.options["PlaceIndex"] = self._placeIndex.GetValue().strip()
+        self.options["PlaceMaxDistance"] = int_option({"PlaceMaxDistance": self._placeMaxDistance.GetValue().strip()},
+                                                      "PlaceMaxDistance")
+
     def _create_exiftool_page(self):
         self.exiftoolPage = wx.Panel(self.categoryNotebook, -1)
         explanation = wx.StaticText(self.exiftoolPage, -1, _EXIFTOOL_TEXT)
@@ -182,7 +421,7 @@ class OptionsDialog(wx.Dialog):
         self.jpegtranPage = wx.Panel(self.categoryNotebook, -1)
         explanation = wx.StaticText(self.jpegtranPage, -1, _JPEGTRAN_TEXT)
         explanation.Wrap(_TEXT_WIDTH)
-        self._jpegtranEnable = wx.CheckBox(self.jpegtranPage, -1, "Enable jpegtran (and jpegexiforient)")
+        self._jpegtranEnable = wx.CheckBox(self.jpegtranPage, -1, "Enable jpegtran")
         self.Bind(wx.EVT_CHECKBOX, self._jpegtran_enabled, self._jpegtranEnable)
         self._jpegtranCheckCfg = wx.Button(self.jpegtranPage, -1, "Check configuration")
         self.Bind(wx.EVT_BUTTON, self._check_jpegtran_cfg, self._jpegtranCheckCfg)
@@ -198,7 +437,7 @@ class OptionsDialog(wx.Dialog):
         vSizer.Add(self._jpegtranEnable, 0, wx.TOP, 6)
         self._create_labelled_text_ctrl(
                 self.jpegtranPage,
-                "Path to jpegtran/jpegexiforient:",
+                "Path to jpegtran:",
                 vSizer,
                 "_jpegtranPath",
                 tooltip = "If jpegtran is in your path, simply leave this blank. Once you've completed the configuration, click 'Check Configuration' to see if PGTips is able to find the applications")
@@ -228,10 +467,8 @@ class OptionsDialog(wx.Dialog):
             self._jpegtranCheckText.SetValue("ERROR: '%s' is not a directory" % path)
             return
         jpegtran = "jpegtran"
-        jpegexiforient = "jpegexiforient"
         if path != "":
             jpegtran = os.path.join(path, jpegtran)
-            jpegexiforient = os.path.join(path, jpegexiforient)
         try:
             p = Popen([jpegtran, "-v"], stdin = PIPE, stdout = PIPE, stderr = STDOUT)
             stdout, stderr = p.communicate()
@@ -239,44 +476,11 @@ class OptionsDialog(wx.Dialog):
             self._jpegtranCheckText.SetValue("ERROR: Unable to execute '%s -v'" % jpegtran)
             return
         s = stdout.splitlines()[0:2]
-        try:
-            p = Popen([jpegexiforient, "--help"], stdin = PIPE, stdout = PIPE, stderr = STDOUT)
-            stdout, stderr = p.communicate()
-        except OSError:
-            self._jpegtranCheckText.SetValue("Semi-success: jpegtran worked fine but unable to execute '%s --help'. You will only be able to rotate JPEGS manually.\n\n" % jpegexiforient + "\n".join(s))
-            return
-        s.append("")
-        s += stdout.splitlines()[0:1]
         self._jpegtranCheckText.SetValue("SUCCESS! You can losslessly rotate JPEGs both automatically and manually.\n\n" + "\n".join(s))
 
     def __init__(self, *args, **kwds):
-        try:
-            self._optFile = kwds["optFile"]
-            del kwds["optFile"]
-            try:
-                o = file(self._optFile).read()
-            except IOError:
-                o = "{}"
-            readOpts = eval(o)
-        except KeyError:
-            self._optFile = None
-            readOpts = {}
-
-        # Set everything to the default values in the first case
-        self.options = {
-                "ImageExtensions" : [],
-                "GpsExtensions" : [],
-                "OtherExtensions" : [],
-                "WorkingDir" : "",
-                "FilingDir" : "",
-                "FilingStruct" : "%Y/%Y_%m/%Y_%m_%d",
-                "JpegtranEnabled": True,
-                "JpegtranPath": "",
-                "ExiftoolPath": "",
-                }
-
-        for k, v in readOpts.items():
-            self.options[k] = v
+        self._optFile = kwds.pop("optFile", None)
+        self.options = load_options(self._optFile)
 
         kwds["style"] = wx.DEFAULT_DIALOG_STYLE
         wx.Dialog.__init__(self, *args, **kwds)
@@ -296,6 +500,9 @@ class OptionsDialog(wx.Dialog):
         self._pages = [
                 ("Filetypes", self._create_filetypes_page, self._populate_filetypes_options, self._update_filetypes_options),
                 ("Directories", self._create_directories_page, self._populate_directories_options, self._update_directories_options),
+                ("Import", self._create_import_page, self._populate_import_options, self._update_import_options),
+                ("Export", self._create_export_page, self._populate_export_options, self._update_export_options),
+                ("Geotag", self._create_geotag_page, self._populate_geotag_options, self._update_geotag_options),
                 ("EXIFtool", self._create_exiftool_page, self._populate_exiftool_options, self._update_exiftool_options),
                 ("jpegtran", self._create_jpegtran_page, self._populate_jpegtran_options, self._update_jpegtran_options),
                 ]
@@ -337,10 +544,18 @@ class OptionsDialog(wx.Dialog):
         map(lambda x: x[3](), self._pages)
         map(lambda x: x[2](), self._pages)
         if self._optFile is not None:
-            with file(self._optFile, "w") as o:
-                o.write(repr(self.options))
+            save_options(self.options, self._optFile)
         evt.Skip()
 
+    def set_option(self, name, value):
+        """
+        Change an option other than through the dialog, saving the options
+        """
+        self.options[name] = value
+        map(lambda x: x[2](), self._pages)
+        if self._optFile is not None:
+            save_options(self.options, self._optFile)
+
     def OnCancel(self, evt):
         map(lambda x: x[2](), self._pages)
         evt.Skip()
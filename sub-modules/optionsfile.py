@@ -0,0 +1,74 @@
+"""
+The options and the file that they are kept in, separate from the options
+dialog so that they can be used without wx (e.g. by the command line).
+"""
+import multiprocessing
+from hashindex import CHECK_QUICK
+from exporter import COLLISION_ASK, ARCHIVE_NONE
+
+# Set everything to the default values in the first case
+_defaultOptions = {
+        "ImageExtensions" : [],
+        "GpsExtensions" : [],
+        "OtherExtensions" : [],
+        "SidecarExtensions" : [],
+        "WorkingDir" : "",
+        "FilingDir" : "",
+        "FilingStruct" : "%Y/%Y_%m/%Y_%m_%d",
+        "FilingMirrors" : [],
+        "JpegtranEnabled": True,
+        "JpegtranPath": "",
+        "ExiftoolPath": "",
+        "ImportCopyWorkers": 2,
+        "ImportRotateWorkers": multiprocessing.cpu_count(),
+        "ImportMetadataWorkers": 1,
+        "ImportQueueSize": 32,
+        "ImportBatchSize": 50,
+        "ImportBatchLatency": 500,
+        "ImportDuplicateCheck": CHECK_QUICK,
+        "GeotagClockOffset": 0,
+        "GeotagOffsetRange": 12,
+        "PlaceIndex": "",
+        "PlaceMaxDistance": 50,
+        "ExportCopyWorkers": 4,
+        "ExportCollisions": COLLISION_ASK,
+        "ExportArchive": ARCHIVE_NONE,
+        "ExportArchiveDir": "",
+        "ExportArchiveVolumeSize": 0,
+        "ExportArchiveOnly": False,
+        }
+
+def int_option(options, name):
+    """
+    Returns the named option as an integer, falling back to the default value
+    if it has been set to something that isn't a positive integer
+    """
+    try:
+        v = int(options[name])
+        if v > 0:
+            return v
+    except (KeyError, ValueError):
+        pass
+    return _defaultOptions[name]
+
+def load_options(optFile = None):
+    """
+    Returns the options read from the file, with the default value of any
+    that aren't set
+    """
+    readOpts = {}
+    if optFile is not None:
+        try:
+            o = file(optFile).read()
+        except IOError:
+            o = "{}"
+        readOpts = eval(o)
+
+    options = dict(_defaultOptions)
+    for k, v in readOpts.items():
+        options[k] = v
+    return options
+
+def save_options(options, optFile):
+    with file(optFile, "w") as o:
+        o.write(repr(options))
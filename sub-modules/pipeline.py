@@ -0,0 +1,181 @@
+"""
+A simple multi-stage pipeline. Each stage is run by its own pool of threads
+and stages are connected by bounded queues, so that a slow stage applies back
+pressure to the ones before it rather than letting work pile up in memory,
+while stages limited by different resources (e.g. card reads, CPU, exiftool)
+overlap with each other.
+"""
+import threading, traceback, time
+import Queue
+
+_DEBUG = True
+
+# Placed in a stage's queue (once per worker) to tell it there is no more work
+_END = object()
+
+class _Stage(object):
+    def __init__(self, pipeline, name, fn, workers, queueSize):
+        self.pipeline = pipeline
+        self.name = name
+        self.fn = fn
+        self.queue = Queue.Queue(queueSize)
+        self.next = None
+        self.sink = None
+        self._lock = threading.Lock()
+        self._running = workers
+        self.threads = [threading.Thread(target = self._worker, name = "%s-%d" % (name, n))
+                        for n in range(workers)]
+        for t in self.threads:
+            t.setDaemon(True)
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+
+    def end(self):
+        for t in self.threads:
+            self.queue.put(_END)
+
+    def _emit(self, item):
+        if self.next is not None:
+            self.next.queue.put(item)
+        elif self.sink is not None:
+            self.sink(item)
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is _END:
+                break
+            if self.pipeline.cancelled:
+                # Just drain the queue
+                continue
+            try:
+                result = self.fn(item)
+            except Exception, e:
+                if _DEBUG: traceback.print_exc()
+                self.pipeline.add_error(self.name, item, e)
+                continue
+            if result is not None:
+                self._emit(result)
+
+        # The last worker out of a stage tells the next stage that it's done
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last and self.next is not None:
+            self.next.end()
+
+class Pipeline(object):
+    """
+    The stages are given as a list of (name, fn, workers) tuples. Each item put
+    into the pipeline is passed to the first stage's function and whatever that
+    returns is passed on to the next stage; returning None drops the item. What
+    is returned by the final stage is passed to the sink function, if any.
+
+    Exceptions raised by a stage function are recorded in the errors member as
+    (stage name, item, exception) tuples and the item is dropped.
+    """
+    def __init__(self, stages, sink = None, queueSize = 16):
+        self.errors = []
+        self.cancelled = False
+        self._errorLock = threading.Lock()
+        self._stages = [_Stage(self, name, fn, max(1, workers), queueSize)
+                        for name, fn, workers in stages]
+        for stage, nextStage in zip(self._stages, self._stages[1:]):
+            stage.next = nextStage
+        self._stages[-1].sink = sink
+        for stage in self._stages:
+            stage.start()
+
+    def add_error(self, name, item, exception):
+        with self._errorLock:
+            self.errors.append((name, item, exception))
+
+    def put(self, item):
+        """
+        Add an item to the pipeline, blocking while the first stage is full
+        """
+        self._stages[0].queue.put(item)
+
+    def close(self):
+        """
+        Indicate that there are no more items and wait for all of those already
+        in the pipeline to pass through it
+        """
+        self._stages[0].end()
+        for stage in self._stages:
+            for t in stage.threads:
+                t.join()
+
+    def cancel(self):
+        """
+        Discard any items that haven't yet been processed; close() must still
+        be called to wait for the pipeline to stop
+        """
+        self.cancelled = True
+
+class Batcher(object):
+    """
+    Collects the items arriving on a queue into batches for a consumer that is
+    more efficient when given several items at once (e.g. exiftool). A batch
+    is returned as soon as it reaches the target size or the maximum latency
+    (in seconds) has passed since its first item arrived, so batches grow
+    with the arrival rate without holding up a trickle of items for long.
+
+    The end item (None by default) ends the batching: any items already
+    collected are returned and subsequent calls return None.
+
+    Counters of the batches, items and time spent waiting for items to fill
+    the batches are kept to help with tuning.
+    """
+    def __init__(self, queue, targetSize, maxLatency, end = None):
+        self._queue = queue
+        self._end = end
+        self.targetSize = targetSize
+        self.maxLatency = maxLatency
+        self.closed = False
+        self.batches = 0
+        self.items = 0
+        self.waitTime = 0.0
+        self.maxWait = 0.0
+
+    def get_batch(self):
+        if self.closed:
+            return None
+        item = self._queue.get()
+        if item is self._end:
+            self.closed = True
+            return None
+        batch = [item]
+        start = time.time()
+        deadline = start + self.maxLatency
+        while len(batch) < self.targetSize:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    item = self._queue.get(timeout = timeout)
+                else:
+                    # Still take whatever is already waiting
+                    item = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is self._end:
+                self.closed = True
+                break
+            batch.append(item)
+        wait = time.time() - start
+        self.batches += 1
+        self.items += len(batch)
+        self.waitTime += wait
+        self.maxWait = max(self.maxWait, wait)
+        return batch
+
+    def stats(self):
+        return {
+                "batches": self.batches,
+                "items": self.items,
+                "meanBatchSize": self.items / float(self.batches) if self.batches else 0.0,
+                "meanWait": self.waitTime / self.batches if self.batches else 0.0,
+                "maxWait": self.maxWait,
+                }
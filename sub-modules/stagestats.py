@@ -0,0 +1,100 @@
+"""
+Instrumentation of the stages of the work that PGTips does (importing,
+geotagging and exporting), counting the items, bytes and time spent in each
+so that it is possible to tell which stage is limiting a run.
+
+The time recorded is the time spent working in a stage summed over all of its
+workers, so with several workers it can exceed the elapsed time of the run.
+
+Every measurement is also appended to a log file, if one is given, as a line
+of JSON so that a run can be analysed afterwards.
+"""
+import time, json, threading
+from contextlib import contextmanager
+
+_DEBUG = True
+
+# The stages that are measured, in the order that they are reported
+DISCOVERY = "discovery"
+COPY = "copy"
+ROTATE = "rotate"
+EXIF_READ = "exiftool read"
+GEOTAG_MATCH = "geotag match"
+EXIF_WRITE = "exiftool write"
+EXPORT_MOVE = "export move"
+EXPORT_ARCHIVE = "export archive"
+STAGES = [DISCOVERY, COPY, ROTATE, EXIF_READ, GEOTAG_MATCH, EXIF_WRITE, EXPORT_MOVE, EXPORT_ARCHIVE]
+
+class _Counter(object):
+    __slots__ = ["items", "bytes", "seconds"]
+
+    def __init__(self):
+        self.items = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+class StageStats(object):
+    def __init__(self, logFile = None):
+        self._lock = threading.Lock()
+        self._counters = dict((stage, _Counter()) for stage in STAGES)
+        self._log = None
+        if logFile is not None:
+            try:
+                self._log = open(logFile, "a")
+            except IOError, e:
+                if _DEBUG: print "Unable to open", logFile, "-", e
+
+    def _write(self, record):
+        if self._log is not None:
+            record["time"] = time.time()
+            self._log.write(json.dumps(record, sort_keys = True) + "\n")
+            self._log.flush()
+
+    def add(self, stage, items = 1, bytes = 0, seconds = 0.0):
+        with self._lock:
+            c = self._counters[stage]
+            c.items += items
+            c.bytes += bytes
+            c.seconds += seconds
+            self._write({"stage": stage, "items": items, "bytes": bytes, "seconds": seconds})
+
+    @contextmanager
+    def timed(self, stage, items = 1, bytes = 0):
+        """
+        Time the body of a with statement as work in the stage. The yielded
+        dictionary's items and bytes can be updated if they are only known
+        once the work has been done.
+        """
+        counts = {"items": items, "bytes": bytes}
+        start = time.time()
+        try:
+            yield counts
+        finally:
+            self.add(stage, counts["items"], counts["bytes"], time.time() - start)
+
+    def mark(self, event, **fields):
+        """
+        Record an event, such as the start or end of a run, in the log
+        """
+        fields["event"] = event
+        with self._lock:
+            self._write(fields)
+
+    def totals(self):
+        """
+        Returns a list of (stage, items, bytes, seconds) tuples in stage order
+        """
+        with self._lock:
+            return [(stage, self._counters[stage].items, self._counters[stage].bytes, self._counters[stage].seconds)
+                    for stage in STAGES]
+
+    def reset(self):
+        with self._lock:
+            self._counters = dict((stage, _Counter()) for stage in STAGES)
+            self._write({"event": "reset"})
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+import wx
+import  wx.lib.mixins.listctrl as listmix
+
+_COLUMNS = ["Stage", "Items", "MB", "Busy (s)", "Items/s", "MB/s"]
+
+class _StatsListCtrl(wx.ListCtrl, listmix.ListCtrlAutoWidthMixin):
+    def __init__(self, parent, ID, pos=wx.DefaultPosition,
+                 size=wx.DefaultSize, style=0):
+        wx.ListCtrl.__init__(self, parent, ID, pos, size, style)
+        listmix.ListCtrlAutoWidthMixin.__init__(self)
+
+class StageStatsPanel(wx.Panel):
+    """
+    Define the panel that shows the throughput of each stage, as counted by a
+    StageStats object. The rates are per second of busy time, so they show
+    how quickly a stage gets through work while it is doing it.
+    """
+    def __init__(self, parent, stats):
+        wx.Panel.__init__(self, parent, -1)
+        self._stats = stats
+
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        self._listCtrl = _StatsListCtrl(self, -1,
+                                        style=wx.LC_REPORT
+                                        | wx.BORDER_NONE
+                                        | wx.LC_VRULES
+                                        | wx.LC_HRULES
+                                        | wx.LC_SINGLE_SEL
+                                        )
+        sizer.Add(self._listCtrl, 1, wx.EXPAND)
+        for n, title in enumerate(_COLUMNS):
+            self._listCtrl.InsertColumn(n, title, wx.LIST_FORMAT_LEFT if n == 0 else wx.LIST_FORMAT_RIGHT)
+        for n, (stage, items, bytes, seconds) in enumerate(stats.totals()):
+            self._listCtrl.InsertStringItem(n, stage)
+
+        self.SetSizer(sizer)
+        self.SetAutoLayout(True)
+        self.refresh()
+
+    def refresh(self):
+        """
+        Update the figures from the current totals
+        """
+        for n, (stage, items, bytes, seconds) in enumerate(self._stats.totals()):
+            mb = bytes / (1024.0 * 1024.0)
+            values = [str(items), "%.1f" % mb, "%.1f" % seconds]
+            if seconds > 0:
+                values += ["%.1f" % (items / seconds), "%.1f" % (mb / seconds)]
+            else:
+                values += ["-", "-"]
+            for col, value in enumerate(values):
+                if self._listCtrl.GetItem(n, col + 1).GetText() != value:
+                    self._listCtrl.SetStringItem(n, col + 1, value)
@@ -0,0 +1,194 @@
+"""
+Reading and writing of geotags in XMP sidecar files, i.e. a .xmp file next
+to the image with the same base name. For large RAW files, writing a few
+hundred bytes of sidecar is much cheaper than having exiftool rewrite the
+whole image and most RAW processors will pick the geotag up from there.
+"""
+import os, sys, re
+import xml.etree.ElementTree as ET
+
+SIDECAR_EXTENSION = ".xmp"
+
+_NS_X = "adobe:ns:meta/"
+_NS_RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+_NS_EXIF = "http://ns.adobe.com/exif/1.0/"
+
+for prefix, uri in [("x", _NS_X), ("rdf", _NS_RDF), ("exif", _NS_EXIF)]:
+    ET.register_namespace(prefix, uri)
+
+_DESCRIPTION = "{%s}Description" % _NS_RDF
+_ABOUT = "{%s}about" % _NS_RDF
+
+_GPS_TAGS = [
+        "GPSVersionID",
+        "GPSLatitude",
+        "GPSLongitude",
+        "GPSAltitude",
+        "GPSAltitudeRef",
+        ]
+
+_TEMPLATE = (
+        '<x:xmpmeta xmlns:x="%s">'
+        '<rdf:RDF xmlns:rdf="%s">'
+        '<rdf:Description rdf:about="" xmlns:exif="%s"/>'
+        '</rdf:RDF>'
+        '</x:xmpmeta>' % (_NS_X, _NS_RDF, _NS_EXIF))
+
+# XMP stores coordinates as "DDD,MM.mmmmK" or "DDD,MM,SSK"
+_coordinate = re.compile(
+    "^(?P<degrees>[0-9]+)"
+    ",(?P<minutes>[0-9]+(\.[0-9]*)?)"
+    "(,(?P<seconds>[0-9]+(\.[0-9]*)?))?"
+    "(?P<ref>[NSEW])$")
+
+def sidecar_filename(filename):
+    """
+    Returns the name of the sidecar for the file, preferring one that already
+    exists (in either case) over the default lower-case extension
+    """
+    base = os.path.splitext(filename)[0]
+    for ext in (SIDECAR_EXTENSION, SIDECAR_EXTENSION.upper()):
+        if os.path.isfile(base + ext):
+            return base + ext
+    return base + SIDECAR_EXTENSION
+
+def _parse_coordinate(value):
+    m = _coordinate.match(value.strip())
+    if not m:
+        raise ValueError("Invalid XMP GPS coordinate: " + value)
+    v = int(m.group("degrees")) + float(m.group("minutes")) / 60.0
+    if m.group("seconds") is not None:
+        v += float(m.group("seconds")) / 3600.0
+    if m.group("ref") in "SW":
+        v = -v
+    return v
+
+def _format_coordinate(value, positive, negative):
+    ref = positive if value >= 0 else negative
+    value = abs(value)
+    degrees = int(value)
+    return "%d,%.8f%s" % (degrees, (value - degrees) * 60, ref)
+
+def _parse_rational(value):
+    if "/" in value:
+        num, den = value.split("/", 1)
+        return float(num) / float(den)
+    return float(value)
+
+def _gps_properties(root):
+    """
+    Gather the exif:GPS* properties, which may be held as either attributes
+    or child elements of any rdf:Description
+    """
+    props = {}
+    for description in root.iter(_DESCRIPTION):
+        for tag in _GPS_TAGS:
+            key = "{%s}%s" % (_NS_EXIF, tag)
+            value = description.get(key)
+            if value is None:
+                element = description.find(key)
+                if element is not None:
+                    value = element.text
+            if value is not None:
+                props[tag] = value
+    return props
+
+def read_geotag(filename):
+    """
+    Returns the (lat, lon, alt) tuple from the file's sidecar or None if there
+    isn't a sidecar or it doesn't hold a position
+    """
+    sidecar = sidecar_filename(filename)
+    if not os.path.isfile(sidecar):
+        return None
+    try:
+        props = _gps_properties(ET.parse(sidecar).getroot())
+        lat = _parse_coordinate(props["GPSLatitude"])
+        lon = _parse_coordinate(props["GPSLongitude"])
+    except (KeyError, ValueError, SyntaxError):
+        return None
+    try:
+        alt = _parse_rational(props["GPSAltitude"])
+        if props.get("GPSAltitudeRef", "0").strip() == "1":
+            alt = -alt
+    except (KeyError, ValueError, ZeroDivisionError):
+        alt = None
+    return lat, lon, alt
+
+def _parse_preserving_prefixes(sidecar):
+    """
+    Parse the sidecar, registering the namespace prefixes that it uses so that
+    they survive being written back out (rather than becoming ns0, ns1, ...)
+    """
+    for event, (prefix, uri) in ET.iterparse(sidecar, events = ("start-ns",)):
+        try:
+            ET.register_namespace(prefix, uri)
+        except ValueError:
+            pass
+    return ET.parse(sidecar)
+
+def write_geotag(filename, geotag, clearAltitude = False):
+    """
+    Set (or, if geotag is None, remove) the position in the file's sidecar,
+    creating the sidecar if required. A geotag without an altitude leaves any
+    existing altitude in place unless clearAltitude is set. Any other content of an existing sidecar
+    (e.g. from a RAW processor) is preserved.
+    """
+    sidecar = sidecar_filename(filename)
+    if os.path.isfile(sidecar):
+        tree = _parse_preserving_prefixes(sidecar)
+    else:
+        if geotag is None:
+            return
+        tree = ET.ElementTree(ET.fromstring(_TEMPLATE))
+    root = tree.getroot()
+
+    descriptions = list(root.iter(_DESCRIPTION))
+    if len(descriptions) == 0:
+        raise ValueError("%s has no rdf:Description" % sidecar)
+    # Remove any existing GPS properties, whichever form they're in. As with
+    # the embedded geotag, a missing altitude leaves any existing one in place
+    tags = _GPS_TAGS
+    if geotag is not None and geotag[2] is None and not clearAltitude:
+        tags = [t for t in tags if not t.startswith("GPSAltitude")]
+    for description in descriptions:
+        for tag in tags:
+            key = "{%s}%s" % (_NS_EXIF, tag)
+            if key in description.attrib:
+                del description.attrib[key]
+            for element in description.findall(key):
+                description.remove(element)
+
+    if geotag is not None:
+        lat, lon, alt = geotag
+        description = descriptions[0]
+        if description.get(_ABOUT) is None:
+            description.set(_ABOUT, "")
+        description.set("{%s}GPSVersionID" % _NS_EXIF, "2.3.0.0")
+        description.set("{%s}GPSLatitude" % _NS_EXIF, _format_coordinate(lat, "N", "S"))
+        description.set("{%s}GPSLongitude" % _NS_EXIF, _format_coordinate(lon, "E", "W"))
+        if alt is not None:
+            description.set("{%s}GPSAltitude" % _NS_EXIF, "%d/1000" % int(round(abs(alt) * 1000)))
+            description.set("{%s}GPSAltitudeRef" % _NS_EXIF, "1" if alt < 0 else "0")
+
+    tmpFile = sidecar + ".pgtips~"
+    removed = False
+    try:
+        tree.write(tmpFile, encoding = "UTF-8")
+        if sys.platform == "win32" and os.path.exists(sidecar):
+            # os.rename() won't replace an existing file on Windows
+            os.remove(sidecar)
+            removed = True
+        os.rename(tmpFile, sidecar)
+    finally:
+        # The new sidecar is only kept if it's all there is (i.e. the old one
+        # was removed on Windows but the rename then failed)
+        if os.path.exists(tmpFile) and not removed:
+            try:
+                os.remove(tmpFile)
+            except OSError:
+                pass
+
+if __name__ == "__main__":
+    for f in sys.argv[1:]:
+        print f, read_geotag(f)
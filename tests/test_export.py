@@ -0,0 +1,136 @@
+"""
+Tests of exporting files into the filing tree, run with:
+
+    python -m unittest discover tests
+
+exiftool is replaced by a script that reports a fixed capture time and no
+embedded geotag for each file, so the only geotag is any in a sidecar.
+"""
+import os, sys, json, shutil, tarfile, tempfile, unittest
+from cStringIO import StringIO
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sub-modules"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import xmpsidecar
+import pgtipscli
+from catalog import Catalog
+from exporter import ExportArchive, archive_files
+
+_FAKE_EXIFTOOL = """#!%s
+import sys
+from xml.sax.saxutils import quoteattr, escape
+print "<?xml version='1.0' encoding='UTF-8'?>"
+print "<rdf:RDF xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#'>"
+for line in sys.stdin:
+    f = line.strip()
+    if f == "" or f.startswith("-"):
+        continue
+    print "<rdf:Description rdf:about=%%s" %% quoteattr(f)
+    print " xmlns:System='http://ns.exiftool.ca/File/System/1.0/'"
+    print " xmlns:ExifIFD='http://ns.exiftool.ca/EXIF/ExifIFD/1.0/'>"
+    print " <System:FileName>%%s</System:FileName>" %% escape(f.split("/")[-1])
+    print " <ExifIFD:DateTimeOriginal>2020:05:01 12:00:00</ExifIFD:DateTimeOriginal>"
+    print "</rdf:Description>"
+print "</rdf:RDF>"
+"""
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.workingDir = os.path.join(self.dir, "working")
+        self.filingDir = os.path.join(self.dir, "filing")
+        toolDir = os.path.join(self.dir, "tools")
+        for d in [self.workingDir, self.filingDir, toolDir]:
+            os.mkdir(d)
+        exiftool = os.path.join(toolDir, "exiftool")
+        with open(exiftool, "w") as f:
+            f.write(_FAKE_EXIFTOOL % sys.executable)
+        os.chmod(exiftool, 0755)
+        self.options = os.path.join(self.dir, "pgtips.opt")
+        with open(self.options, "w") as f:
+            f.write(repr({"WorkingDir": self.workingDir,
+                          "FilingDir": self.filingDir,
+                          "ExiftoolPath": toolDir,
+                          "SidecarExtensions": [".cr2"]}))
+        self.catalog = os.path.join(self.dir, "pgtips.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def export(self, *args):
+        out = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            status = pgtipscli.main(["--options", self.options,
+                                     "--index", os.path.join(self.dir, "pgtips.idx"),
+                                     "--catalog", self.catalog,
+                                     "--geotag-journal", os.path.join(self.dir, "pgtips.undo"),
+                                     "export"] + list(args))
+            result = json.loads(sys.stdout.getvalue())
+        finally:
+            sys.stdout = out
+        self.assertEqual(status, 0, result)
+        return result
+
+    def test_sidecar_geotag_is_catalogued(self):
+        raw = os.path.join(self.workingDir, "IMG_0001.CR2")
+        with open(raw, "wb") as f:
+            f.write("RAW DATA" * 100)
+        xmpsidecar.write_geotag(raw, (51.4778, -0.0015, 46.5))
+
+        self.export()
+        filedDir = os.path.join(self.filingDir, "2020", "2020_05", "2020_05_01")
+        filed = os.path.join(filedDir, "IMG_0001.CR2")
+        self.assertTrue(os.path.isfile(filed))
+        self.assertTrue(os.path.isfile(os.path.join(filedDir, "IMG_0001.xmp")))
+        self.assertEqual(os.listdir(self.workingDir), [])
+
+        catalog = Catalog(self.catalog)
+        try:
+            entry = catalog.find_path(filed)
+            self.assertNotEqual(entry, None)
+            self.assertAlmostEqual(entry.lat, 51.4778, 5)
+            self.assertAlmostEqual(entry.lon, -0.0015, 5)
+            self.assertAlmostEqual(entry.alt, 46.5, 3)
+            self.assertEqual([e.path for e in catalog.find_in_area(51.4, -0.1, 51.5, 0.1)], [os.path.abspath(filed)])
+        finally:
+            catalog.close()
+
+    def test_archive_keeps_sidecar_with_file(self):
+        srcFiles = []
+        for n in range(3):
+            raw = os.path.join(self.workingDir, "IMG_%04d.CR2" % n)
+            with open(raw, "wb") as f:
+                f.write("RAW DATA" * 200)
+            xmpsidecar.write_geotag(raw, (51.4778, -0.0015, None))
+            srcFiles.append(raw)
+        sidecars = dict((f, os.path.splitext(f)[0] + ".xmp") for f in srcFiles)
+        exportDir = os.path.join(self.filingDir, "2020")
+        # Each volume only has room for a file, not its sidecar as well, but
+        # the two still go in the same volume
+        archive = ExportArchive(os.path.join(self.dir, "archive"), volumeSize = 3000)
+        archived, failed = archive_files(archive, srcFiles, exportDir, self.filingDir, sidecars = sidecars)
+        self.assertEqual(failed, [])
+        volumes = archive.close()
+        self.assertEqual(len(volumes), 3)
+        for n, volume in enumerate(volumes):
+            self.assertEqual(sorted(tarfile.open(volume).getnames()),
+                             ["2020/IMG_%04d.CR2" % n, "2020/IMG_%04d.xmp" % n])
+
+    def test_export_with_archive(self):
+        raw = os.path.join(self.workingDir, "IMG_0001.CR2")
+        with open(raw, "wb") as f:
+            f.write("RAW DATA" * 100)
+        xmpsidecar.write_geotag(raw, (51.4778, -0.0015, 46.5))
+
+        result = self.export("--archive", "tar", "--archive-dir", self.dir)
+        self.assertEqual(len(result["exported"]), 1)
+        self.assertEqual([a["name"] for a in result["archived"]], ["2020/2020_05/2020_05_01/IMG_0001.CR2"])
+        self.assertEqual(len(result["volumes"]), 1)
+        self.assertEqual(sorted(tarfile.open(result["volumes"][0]).getnames()),
+                         ["2020/2020_05/2020_05_01/IMG_0001.CR2", "2020/2020_05/2020_05_01/IMG_0001.xmp"])
+        self.assertEqual(os.listdir(self.workingDir), [])
+
+if __name__ == "__main__":
+    unittest.main()
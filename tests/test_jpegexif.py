@@ -0,0 +1,89 @@
+"""
+Round trip tests of the native JPEG geotag writer, run with:
+
+    python -m unittest discover tests
+"""
+import os, sys, struct, shutil, tempfile, unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sub-modules"))
+
+import jpegexif
+
+def _fixture_jpeg(path, endian = "<"):
+    """
+    Write a small JPEG whose EXIF data has an IFD0 holding the camera make
+    (stored outside the entry) and the orientation, but no GPS IFD
+    """
+    entries = [(0x010f, 2, 6, "Canon\x00"), (0x0112, 3, 1, struct.pack(endian + "H", 6) + "\x00\x00")]
+    tiff = ("II*\x00" if endian == "<" else "MM\x00*") + struct.pack(endian + "L", 8)
+    valueOffset = 8 + 2 + 12 * len(entries) + 4
+    ifd = struct.pack(endian + "H", len(entries))
+    values = ""
+    for tag, typ, count, value in entries:
+        if len(value) <= 4:
+            ifd += struct.pack(endian + "HHL", tag, typ, count) + value
+        else:
+            ifd += struct.pack(endian + "HHL", tag, typ, count) + struct.pack(endian + "L", valueOffset + len(values))
+            values += value
+    ifd += struct.pack(endian + "L", 0)
+    payload = "Exif\x00\x00" + tiff + ifd + values
+    with open(path, "wb") as f:
+        f.write("\xff\xd8")
+        f.write("\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload)
+        f.write("\xff\xda" + struct.pack(">H", 4) + "\x00\x00" + "IMAGEDATA" * 100 + "\xff\xd9")
+
+class WriteGeotagTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.jpeg = os.path.join(self.dir, "fixture.jpg")
+        _fixture_jpeg(self.jpeg)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertGeotag(self, geotag):
+        written = jpegexif.read_geotag(self.jpeg)
+        self.assertTrue(jpegexif.same_geotag(written, geotag, 1e-5, 1e-5), "wrote %s but read back %s" % (geotag, written))
+
+    def test_round_trip(self):
+        self.assertEqual(jpegexif.read_geotag(self.jpeg), None)
+        jpegexif.write_geotag(self.jpeg, (51.4778, -0.0015, 46.5))
+        self.assertGeotag((51.4778, -0.0015, 46.5))
+        self.assertEqual(jpegexif.read_orientation(self.jpeg), 6)
+
+    def test_rewrite_keeps_size(self):
+        jpegexif.write_geotag(self.jpeg, (51.4778, -0.0015, 46.5))
+        size = os.path.getsize(self.jpeg)
+        for geotag in [(-33.8568, 151.2153, -2.0), (51.4778, -0.0015, 46.5), (40.6892, -74.0445, 93.0)]:
+            jpegexif.write_geotag(self.jpeg, geotag)
+            self.assertGeotag(geotag)
+            self.assertEqual(os.path.getsize(self.jpeg), size)
+
+    def test_remove_and_geotag_again_keeps_size(self):
+        jpegexif.write_geotag(self.jpeg, (51.4778, -0.0015, 46.5))
+        size = os.path.getsize(self.jpeg)
+        jpegexif.write_geotag(self.jpeg, None)
+        self.assertEqual(jpegexif.read_geotag(self.jpeg), None)
+        self.assertTrue(os.path.getsize(self.jpeg) <= size)
+        jpegexif.write_geotag(self.jpeg, (51.4778, -0.0015, 46.5))
+        self.assertGeotag((51.4778, -0.0015, 46.5))
+        self.assertEqual(os.path.getsize(self.jpeg), size)
+
+    def test_missing_altitude(self):
+        jpegexif.write_geotag(self.jpeg, (51.4778, -0.0015, 46.5))
+        jpegexif.write_geotag(self.jpeg, (51.5, -0.1, None))
+        self.assertEqual(jpegexif.read_geotag(self.jpeg)[2], 46.5)
+        jpegexif.write_geotag(self.jpeg, (51.5, -0.1, None), clearAltitude = True)
+        self.assertGeotag((51.5, -0.1, None))
+        self.assertEqual(jpegexif.read_geotag(self.jpeg)[2], None)
+
+    def test_big_endian(self):
+        _fixture_jpeg(self.jpeg, ">")
+        jpegexif.write_geotag(self.jpeg, (51.4778, -0.0015, None))
+        size = os.path.getsize(self.jpeg)
+        jpegexif.write_geotag(self.jpeg, (51.5, -0.1, None))
+        self.assertGeotag((51.5, -0.1, None))
+        self.assertEqual(os.path.getsize(self.jpeg), size)
+
+if __name__ == "__main__":
+    unittest.main()